@@ -0,0 +1,127 @@
+"""
+Admission control of inbound /chatws frames.
+Every connection has a token bucket for frames and every username one for chat messages, so a single chatty or
+malicious client can not take the event loop away from everyone else.
+Frames over the limit are dropped before they are decoded, which is the expensive part.
+"""
+import heapq
+from typing import Dict, List, Optional, Set, Tuple
+
+# Errors sent to the client when a frame or message is dropped
+RATE_LIMITED = 'rateLimited'
+FRAME_TOO_LARGE = 'frameTooLarge'
+
+
+class TokenBucket:
+    """ Allows 'rate' events per second on average and bursts of up to 'burst' events """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self, now: float) -> bool:
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.burst
+
+    def full_at(self, now: float) -> float:
+        """ Time at which the bucket is full again if no tokens are taken """
+        self.refill(now)
+        return now + (self.burst - self.tokens) / self.rate
+
+
+class AdmissionControl:
+    def __init__(
+        self,
+        frame_rate: float = 50,
+        frame_burst: float = 100,
+        message_rate: float = 20,
+        message_burst: float = 40,
+        max_frame_size: int = 65536,
+    ):
+        # A rate of 0 disables the limit
+        self.frame_rate = frame_rate
+        self.frame_burst = frame_burst
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        # Characters of text frames or bytes of binary frames, 0 disables the limit
+        self.max_frame_size = max_frame_size
+        # Keyed by id(websocket)
+        self.connection_buckets: Dict[int, TokenBucket] = {}
+        # Connections whose last frame was dropped
+        self.throttled: Set[int] = set()
+        # Kept after the user disconnected until the bucket is full again, so reconnecting does not reset the limit
+        self.user_buckets: Dict[str, TokenBucket] = {}
+        # Released username -> time its bucket is full again
+        self.released_users: Dict[str, float] = {}
+        # (time the bucket is full again, username), the oldest release first, entries of users that came back are
+        # skipped when they are popped
+        self._released_queue: List[Tuple[float, str]] = []
+        self.dropped_frames: int = 0
+        self.oversized_frames: int = 0
+        self.dropped_messages: int = 0
+
+    def add(self, connection_id: int, now: float):
+        if self.frame_rate > 0:
+            self.connection_buckets[connection_id] = TokenBucket(self.frame_rate, self.frame_burst, now)
+
+    def remove(self, connection_id: int):
+        self.connection_buckets.pop(connection_id, None)
+        self.throttled.discard(connection_id)
+
+    def admit_frame(self, connection_id: int, size: int, now: float) -> Optional[str]:
+        """ Called for every inbound frame before it is decoded, returns the error if the frame is dropped """
+        bucket = self.connection_buckets.get(connection_id)
+        if bucket is not None and not bucket.take(now):
+            self.dropped_frames += 1
+            self.throttled.add(connection_id)
+            return RATE_LIMITED
+        self.throttled.discard(connection_id)
+        # Checked after the rate, so oversized frames also use up the budget of the connection
+        if self.max_frame_size and size > self.max_frame_size:
+            self.oversized_frames += 1
+            return FRAME_TOO_LARGE
+        return None
+
+    def is_throttled(self, connection_id: int) -> bool:
+        """ Whether the last frame of the connection was dropped """
+        return connection_id in self.throttled
+
+    def admit_message(self, username: str, now: float) -> bool:
+        if self.message_rate <= 0:
+            return True
+        bucket = self.user_buckets.get(username)
+        if bucket is None:
+            bucket = self.user_buckets[username] = TokenBucket(self.message_rate, self.message_burst, now)
+        self.released_users.pop(username, None)
+        if bucket.take(now):
+            return True
+        self.dropped_messages += 1
+        return False
+
+    def release_user(self, username: str, now: float):
+        """ Called when the username is released, forgets the buckets of released users that are full again """
+        bucket = self.user_buckets.get(username)
+        if bucket is not None:
+            full_at = bucket.full_at(now)
+            self.released_users[username] = full_at
+            heapq.heappush(self._released_queue, (full_at, username))
+        # Only the entries that are due are looked at, so a release costs O(log n) amortized
+        while self._released_queue and self._released_queue[0][0] <= now:
+            full_at, name = heapq.heappop(self._released_queue)
+            if self.released_users.get(name) == full_at:
+                self.released_users.pop(name)
+                self.user_buckets.pop(name)
@@ -0,0 +1,360 @@
+"""
+Pub/sub backplane that shares chat messages, username reservations and history between worker processes,
+e.g. when running 'uvicorn backend.main:app --workers 4'.
+Every message is published to the backplane, which delivers it to all workers including the one that published it.
+"""
+import asyncio
+import fcntl
+import json
+import os
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+from loguru import logger
+
+from backend.chat.history import HistoryRecord
+from backend.chat.protocol import ChatMessage
+
+# Called for every message published by any worker: (room, message, message id assigned by the backplane)
+DeliverCallback = Callable[[str, ChatMessage, Optional[int]], Awaitable[None]]
+# Called with a username of this worker that another worker reserved while the hub was replaced
+UsernameLostCallback = Callable[[str], Awaitable[None]]
+
+
+class ChatBackplane:
+    def __init__(self):
+        self._deliver: Optional[DeliverCallback] = None
+        self._username_lost: Optional[UsernameLostCallback] = None
+
+    def attach(self, deliver: DeliverCallback, username_lost: Optional[UsernameLostCallback] = None):
+        self._deliver = deliver
+        self._username_lost = username_lost
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, room: str, message: ChatMessage):
+        raise NotImplementedError()
+
+    async def reserve_username(self, name: str) -> bool:
+        """ Returns False if the name is already taken on any worker """
+        raise NotImplementedError()
+
+    async def release_username(self, name: str):
+        raise NotImplementedError()
+
+    async def fetch_history(self, room: str) -> Optional[List[HistoryRecord]]:
+        """ Recent messages of a room, None if the backplane does not keep history """
+        return None
+
+
+class InProcessBackplane(ChatBackplane):
+    """ Single worker: messages are delivered directly, ids are assigned by the room history """
+    def __init__(self):
+        super().__init__()
+        self.usernames: Set[str] = set()
+
+    async def publish(self, room: str, message: ChatMessage):
+        assert self._deliver is not None
+        await self._deliver(room, message, None)
+
+    async def reserve_username(self, name: str) -> bool:
+        if name in self.usernames:
+            return False
+        self.usernames.add(name)
+        return True
+
+    async def release_username(self, name: str):
+        self.usernames.discard(name)
+
+
+class BackplaneHub:
+    """
+    Runs inside one of the workers and relays messages between all workers connected to the local socket.
+    Wire format: one JSON object per line, requests that expect a reply carry a 'req' id.
+    Every worker starts with a 'hello' that carries the next message id of each room it knows, so a hub that took over
+    from a dead one continues the ids the workers already stored instead of starting at 1 again.
+    """
+    def __init__(self, history_size: int, max_write_buffer: int = 16 * 2**20):
+        self.history_size = history_size
+        # Bytes queued for a worker that does not read, it is then disconnected and resumes after reconnecting
+        self.max_write_buffer = max_write_buffer
+        self.workers: Set[asyncio.StreamWriter] = set()
+        self.usernames: Dict[str, asyncio.StreamWriter] = {}
+        self.histories: Dict[str, Deque[Dict]] = {}
+        self.next_ids: Dict[str, int] = {}
+
+    async def handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while 1:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.handle_request(json.loads(line), writer)
+        except (ConnectionError, ValueError, KeyError) as e:
+            logger.info(f'Backplane worker connection failed: {e}')
+        finally:
+            self.workers.discard(writer)
+            # Usernames of a worker that went away are free again
+            for name in [name for name, owner in self.usernames.items() if owner is writer]:
+                self.usernames.pop(name)
+            writer.close()
+
+    def close(self):
+        for writer in list(self.workers):
+            writer.close()
+
+    def handle_request(self, request: Dict, writer: asyncio.StreamWriter):
+        op = request['op']
+        if op == 'hello':
+            for room, next_id in request['next_ids'].items():
+                self.next_ids[room] = max(self.next_ids.get(room, 1), next_id)
+            # Only from now on, so the worker never receives an id that is lower than the ones it announced
+            self.workers.add(writer)
+        elif op == 'publish':
+            room = request['room']
+            message_id = self.next_ids.get(room, 1)
+            self.next_ids[room] = message_id + 1
+            message = {
+                'op': 'message',
+                'room': room,
+                'id': message_id,
+                'timestamp': request['timestamp'],
+                'author': request['author'],
+                'message': request['message'],
+            }
+            self.histories.setdefault(room, deque(maxlen=self.history_size)).append(message)
+            # Encoded once for all workers
+            line = _encode_line(message)
+            for worker in list(self.workers):
+                self._write(worker, line)
+        elif op == 'reserve':
+            name = request['name']
+            ok = self.usernames.setdefault(name, writer) is writer
+            self._write(writer, _encode_line({'op': 'reply', 'req': request['req'], 'ok': ok}))
+        elif op == 'release':
+            if self.usernames.get(request['name']) is writer:
+                self.usernames.pop(request['name'])
+        elif op == 'history':
+            messages = list(self.histories.get(request['room'], ()))
+            self._write(writer, _encode_line({'op': 'reply', 'req': request['req'], 'messages': messages}))
+
+    def _write(self, writer: asyncio.StreamWriter, line: bytes):
+        if writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() + len(line) > self.max_write_buffer:
+            logger.warning('Disconnecting chat backplane worker that does not keep up')
+            self.workers.discard(writer)
+            # Drops the buffered data instead of waiting until the worker reads it
+            writer.transport.abort()
+            return
+        writer.write(line)
+
+
+def _encode_line(data: Dict) -> bytes:
+    return json.dumps(data, separators=(',', ':')).encode() + b'\n'
+
+
+class SocketBackplane(ChatBackplane):
+    """
+    Workers on the same machine connect to a hub on a unix socket.
+    The first worker that finds no hub starts it, if that worker dies another worker takes over.
+    Reservations and the next message id of every room are re-sent after reconnecting,
+    the history kept by a hub is lost with its worker.
+    A username that another worker reserved on the new hub first is taken away from the local user.
+    """
+    def __init__(
+        self,
+        path: str,
+        history_size: int = 10_000,
+        request_timeout: float = 5,
+        hub_write_buffer: int = 16 * 2**20,
+    ):
+        super().__init__()
+        self.path = path
+        self.history_size = history_size
+        # Used if this worker starts the hub, see BackplaneHub.max_write_buffer
+        self.hub_write_buffer = hub_write_buffer
+        self.request_timeout = request_timeout
+        self.hub: Optional[BackplaneHub] = None
+        self.hub_server: Optional[asyncio.AbstractServer] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, 'asyncio.Future[Dict]'] = {}
+        self._next_request_id = 0
+        self._local_usernames: Set[str] = set()
+        # Next message id of every room this worker received messages for, announced to the hub on connect
+        self._next_ids: Dict[str, int] = {}
+        self._stopping = False
+
+    async def start(self):
+        reader = await self._connect()
+        self._start_reader(reader)
+
+    def _start_reader(self, reader: Optional[asyncio.StreamReader]):
+        self._reader_task = asyncio.create_task(self._read_loop(reader))
+        self._reader_task.add_done_callback(self._reader_done)
+
+    def _reader_done(self, task: 'asyncio.Task[None]'):
+        if task.cancelled() or self._stopping:
+            return
+        # Errors of single messages are handled in the loop, this is a bug in the reader itself
+        logger.opt(exception=task.exception()).error('Chat backplane reader crashed, reconnecting')
+        asyncio.get_event_loop().call_later(1, self._restart_reader)
+
+    def _restart_reader(self):
+        if not self._stopping:
+            self._start_reader(None)
+
+    async def stop(self):
+        self._stopping = True
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self.hub is not None and self.hub_server is not None:
+            self.hub_server.close()
+            self.hub.close()
+            await self.hub_server.wait_closed()
+
+    async def _connect(self) -> asyncio.StreamReader:
+        # The lock file makes sure only one worker starts a hub
+        with open(f'{self.path}.lock', 'w') as lock_file:
+            while 1:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    # Another worker is starting a hub, waiting must not block the event loop
+                    await asyncio.sleep(0.01)
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if os.path.exists(self.path):
+                    # Left over by a worker that died
+                    os.unlink(self.path)
+                self.hub = BackplaneHub(self.history_size, max_write_buffer=self.hub_write_buffer)
+                self.hub_server = await asyncio.start_unix_server(self.hub.handle_worker, self.path)
+                logger.info(f'Started chat backplane hub on {self.path}')
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self._send({'op': 'hello', 'next_ids': self._next_ids})
+        if self._local_usernames:
+            # The replies are read by the read loop that called _connect(), so they are checked in another task
+            reservations = {name: self._send_request({'op': 'reserve', 'name': name}) for name in self._local_usernames}
+            asyncio.ensure_future(self._check_reservations(reservations))
+        return reader
+
+    async def _check_reservations(self, reservations: Dict[str, 'asyncio.Future[Dict]']):
+        await asyncio.wait(reservations.values(), timeout=self.request_timeout)
+        for name, future in reservations.items():
+            if not future.done() or future.cancelled():
+                # Lost the connection again, the next connect checks the reservation again
+                future.cancel()
+                continue
+            if future.result()['ok'] or name not in self._local_usernames:
+                continue
+            logger.warning(f'Username {name} was taken by another worker while reconnecting to the chat backplane hub')
+            self._local_usernames.discard(name)
+            if self._username_lost is not None:
+                await self._username_lost(name)
+
+    async def _reconnect(self) -> asyncio.StreamReader:
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        if self._writer is not None:
+            self._writer.close()
+        delay = 0.1
+        while 1:
+            try:
+                return await self._connect()
+            except OSError as e:
+                logger.warning(f'Connecting to chat backplane hub failed: {e}, retrying in {delay} seconds')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    async def _read_loop(self, reader: Optional[asyncio.StreamReader]):
+        """ Started without a reader after a crash, it then reconnects first """
+        while 1:
+            if reader is None:
+                reader = await self._reconnect()
+            try:
+                line = await reader.readline()
+            except (ConnectionError, ValueError) as e:
+                # ValueError: the line exceeds the buffer limit of the stream
+                logger.warning(f'Reading from chat backplane hub failed: {e}')
+                line = b''
+            if not line:
+                if self._stopping:
+                    return
+                logger.info('Lost connection to chat backplane hub, reconnecting')
+                reader = None
+                continue
+            try:
+                await self._handle_line(line)
+            except Exception:  # pylint: disable=W0703
+                # One bad message must not stop the delivery of all following ones
+                logger.exception('Failed to handle chat backplane message')
+
+    async def _handle_line(self, line: bytes):
+        data = json.loads(line)
+        if data['op'] == 'message':
+            assert self._deliver is not None
+            self._next_ids[data['room']] = data['id'] + 1
+            message = ChatMessage(data['timestamp'], data['author'], data['message'])
+            await self._deliver(data['room'], message, data['id'])
+        elif data['op'] == 'reply':
+            future = self._pending.pop(data['req'], None)
+            if future is not None and not future.done():
+                future.set_result(data)
+
+    def _send(self, request: Dict):
+        assert self._writer is not None, 'SocketBackplane.start() was not called'
+        self._writer.write(_encode_line(request))
+
+    def _send_request(self, request: Dict) -> 'asyncio.Future[Dict]':
+        self._next_request_id += 1
+        request['req'] = self._next_request_id
+        future: 'asyncio.Future[Dict]' = asyncio.get_event_loop().create_future()
+        self._pending[self._next_request_id] = future
+        self._send(request)
+        return future
+
+    async def _request(self, request: Dict) -> Dict:
+        return await asyncio.wait_for(self._send_request(request), self.request_timeout)
+
+    async def publish(self, room: str, message: ChatMessage):
+        self._send({
+            'op': 'publish',
+            'room': room,
+            'timestamp': message.timestamp,
+            'author': message.author,
+            'message': message.message,
+        })
+
+    async def reserve_username(self, name: str) -> bool:
+        reply = await self._request({'op': 'reserve', 'name': name})
+        if reply['ok']:
+            self._local_usernames.add(name)
+        return reply['ok']
+
+    async def release_username(self, name: str):
+        self._local_usernames.discard(name)
+        self._send({'op': 'release', 'name': name})
+
+    async def fetch_history(self, room: str) -> Optional[List[HistoryRecord]]:
+        reply = await self._request({'op': 'history', 'room': room})
+        return [HistoryRecord(m['id'], m['timestamp'], m['author'], m['message']) for m in reply['messages']]
+
+
+def create_backplane(kind: str, socket_path: str, history_size: int) -> ChatBackplane:
+    if kind == 'memory':
+        return InProcessBackplane()
+    if kind == 'socket':
+        return SocketBackplane(socket_path, history_size=history_size)
+    raise ValueError(f'Unknown chat backplane: {kind!r}, choose one of: memory, socket')
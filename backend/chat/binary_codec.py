@@ -0,0 +1,246 @@
+"""
+Compact length-prefixed binary format for /chatws, selected with the 'chat.binary.v1' websocket subprotocol.
+
+Every frame starts with one byte frame type, followed by the frame body.
+    varint:     unsigned LEB128 integer, 7 bits per byte, high bit set on all but the last byte
+    float64:    little endian double
+    str:        varint byte length + utf-8 bytes
+    record:     varint id, float64 timestamp, str author, str message
+
+Server -> client:
+    0x01 newMessage:        str room, record
+    0x02 newMessageHistory: str room, varint count, record * count
+    0x03 historyPage:       uint8 has more, str room, varint count, record * count
+    0x04 connectUser:       str
+    0x05 error:             str
+    0x06 message:           str
+    0x07 leftRoom:          str
+    0x08 ping:              float64
+    0x09 newMessages:       str room, varint count, record * count
+
+Client -> server:
+    0x11 message:           str
+    0x12 tryToConnectUser:  str
+    0x13 sendChatMessage:   str author, str message, optional str room
+    0x14 requestHistory:    uint8 flags (1: since, 2: beforeId, 4: limit, 8: room), then for each set flag in that order:
+                            float64 since, varint beforeId, varint limit, str room
+    0x15 joinRoom:          str
+    0x16 leaveRoom:         str
+    0x17 pong:              float64
+"""
+import struct
+from typing import Any, Dict, List, Sequence, Tuple
+
+from backend.chat.codec import ChatCodec, FrameDecodeError, Payload
+from backend.chat.history import HistoryRecord
+from backend.chat.protocol import DEFAULT_ROOM, HistoryPage, InboundFrame, RequestHistory, SendChatMessage
+
+NEW_MESSAGE = 0x01
+NEW_MESSAGE_HISTORY = 0x02
+HISTORY_PAGE = 0x03
+CONNECT_USER = 0x04
+ERROR = 0x05
+MESSAGE = 0x06
+LEFT_ROOM = 0x07
+PING = 0x08
+NEW_MESSAGES = 0x09
+
+CLIENT_MESSAGE = 0x11
+CLIENT_TRY_TO_CONNECT_USER = 0x12
+CLIENT_SEND_CHAT_MESSAGE = 0x13
+CLIENT_REQUEST_HISTORY = 0x14
+CLIENT_JOIN_ROOM = 0x15
+CLIENT_LEAVE_ROOM = 0x16
+CLIENT_PONG = 0x17
+
+REQUEST_HISTORY_SINCE = 1
+REQUEST_HISTORY_BEFORE_ID = 2
+REQUEST_HISTORY_LIMIT = 4
+REQUEST_HISTORY_ROOM = 8
+
+_FLOAT64 = struct.Struct('<d')
+
+# Frames with a single string as body
+_STRING_FRAMES = {
+    'connectUser': CONNECT_USER,
+    'error': ERROR,
+    'message': MESSAGE,
+    'leftRoom': LEFT_ROOM,
+}
+_CLIENT_STRING_FRAMES = {
+    CLIENT_MESSAGE: 'message',
+    CLIENT_TRY_TO_CONNECT_USER: 'tryToConnectUser',
+    CLIENT_JOIN_ROOM: 'joinRoom',
+    CLIENT_LEAVE_ROOM: 'leaveRoom',
+}
+
+
+def _encode_varint(value: int) -> bytes:
+    if value < 0x80:
+        # Fast path, covers most string lengths
+        return bytes((value, ))
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _decode_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while 1:
+        if offset >= len(data) or shift > 63:
+            raise FrameDecodeError('Invalid varint')
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _encode_str(text: str) -> bytes:
+    encoded = text.encode()
+    return _encode_varint(len(encoded)) + encoded
+
+
+def _decode_str(data: bytes, offset: int) -> Tuple[str, int]:
+    length, offset = _decode_varint(data, offset)
+    if offset + length > len(data):
+        raise FrameDecodeError('String exceeds frame length')
+    return data[offset:offset + length].decode(), offset + length
+
+
+class BinaryCodec(ChatCodec):
+    name = 'binary'
+
+    def encode(self, obj: Dict[str, Any]) -> bytes:
+        # The frame name is the first key, message frames may have an additional 'room' key
+        frame_name, value = next(iter(obj.items()))
+        room = obj.get('room', DEFAULT_ROOM)
+        if frame_name in _STRING_FRAMES:
+            return bytes((_STRING_FRAMES[frame_name], )) + _encode_str(value)
+        if frame_name == 'ping':
+            return bytes((PING, )) + _FLOAT64.pack(value)
+        if frame_name == 'newMessage':
+            return self.new_message_frame(self.encode_record(value), room)
+        if frame_name == 'newMessageHistory':
+            return self.history_frame([self.encode_record(record) for record in value], room)
+        if frame_name == 'historyPage':
+            page: HistoryPage = value
+            header = bytes((HISTORY_PAGE, page.hasMore)) + _encode_str(page.room) + _encode_varint(len(page.messages))
+            return header + b''.join(self.encode_record(record) for record in page.messages)
+        raise ValueError(f'Unknown frame: {frame_name}')
+
+    def encode_record(self, record: HistoryRecord) -> bytes:
+        return b''.join((
+            _encode_varint(record.id),
+            _FLOAT64.pack(record.timestamp),
+            _encode_str(record.author),
+            _encode_str(record.message),
+        ))
+
+    def new_message_frame(self, encoded_record: Payload, room: str) -> bytes:
+        return bytes((NEW_MESSAGE, )) + _encode_str(room) + encoded_record
+
+    def new_messages_frame(self, encoded_records: Sequence[Payload], room: str) -> bytes:
+        return self._records_frame(NEW_MESSAGES, encoded_records, room)
+
+    def history_frame(self, encoded_records: Sequence[Payload], room: str) -> bytes:
+        return self._records_frame(NEW_MESSAGE_HISTORY, encoded_records, room)
+
+    @staticmethod
+    def _records_frame(frame_type: int, encoded_records: Sequence[Payload], room: str) -> bytes:
+        return b''.join((
+            bytes((frame_type, )),
+            _encode_str(room),
+            _encode_varint(len(encoded_records)),
+            b''.join(encoded_records),
+        ))
+
+    def decode(self, data: Payload) -> InboundFrame:
+        if not isinstance(data, bytes) or not data:
+            raise FrameDecodeError('Expected a binary frame')
+        try:
+            return self._decode(data)
+        except (struct.error, UnicodeDecodeError, IndexError) as e:
+            raise FrameDecodeError(str(e)) from e
+
+    @staticmethod
+    def _decode(data: bytes) -> InboundFrame:
+        frame_type = data[0]
+        offset = 1
+        if frame_type in _CLIENT_STRING_FRAMES:
+            return InboundFrame(**{_CLIENT_STRING_FRAMES[frame_type]: _decode_str(data, offset)[0]})
+        if frame_type == CLIENT_SEND_CHAT_MESSAGE:
+            author, offset = _decode_str(data, offset)
+            message, offset = _decode_str(data, offset)
+            room = _decode_str(data, offset)[0] if offset < len(data) else None
+            return InboundFrame(sendChatMessage=SendChatMessage(author=author, message=message, room=room))
+        if frame_type == CLIENT_REQUEST_HISTORY:
+            flags = data[offset]
+            offset += 1
+            request = RequestHistory()
+            if flags & REQUEST_HISTORY_SINCE:
+                (request.since, ) = _FLOAT64.unpack_from(data, offset)
+                offset += _FLOAT64.size
+            if flags & REQUEST_HISTORY_BEFORE_ID:
+                request.beforeId, offset = _decode_varint(data, offset)
+            if flags & REQUEST_HISTORY_LIMIT:
+                request.limit, offset = _decode_varint(data, offset)
+            if flags & REQUEST_HISTORY_ROOM:
+                request.room, offset = _decode_str(data, offset)
+            return InboundFrame(requestHistory=request)
+        if frame_type == CLIENT_PONG:
+            return InboundFrame(pong=_FLOAT64.unpack_from(data, offset)[0])
+        raise FrameDecodeError(f'Unknown frame type: {frame_type}')
+
+
+def decode_records(data: bytes, offset: int, count: int) -> Tuple[List[HistoryRecord], int]:
+    """ Reads 'count' records starting at 'offset', used by clients and tests """
+    records = []
+    for _ in range(count):
+        id_, offset = _decode_varint(data, offset)
+        (timestamp, ) = _FLOAT64.unpack_from(data, offset)
+        offset += _FLOAT64.size
+        author, offset = _decode_str(data, offset)
+        message, offset = _decode_str(data, offset)
+        records.append(HistoryRecord(id_, timestamp, author, message))
+    return records, offset
+
+
+def encode_client_frame(frame: InboundFrame) -> bytes:
+    """ The client side of the format, used by clients written in python and tests """
+    for frame_type, frame_name in _CLIENT_STRING_FRAMES.items():
+        value = getattr(frame, frame_name)
+        if value is not None:
+            return bytes((frame_type, )) + _encode_str(value)
+    if frame.sendChatMessage is not None:
+        return b''.join((
+            bytes((CLIENT_SEND_CHAT_MESSAGE, )),
+            _encode_str(frame.sendChatMessage.author),
+            _encode_str(frame.sendChatMessage.message),
+            b'' if frame.sendChatMessage.room is None else _encode_str(frame.sendChatMessage.room),
+        ))
+    if frame.requestHistory is not None:
+        request = frame.requestHistory
+        flags = 0
+        body = b''
+        if request.since is not None:
+            flags |= REQUEST_HISTORY_SINCE
+            body += _FLOAT64.pack(request.since)
+        if request.beforeId is not None:
+            flags |= REQUEST_HISTORY_BEFORE_ID
+            body += _encode_varint(request.beforeId)
+        if request.limit is not None:
+            flags |= REQUEST_HISTORY_LIMIT
+            body += _encode_varint(request.limit)
+        if request.room is not None:
+            flags |= REQUEST_HISTORY_ROOM
+            body += _encode_str(request.room)
+        return bytes((CLIENT_REQUEST_HISTORY, flags)) + body
+    if frame.pong is not None:
+        return bytes((CLIENT_PONG, )) + _FLOAT64.pack(frame.pong)
+    raise ValueError('Empty frame')
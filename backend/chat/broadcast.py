@@ -0,0 +1,190 @@
+import asyncio
+import enum
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+from fastapi import WebSocket
+from loguru import logger
+
+
+class SlowConsumerPolicy(enum.Enum):
+    # Throw away the oldest queued frame to make room for the new one
+    DROP_OLDEST = 'drop_oldest'
+    # Close the connection of a client that can not keep up
+    DISCONNECT = 'disconnect'
+
+
+# Websocket close code 1008: policy violation
+SLOW_CONSUMER_CLOSE_CODE = 1008
+
+# str is sent as text frame, bytes as binary frame
+Payload = Union[str, bytes]
+
+
+class ConnectionSender:
+    """
+    Owns the bounded send queue of a single websocket.
+    Frames are put into the queue without awaiting, a background task drains the queue into the socket.
+    """
+    def __init__(
+        self,
+        websocket: WebSocket,
+        max_queue_size: int,
+        policy: SlowConsumerPolicy,
+        on_close: Callable[[WebSocket], Awaitable[None]],
+        protocol: str = '',
+    ):
+        self.websocket = websocket
+        self.policy = policy
+        # The negotiated websocket subprotocol, decides which encoding of a broadcast this connection receives
+        self.protocol = protocol
+        self.queue: 'asyncio.Queue[Payload]' = asyncio.Queue(maxsize=max_queue_size)
+        self.dropped_frames: int = 0
+        self.sent_frames: int = 0
+        self.closed: bool = False
+        self._overflowed: bool = False
+        self._on_close = on_close
+        self.task: asyncio.Task = asyncio.create_task(self._run())
+
+    def enqueue(self, payload: Payload) -> bool:
+        """ Returns False if the frame could not be queued """
+        if self.closed or self._overflowed:
+            return False
+        if self.queue.full():
+            if self.policy == SlowConsumerPolicy.DISCONNECT:
+                self._overflowed = True
+                # Wake up the sender task so it closes the connection
+                self.queue.get_nowait()
+                self.queue.put_nowait('')
+                return False
+            self.queue.get_nowait()
+            self.dropped_frames += 1
+        self.queue.put_nowait(payload)
+        return True
+
+    async def _run(self):
+        while 1:
+            payload = await self.queue.get()
+            try:
+                if self._overflowed:
+                    logger.info('Closing connection of slow consumer')
+                    await self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+                    break
+                if isinstance(payload, bytes):
+                    await self.websocket.send_bytes(payload)
+                else:
+                    await self.websocket.send_text(payload)
+                self.sent_frames += 1
+            except RuntimeError:
+                # Socket was already closed
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=W0703
+                # E.g. the connection was reset, the connection still has to be cleaned up
+                logger.exception('Sending to websocket failed, closing the connection')
+                break
+        self.closed = True
+        await self._on_close(self.websocket)
+
+    def close(self):
+        self.closed = True
+        # The sender task may be the one calling close() through 'on_close'
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+
+
+class BroadcastEngine:
+    """
+    Fan-out of pre-serialized frames to many websockets.
+    The payload is serialized once by the caller, every connection then sends it concurrently from its own task,
+    so one slow client does not delay delivery to the others.
+    """
+    def __init__(
+        self,
+        max_queue_size: int = 256,
+        policy: SlowConsumerPolicy = SlowConsumerPolicy.DROP_OLDEST,
+        on_close: Optional[Callable[[WebSocket], Awaitable[None]]] = None,
+    ):
+        self.max_queue_size = max_queue_size
+        self.policy = policy
+        # Starlette websockets are not hashable, so connections are keyed by id(websocket)
+        self.senders: Dict[int, ConnectionSender] = {}
+        # Frames sent by connections that were already removed
+        self._removed_sent_frames: int = 0
+        self._on_close = on_close
+
+    def add(self, websocket: WebSocket, protocol: str = '') -> ConnectionSender:
+        sender = ConnectionSender(websocket, self.max_queue_size, self.policy, self._sender_closed, protocol)
+        self.senders[id(websocket)] = sender
+        return sender
+
+    def remove(self, websocket: WebSocket):
+        sender = self.senders.pop(id(websocket), None)
+        if sender is not None:
+            self._removed_sent_frames += sender.sent_frames
+            sender.close()
+
+    def close(self):
+        """ Stops all sender tasks, e.g. on shutdown """
+        for sender in list(self.senders.values()):
+            self.remove(sender.websocket)
+
+    async def _sender_closed(self, websocket: WebSocket):
+        self.remove(websocket)
+        if self._on_close is not None:
+            await self._on_close(websocket)
+
+    def __contains__(self, websocket: WebSocket) -> bool:
+        return id(websocket) in self.senders
+
+    def __len__(self) -> int:
+        return len(self.senders)
+
+    def protocol_of(self, websocket: WebSocket) -> Optional[str]:
+        sender = self.senders.get(id(websocket))
+        return None if sender is None else sender.protocol
+
+    def send(self, payload: Payload, websocket: WebSocket) -> bool:
+        sender = self.senders.get(id(websocket))
+        if sender is None:
+            return False
+        return sender.enqueue(payload)
+
+    def _senders_of(self, websockets: Optional[Iterable[WebSocket]]) -> List[ConnectionSender]:
+        if websockets is None:
+            return list(self.senders.values())
+        senders = []
+        for websocket in websockets:
+            sender = self.senders.get(id(websocket))
+            if sender is not None:
+                senders.append(sender)
+        return senders
+
+    def broadcast(self, payload: Payload, websockets: Optional[Iterable[WebSocket]] = None) -> int:
+        """ Queues the payload for all (or the given) websockets, returns the amount of connections it was queued for """
+        queued = 0
+        for sender in self._senders_of(websockets):
+            if sender.enqueue(payload):
+                queued += 1
+        return queued
+
+    def broadcast_by_protocol(
+        self,
+        payloads: Dict[str, Payload],
+        websockets: Optional[Iterable[WebSocket]] = None,
+    ) -> int:
+        """ Like broadcast(), but every connection receives the payload that was encoded for its subprotocol """
+        queued = 0
+        for sender in self._senders_of(websockets):
+            if sender.enqueue(payloads[sender.protocol]):
+                queued += 1
+        return queued
+
+    @property
+    def dropped_frames(self) -> int:
+        return sum(sender.dropped_frames for sender in self.senders.values())
+
+    @property
+    def sent_frames(self) -> int:
+        """ Frames sent to all connections since the engine was created """
+        return self._removed_sent_frames + sum(sender.sent_frames for sender in self.senders.values())
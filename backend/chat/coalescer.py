@@ -0,0 +1,80 @@
+"""
+Batches the new messages of a busy room into one 'newMessages' frame per subprotocol,
+so every member receives one frame per window instead of one frame per message.
+"""
+import asyncio
+from typing import Callable, Dict, List, Optional
+
+from backend.chat.codec import ChatCodec, Payload
+
+
+def parse_room_windows(value: str) -> Dict[str, float]:
+    """ 'general=0.02,dev=0' -> {'general': 0.02, 'dev': 0.0} """
+    windows = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        room, _, window = item.partition('=')
+        windows[room.strip()] = float(window)
+    return windows
+
+
+class MessageCoalescer:
+    def __init__(
+        self,
+        room: str,
+        codecs: Dict[str, ChatCodec],
+        send: Callable[[Dict[str, Payload]], None],
+        window: float = 0.02,
+        max_messages: int = 100,
+    ):
+        self.room = room
+        self.codecs = codecs
+        # Receives the frame of the batch for each subprotocol
+        self.send = send
+        # Seconds to wait for more messages after the first message of a batch arrived
+        self.window = window
+        self.max_messages = max_messages
+        # Encoded records of the current batch, per subprotocol
+        self._pending: Dict[str, List[Payload]] = {protocol: [] for protocol in codecs}
+        self._size: int = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, encoded_records: Dict[str, Payload]):
+        """ Adds a message, encoded for each subprotocol """
+        for protocol, encoded_record in encoded_records.items():
+            self._pending[protocol].append(encoded_record)
+        self._size += 1
+        if self._size >= self.max_messages:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._size:
+            return
+        batch = self._pending
+        self._pending = {protocol: [] for protocol in self.codecs}
+        self._size = 0
+        payloads: Dict[str, Payload] = {}
+        for protocol, encoded_records in batch.items():
+            codec = self.codecs[protocol]
+            if len(encoded_records) == 1:
+                payloads[protocol] = codec.new_message_frame(encoded_records[0], self.room)
+            else:
+                payloads[protocol] = codec.new_messages_frame(encoded_records, self.room)
+        self.send(payloads)
+
+    def close(self):
+        """ Drops the pending messages, they are already stored in the room history """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._pending = {protocol: [] for protocol in self.codecs}
+        self._size = 0
@@ -0,0 +1,144 @@
+"""
+Serialization of /chatws frames.
+The fastest available library is used: msgspec, then orjson, then the stdlib json module.
+msgspec and orjson are only imported when their codec is created.
+"""
+import dataclasses
+import importlib.util
+import json
+from typing import Any, Dict, List, Optional, Sequence, Type, Union
+
+from backend.chat.history import HistoryRecord
+from backend.chat.protocol import FrameDecodeError, InboundFrame
+
+# An encoded frame, str is sent as text frame and bytes as binary frame
+Payload = Union[str, bytes]
+
+
+class ChatCodec:
+    name = ''
+
+    def encode(self, obj: Any) -> Payload:
+        """ Encodes an outbound frame of the form {"<frame name>": <payload>} """
+        raise NotImplementedError()
+
+    def decode(self, data: Payload) -> InboundFrame:
+        raise NotImplementedError()
+
+    def encode_record(self, record: HistoryRecord) -> Payload:
+        """ Encodes a single message so it can be reused in 'newMessage' and 'newMessageHistory' frames """
+        raise NotImplementedError()
+
+    def new_message_frame(self, encoded_record: Payload, room: str) -> Payload:
+        raise NotImplementedError()
+
+    def new_messages_frame(self, encoded_records: Sequence[Payload], room: str) -> Payload:
+        """ Several new messages in one frame, sent by rooms that coalesce their messages """
+        raise NotImplementedError()
+
+    def history_frame(self, encoded_records: Sequence[Payload], room: str) -> Payload:
+        raise NotImplementedError()
+
+
+class JsonChatCodec(ChatCodec):
+    """ Frames are sent as JSON text frames """
+    # Module the codec needs, None if it only uses the standard library
+    requires: Optional[str] = None
+
+    def encode(self, obj: Any) -> str:
+        raise NotImplementedError()
+
+    def encode_record(self, record: HistoryRecord) -> str:
+        return self.encode(record)
+
+    def new_message_frame(self, encoded_record: Payload, room: str) -> str:
+        return f'{{"newMessage":{encoded_record},"room":{self.encode(room)}}}'
+
+    def new_messages_frame(self, encoded_records: Sequence[Payload], room: str) -> str:
+        return f'{{"newMessages":[{",".join(encoded_records)}],"room":{self.encode(room)}}}'
+
+    def history_frame(self, encoded_records: Sequence[Payload], room: str) -> str:
+        return f'{{"newMessageHistory":[{",".join(encoded_records)}],"room":{self.encode(room)}}}'
+
+
+def _dataclass_to_dict(obj: Any) -> Dict[str, Any]:
+    # Faster than dataclasses.asdict() which deep-copies, nested dataclasses are handled by json.dumps recursively
+    if dataclasses.is_dataclass(obj):
+        return {field.name: getattr(obj, field.name) for field in dataclasses.fields(obj)}
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+class StdlibCodec(JsonChatCodec):
+    name = 'json'
+
+    def encode(self, obj: Any) -> str:
+        return json.dumps(obj, default=_dataclass_to_dict, separators=(',', ':'))
+
+    def decode(self, data: Payload) -> InboundFrame:
+        try:
+            return InboundFrame.from_dict(json.loads(data))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise FrameDecodeError(str(e)) from e
+
+
+class OrjsonCodec(JsonChatCodec):
+    name = 'orjson'
+    requires = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.dumps = orjson.dumps
+        self.loads = orjson.loads
+
+    def encode(self, obj: Any) -> str:
+        # orjson serializes dataclasses natively
+        return self.dumps(obj).decode()
+
+    def decode(self, data: Payload) -> InboundFrame:
+        try:
+            return InboundFrame.from_dict(self.loads(data))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise FrameDecodeError(str(e)) from e
+
+
+class MsgspecCodec(JsonChatCodec):
+    name = 'msgspec'
+    requires = 'msgspec'
+
+    def __init__(self):
+        import msgspec
+        self.decode_error = msgspec.DecodeError
+        self.encoder = msgspec.json.Encoder()
+        # Decodes and validates frames straight into the typed dataclasses, without an intermediate dict
+        self.decoder = msgspec.json.Decoder(InboundFrame)
+
+    def encode(self, obj: Any) -> str:
+        return self.encoder.encode(obj).decode()
+
+    def decode(self, data: Payload) -> InboundFrame:
+        try:
+            return self.decoder.decode(data)
+        except self.decode_error as e:
+            raise FrameDecodeError(str(e)) from e
+
+
+def _installed_codec_types() -> List[Type[JsonChatCodec]]:
+    """ Fastest first, checks whether the libraries are installed without importing them """
+    return [
+        codec_type for codec_type in (MsgspecCodec, OrjsonCodec, StdlibCodec)
+        if codec_type.requires is None or importlib.util.find_spec(codec_type.requires) is not None
+    ]
+
+
+def available_codecs() -> Dict[str, JsonChatCodec]:
+    return {codec_type.name: codec_type() for codec_type in _installed_codec_types()}
+
+
+def get_codec(name: str = 'auto') -> JsonChatCodec:
+    """ Returns the codec with the given name, or the fastest installed codec for 'auto' """
+    codec_types = {codec_type.name: codec_type for codec_type in _installed_codec_types()}
+    if name == 'auto':
+        return next(iter(codec_types.values()))()
+    if name not in codec_types:
+        raise ValueError(f'Chat codec {name!r} is not available, choose one of: {list(codec_types)}')
+    return codec_types[name]()
@@ -0,0 +1,185 @@
+import sys
+from array import array
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+
+@dataclass
+class HistoryRecord:
+    """ Compact storage of a single chat message """
+    __slots__ = ('id', 'timestamp', 'author', 'message')
+    id: int
+    timestamp: float
+    author: str
+    message: str
+
+    def to_dict(self) -> Dict[str, Union[int, float, str]]:
+        return {
+            'id': self.id,
+            'timestamp': self.timestamp,
+            'author': self.author,
+            'message': self.message,
+        }
+
+
+class ChatHistory:
+    """
+    Ring buffer of the most recent chat messages.
+    Message ids are consecutive, so a message is found by id in O(1).
+    Timestamps are kept in a separate array which is sorted, so 'messages since T' is a binary search.
+    The buffer starts small and doubles until it reaches 'max_size', so quiet rooms stay cheap.
+    """
+    initial_capacity = 64
+
+    def __init__(self, max_size: int = 10_000):
+        assert max_size > 0
+        self.max_size = max_size
+        self._allocate(min(self.initial_capacity, max_size))
+        self._size: int = 0
+        self._next_id: int = 1
+
+    def _allocate(self, capacity: int):
+        self._capacity = capacity
+        self._records: List[Optional[HistoryRecord]] = [None] * capacity
+        self._timestamps = array('d', bytes(8 * capacity))
+        # Physical index of the oldest message
+        self._start: int = 0
+
+    def _grow(self):
+        records, timestamps = list(self), [self._timestamps[self._physical(i)] for i in range(self._size)]
+        self._allocate(min(self._capacity * 2, self.max_size))
+        self._records[:self._size] = records
+        self._timestamps[:self._size] = array('d', timestamps)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[HistoryRecord]:
+        for i in range(self._size):
+            yield self._record_at(i)
+
+    def _physical(self, index: int) -> int:
+        return (self._start + index) % self._capacity
+
+    def _record_at(self, index: int) -> HistoryRecord:
+        record = self._records[self._physical(index)]
+        assert record is not None
+        return record
+
+    @property
+    def next_id(self) -> int:
+        """ Id the next appended message will get """
+        return self._next_id
+
+    @property
+    def first_id(self) -> int:
+        """ Id of the oldest message that is still stored """
+        return self._next_id - self._size
+
+    @property
+    def last_timestamp(self) -> float:
+        if self._size == 0:
+            return 0
+        return self._timestamps[self._physical(self._size - 1)]
+
+    def clear(self, next_id: Optional[int] = None):
+        self._allocate(min(self.initial_capacity, self.max_size))
+        self._size = 0
+        if next_id is not None:
+            self._next_id = next_id
+
+    def append(self, timestamp: float, author: str, message: str, message_id: Optional[int] = None) -> HistoryRecord:
+        """ Ids are assigned consecutively, unless an id is given for the first message (e.g. assigned by a backplane) """
+        if message_id is not None and message_id != self._next_id:
+            if self._size:
+                raise ValueError(f'Expected message id {self._next_id}, got {message_id}')
+            self._next_id = message_id
+        # Keep the timestamp index sorted even if the system clock jumps backwards
+        timestamp = max(timestamp, self.last_timestamp)
+        # Authors repeat a lot, only keep one copy of each name
+        record = HistoryRecord(self._next_id, timestamp, sys.intern(author), message)
+        self._next_id += 1
+        if self._size == self._capacity < self.max_size:
+            self._grow()
+        if self._size == self.max_size:
+            # Overwrite the oldest message
+            self._start = self._physical(1)
+            self._size -= 1
+        position = self._physical(self._size)
+        self._records[position] = record
+        self._timestamps[position] = timestamp
+        self._size += 1
+        return record
+
+    def get(self, message_id: int) -> Optional[HistoryRecord]:
+        index = message_id - self.first_id
+        if 0 <= index < self._size:
+            return self._record_at(index)
+        return None
+
+    def _slice(self, start: int, end: int) -> List[HistoryRecord]:
+        return [self._record_at(i) for i in range(max(start, 0), min(end, self._size))]
+
+    def last(self, limit: int) -> List[HistoryRecord]:
+        """ The newest 'limit' messages, oldest first """
+        return self._slice(self._size - limit, self._size)
+
+    def since(self, timestamp: float, limit: int) -> Tuple[List[HistoryRecord], bool]:
+        """ Up to 'limit' messages newer than 'timestamp', oldest first, and whether more messages are available """
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            if self._timestamps[self._physical(middle)] <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return self._slice(low, low + limit), low + limit < self._size
+
+    def before(self, message_id: int, limit: int) -> Tuple[List[HistoryRecord], bool]:
+        """ Up to 'limit' messages older than 'message_id', oldest first, and whether even older messages are available """
+        end = min(message_id - self.first_id, self._size)
+        start = end - limit
+        return self._slice(start, end), start > 0
+
+
+class HistorySnapshot:
+    """
+    Pre-encoded history payload that is sent to joining users.
+    Every message is encoded once when it is appended, the payload is then only rebuilt from the encoded fragments
+    after the history changed, so a burst of joins (e.g. reconnects after a deploy) reuses the same cached payload.
+    """
+    def __init__(
+        self,
+        max_size: int,
+        encode_record: Callable[[HistoryRecord], Union[str, bytes]],
+        build_payload: Callable[[Sequence[Union[str, bytes]]], Union[str, bytes]],
+    ):
+        self.encode_record = encode_record
+        self.build_payload = build_payload
+        self._fragments: Deque[Union[str, bytes]] = deque(maxlen=max_size)
+        self._payload: Optional[Union[str, bytes]] = None
+
+    def __len__(self) -> int:
+        return len(self._fragments)
+
+    def append(self, record: HistoryRecord) -> Union[str, bytes]:
+        """ Encodes the record, returns the encoded fragment so it can be reused for the broadcast """
+        fragment = self.encode_record(record)
+        self._fragments.append(fragment)
+        self._payload = None
+        return fragment
+
+    def extend(self, records: Iterable[HistoryRecord]):
+        for record in records:
+            self.append(record)
+
+    def clear(self):
+        self._fragments.clear()
+        self._payload = None
+
+    @property
+    def payload(self) -> Union[str, bytes]:
+        if self._payload is None:
+            self._payload = self.build_payload(self._fragments)
+        return self._payload
@@ -0,0 +1,64 @@
+"""
+Detection of dead /chatws connections.
+Half-open TCP connections never raise on receive and may not raise on send for a long time, so connections that did
+not send a frame for a while get a 'ping' frame, and are reaped if they do not answer with any frame in time.
+"""
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+# Websocket close code 1001: going away
+IDLE_CLOSE_CODE = 1001
+
+
+class ConnectionLiveness:
+    """
+    Time of the last received frame of every connection, keyed by id(websocket).
+    Connections are kept in order of their last activity, so finding the idle ones only looks at those.
+    """
+    def __init__(self, idle_timeout: float, pong_timeout: float):
+        self.idle_timeout = idle_timeout
+        self.pong_timeout = pong_timeout
+        # Oldest activity first
+        self.last_seen: 'OrderedDict[int, float]' = OrderedDict()
+        # Connections that were pinged and did not answer yet
+        self.pinged_at: Dict[int, float] = {}
+        self.pings_sent: int = 0
+        self.reaped: int = 0
+
+    def __len__(self) -> int:
+        return len(self.last_seen)
+
+    def add(self, connection_id: int, now: float):
+        self.last_seen[connection_id] = now
+
+    def remove(self, connection_id: int):
+        self.last_seen.pop(connection_id, None)
+        self.pinged_at.pop(connection_id, None)
+
+    def seen(self, connection_id: int, now: float):
+        """ Any frame from the client counts as answer to a ping """
+        if connection_id not in self.last_seen:
+            return
+        self.last_seen[connection_id] = now
+        self.last_seen.move_to_end(connection_id)
+        self.pinged_at.pop(connection_id, None)
+
+    def due(self, now: float) -> Tuple[List[int], List[int]]:
+        """ Returns the connections to ping and the connections to reap, both are marked accordingly """
+        to_ping: List[int] = []
+        to_reap: List[int] = []
+        for connection_id, last_seen in self.last_seen.items():
+            if now - last_seen < self.idle_timeout:
+                break
+            pinged_at = self.pinged_at.get(connection_id)
+            if pinged_at is None:
+                to_ping.append(connection_id)
+            elif now - pinged_at >= self.pong_timeout:
+                to_reap.append(connection_id)
+        for connection_id in to_ping:
+            self.pinged_at[connection_id] = now
+        for connection_id in to_reap:
+            self.remove(connection_id)
+        self.pings_sent += len(to_ping)
+        self.reaped += len(to_reap)
+        return to_ping, to_reap
@@ -0,0 +1,338 @@
+"""
+Durable chat history: an append-only log split into segment files.
+
+Messages are collected on the event loop and written, then fsynced, by a single writer thread once per flush
+interval, so at most one interval of messages is lost on a crash.
+Every record carries its length after the body as well, so on startup the newest segments are memory-mapped and read
+backwards until the history of the default room is full, the older part of the log is never read.
+A segment with a corrupt part, e.g. a damaged disk block, is read backwards up to it and forwards from its start.
+Closed segments are compacted into one when there are too many: only the messages that still belong to the newest
+'history_size' messages of their room (and are younger than the retention) are kept.
+
+Record layout, little endian:
+    <body length: u32> <crc32 of body: u32> <body> <body length: u32>
+    body: <id: i64> <timestamp: f64> <room length: u16> <author length: u16> <message length: u32> <utf-8 strings>
+"""
+import asyncio
+import mmap
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+from backend.chat.history import HistoryRecord
+from backend.chat.protocol import DEFAULT_ROOM
+
+_HEADER = struct.Struct('<II')
+_BODY = struct.Struct('<qdHHI')
+_TRAILER = struct.Struct('<I')
+_OVERHEAD = _HEADER.size + _TRAILER.size
+SEGMENT_SUFFIX = '.seg'
+
+# (room, record)
+LogEntry = Tuple[str, HistoryRecord]
+
+
+class CorruptSegmentError(ValueError):
+    """ The segment does not end with a complete record, e.g. after a crash during a write """
+
+
+def encode_entry(room: str, record: HistoryRecord) -> bytes:
+    room_bytes, author_bytes, message_bytes = room.encode(), record.author.encode(), record.message.encode()
+    body = b''.join((
+        _BODY.pack(record.id, record.timestamp, len(room_bytes), len(author_bytes), len(message_bytes)),
+        room_bytes,
+        author_bytes,
+        message_bytes,
+    ))
+    return _HEADER.pack(len(body), zlib.crc32(body)) + body + _TRAILER.pack(len(body))
+
+
+def _decode_body(buffer, start: int) -> LogEntry:
+    message_id, timestamp, room_length, author_length, message_length = _BODY.unpack_from(buffer, start)
+    position = start + _BODY.size
+    room = bytes(buffer[position:position + room_length]).decode()
+    position += room_length
+    author = bytes(buffer[position:position + author_length]).decode()
+    position += author_length
+    message = bytes(buffer[position:position + message_length]).decode()
+    return room, HistoryRecord(message_id, timestamp, author, message)
+
+
+def _room_of(buffer, start: int) -> bytes:
+    room_length = _BODY.unpack_from(buffer, start)[2]
+    return bytes(buffer[start + _BODY.size:start + _BODY.size + room_length])
+
+
+def _record_ends_at(buffer, end: int) -> int:
+    """ Start of the body of the record that ends at 'end', raises CorruptSegmentError if there is none """
+    if end < _OVERHEAD + _BODY.size:
+        raise CorruptSegmentError(f'Incomplete record before offset {end}')
+    (length, ) = _TRAILER.unpack_from(buffer, end - _TRAILER.size)
+    start = end - _TRAILER.size - length
+    header_start = start - _HEADER.size
+    if header_start < 0 or _HEADER.unpack_from(buffer, header_start)[0] != length:
+        raise CorruptSegmentError(f'Invalid record before offset {end}')
+    return start
+
+
+def iterate_backwards(buffer) -> Iterator[int]:
+    """ Yields the body start of every record, newest first """
+    end = len(buffer)
+    while end > 0:
+        start = _record_ends_at(buffer, end)
+        yield start
+        end = start - _HEADER.size
+
+
+def iterate_backwards_salvaging(buffer, name: str) -> Iterator[int]:
+    """ Like iterate_backwards(), but continues with the valid records before a corrupt part of the segment """
+    end = len(buffer)
+    while end > 0:
+        try:
+            start = _record_ends_at(buffer, end)
+        except CorruptSegmentError:
+            logger.warning(f'Chat log segment {name} is corrupt before offset {end}, reading the rest forwards')
+            # The records before the corrupt part can still be found from the start of the segment
+            yield from reversed([start for start, _ in _valid_records(buffer[:end])])
+            return
+        yield start
+        end = start - _HEADER.size
+
+
+def _valid_records(buffer) -> Iterator[Tuple[int, int]]:
+    """ Yields (body start, record end) of every complete record with a valid checksum, oldest first """
+    position = 0
+    while position + _OVERHEAD <= len(buffer):
+        length, checksum = _HEADER.unpack_from(buffer, position)
+        start = position + _HEADER.size
+        end = start + length + _TRAILER.size
+        if end > len(buffer) or zlib.crc32(buffer[start:start + length]) != checksum:
+            return
+        yield start, end
+        position = end
+
+
+def valid_length(buffer) -> int:
+    """ Length of the part of a segment that consists of complete records """
+    end = 0
+    for _, end in _valid_records(buffer):
+        pass
+    return end
+
+
+def _log_write_error(count: int, future: 'asyncio.Future[None]'):
+    if not future.cancelled() and future.exception() is not None:
+        logger.opt(exception=future.exception()).error(f'Writing {count} chat messages to the log failed')
+
+
+class _MappedSegment:
+    """ Read-only memory map of a segment, empty segments can not be mapped """
+    def __init__(self, path: Path):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.buffer = memoryview(self.map) if self.map is not None else memoryview(b'')
+
+    def __enter__(self) -> memoryview:
+        return self.buffer
+
+    def __exit__(self, *args):
+        self.buffer.release()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class MessageLog:
+    def __init__(
+        self,
+        folder: Path,
+        history_size: int,
+        flush_interval: float = 0.1,
+        segment_size: int = 16 * 2**20,
+        compact_segments: int = 8,
+        retention: float = 0,
+    ):
+        self.folder = folder
+        # Newest messages per room that are restored on startup and kept on compaction
+        self.history_size = history_size
+        self.flush_interval = flush_interval
+        self.segment_size = segment_size
+        # Closed segments are compacted when there are more than this
+        self.compact_segments = compact_segments
+        # Seconds after which messages are dropped on compaction, 0 keeps them
+        self.retention = retention
+        # Oldest first, the last one is written to
+        self.segments: List[Path] = []
+        self._file: Optional[BinaryIO] = None
+        # Encoded records that were not handed to the writer thread yet
+        self._pending: List[bytes] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._last_write: Optional['asyncio.Future[None]'] = None
+        # One thread, so batches are written in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-log')
+
+    async def open(self) -> Dict[str, List[HistoryRecord]]:
+        """ Opens the log for writing, returns the newest messages of every room found in the recent segments """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._open)
+
+    def append(self, room: str, record: HistoryRecord):
+        self._pending.append(encode_entry(room, record))
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        if not self._pending:
+            return
+        count = len(self._pending)
+        data = b''.join(self._pending)
+        self._pending = []
+        self._last_write = asyncio.get_running_loop().run_in_executor(self._executor, self._write, data)
+        # Nobody awaits the write unless flush() is called, so failures are logged here
+        self._last_write.add_done_callback(partial(_log_write_error, count))
+
+    async def flush(self):
+        """ Writes and fsyncs everything appended so far """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._start_flush()
+        if self._last_write is not None:
+            await self._last_write
+
+    async def compact_in_background(self):
+        """ Compacts the closed segments in the writer thread, so it does not interfere with writes """
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.compact)
+
+    async def close(self):
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close_file)
+        self._executor.shutdown()
+
+    # Everything below runs in the writer thread
+
+    def _segment_path(self, index: int) -> Path:
+        return self.folder / f'{index:010d}{SEGMENT_SUFFIX}'
+
+    def _open(self) -> Dict[str, List[HistoryRecord]]:
+        start = time.perf_counter()
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.segments = sorted(self.folder.glob(f'*{SEGMENT_SUFFIX}'))
+        if self.segments:
+            self._repair(self.segments[-1])
+        else:
+            self.segments.append(self._segment_path(0))
+        self._file = open(self.segments[-1], 'ab')
+        recovered = self._recover()
+        count = sum(len(records) for records in recovered.values())
+        logger.info(f'Restored {count} chat messages in {(time.perf_counter() - start) * 1000:.1f} ms')
+        return recovered
+
+    def _repair(self, path: Path):
+        """ Cuts off an incomplete record at the end of the newest segment, left by a crash during a write """
+        with _MappedSegment(path) as buffer:
+            try:
+                if len(buffer):
+                    _record_ends_at(buffer, len(buffer))
+                return
+            except CorruptSegmentError:
+                length = valid_length(buffer)
+        logger.warning(f'Truncating incomplete chat log segment {path.name} to {length} bytes')
+        with open(path, 'r+b') as file:
+            file.truncate(length)
+            os.fsync(file.fileno())
+
+    def _recover(self) -> Dict[str, List[HistoryRecord]]:
+        """ Reads the segments newest first until the default room has 'history_size' messages """
+        records: Dict[bytes, List[LogEntry]] = {}
+        default_room = DEFAULT_ROOM.encode()
+        default_records = records.setdefault(default_room, [])
+        for path in reversed(self.segments):
+            if len(default_records) >= self.history_size:
+                break
+            with _MappedSegment(path) as buffer:
+                for start in iterate_backwards_salvaging(buffer, path.name):
+                    room = _room_of(buffer, start)
+                    room_records = records.setdefault(room, [])
+                    if len(room_records) >= self.history_size:
+                        continue
+                    entry = _decode_body(buffer, start)
+                    # Segments that were already compacted may still exist after a crash during compaction
+                    if room_records and entry[1].id >= room_records[-1][1].id:
+                        continue
+                    room_records.append(entry)
+                    if len(default_records) >= self.history_size:
+                        break
+        if not default_records:
+            records.pop(default_room)
+        return {room.decode(): [record for _, record in reversed(entries)] for room, entries in records.items()}
+
+    def _write(self, data: bytes):
+        assert self._file is not None, 'MessageLog.open() was not awaited'
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self._file.tell() >= self.segment_size:
+            self._roll()
+
+    def _roll(self):
+        assert self._file is not None
+        self._file.close()
+        index = int(self.segments[-1].stem) + 1
+        self.segments.append(self._segment_path(index))
+        self._file = open(self.segments[-1], 'ab')
+        if len(self.segments) - 1 > self.compact_segments:
+            try:
+                self.compact()
+            except Exception:  # pylint: disable=W0703
+                # The batch is already written, a failed compaction only leaves more segments behind
+                logger.exception('Compacting the chat log failed')
+
+    def compact(self):
+        """ Rewrites all closed segments into one that only holds the messages that are still restored on startup """
+        closed, active = self.segments[:-1], self.segments[-1]
+        if not closed:
+            return
+        # Messages in the active segment count towards the history of their room
+        newer: Dict[bytes, int] = {}
+        with _MappedSegment(active) as buffer:
+            for start, _ in _valid_records(buffer):
+                room = _room_of(buffer, start)
+                newer[room] = newer.get(room, 0) + 1
+        cutoff = time.time() - self.retention if self.retention else None
+        kept: List[bytes] = []
+        for path in reversed(closed):
+            with _MappedSegment(path) as buffer:
+                for start in iterate_backwards_salvaging(buffer, path.name):
+                    room = _room_of(buffer, start)
+                    if newer.get(room, 0) >= self.history_size:
+                        continue
+                    if cutoff is not None and _BODY.unpack_from(buffer, start)[1] < cutoff:
+                        continue
+                    newer[room] = newer.get(room, 0) + 1
+                    length = _HEADER.unpack_from(buffer, start - _HEADER.size)[0]
+                    kept.append(bytes(buffer[start - _HEADER.size:start + length + _TRAILER.size]))
+        # The compacted segment replaces the newest closed segment, so it stays ordered before the active segment
+        target = closed[-1]
+        temporary = target.with_suffix('.tmp')
+        with open(temporary, 'wb') as file:
+            file.write(b''.join(reversed(kept)))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, target)
+        self.segments = [target, active]
+        for path in closed[:-1]:
+            path.unlink()
+        logger.info(f'Compacted {len(closed)} chat log segments, kept {len(kept)} messages')
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
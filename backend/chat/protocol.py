@@ -0,0 +1,105 @@
+"""
+Typed frames of the /chatws websocket protocol.
+Field names are camelCase because they are the keys used on the wire.
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
+
+from backend.chat.history import HistoryRecord
+
+# Websocket subprotocols a client may request on connect, clients without a subprotocol speak JSON
+JSON_SUBPROTOCOL = 'chat.json'
+BINARY_SUBPROTOCOL = 'chat.binary.v1'
+# Room every user joins after connecting with a username, frames without a room refer to it
+DEFAULT_ROOM = 'general'
+
+
+@dataclass
+class ChatMessage:
+    timestamp: float
+    author: str
+    message: str
+
+
+# Inbound frames
+
+
+class FrameDecodeError(ValueError):
+    """ The client sent a frame that is not valid JSON or does not match the protocol """
+
+
+def _field(data: Dict[str, Any], key: str, types: Union[Type, Tuple[Type, ...]], required: bool = False) -> Any:
+    """ The value of the key if it has one of the types, values of the wrong type would break the handlers later """
+    value = data.get(key)
+    if value is None:
+        if required:
+            raise FrameDecodeError(f'Missing field: {key}')
+        return None
+    # bool is a subclass of int, but true is not a valid number in a frame
+    if not isinstance(value, types) or isinstance(value, bool):
+        raise FrameDecodeError(f'Invalid type of field {key}: {type(value).__name__}')
+    return value
+
+
+@dataclass
+class SendChatMessage:
+    author: str
+    message: str
+    room: Optional[str] = None
+
+
+@dataclass
+class RequestHistory:
+    since: Optional[float] = None
+    beforeId: Optional[int] = None
+    limit: Optional[int] = None
+    room: Optional[str] = None
+
+
+@dataclass
+class InboundFrame:
+    """ A frame sent by the client, exactly one of the fields is expected to be set """
+    message: Optional[str] = None
+    tryToConnectUser: Optional[str] = None
+    sendChatMessage: Optional[SendChatMessage] = None
+    requestHistory: Optional[RequestHistory] = None
+    joinRoom: Optional[str] = None
+    leaveRoom: Optional[str] = None
+    # Answer to a 'ping' frame of the server, with the value of the ping
+    pong: Optional[float] = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'InboundFrame':
+        """ Used by codecs that can not decode into typed objects directly, checks the type of every field """
+        if not isinstance(data, dict):
+            raise FrameDecodeError('Expected a JSON object')
+        send_chat_message = _field(data, 'sendChatMessage', dict)
+        request_history = _field(data, 'requestHistory', dict)
+        return cls(
+            message=_field(data, 'message', str),
+            tryToConnectUser=_field(data, 'tryToConnectUser', str),
+            sendChatMessage=None if send_chat_message is None else SendChatMessage(
+                author=_field(send_chat_message, 'author', str, required=True),
+                message=_field(send_chat_message, 'message', str, required=True),
+                room=_field(send_chat_message, 'room', str),
+            ),
+            requestHistory=None if request_history is None else RequestHistory(
+                since=_field(request_history, 'since', (int, float)),
+                beforeId=_field(request_history, 'beforeId', int),
+                limit=_field(request_history, 'limit', int),
+                room=_field(request_history, 'room', str),
+            ),
+            joinRoom=_field(data, 'joinRoom', str),
+            leaveRoom=_field(data, 'leaveRoom', str),
+            pong=_field(data, 'pong', (int, float)),
+        )
+
+
+# Outbound frames are sent as {"<frame name>": <payload>}
+
+
+@dataclass
+class HistoryPage:
+    messages: List[HistoryRecord]
+    hasMore: bool
+    room: str = DEFAULT_ROOM
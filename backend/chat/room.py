@@ -0,0 +1,97 @@
+from functools import partial
+from typing import Dict, Iterable, List, Optional
+
+from fastapi import WebSocket
+
+from backend.chat.coalescer import MessageCoalescer
+from backend.chat.codec import ChatCodec, Payload
+from backend.chat.history import ChatHistory, HistoryRecord, HistorySnapshot
+from backend.chat.protocol import ChatMessage
+
+
+class ChatRoom:
+    """ A chat channel with its own members, history and history snapshots """
+    def __init__(
+        self,
+        name: str,
+        codecs: Dict[str, ChatCodec],
+        history_size: int,
+        history_page_size: int,
+    ):
+        self.name = name
+        self.codecs = codecs
+        # Keyed by id(websocket) because starlette websockets are not hashable
+        self.members: Dict[int, WebSocket] = {}
+        self.history = ChatHistory(max_size=history_size)
+        # The payload for joining users per subprotocol, kept up to date on every new message
+        self.history_snapshots: Dict[str, HistorySnapshot] = {
+            protocol: HistorySnapshot(
+                max_size=min(history_page_size, history_size),
+                encode_record=codec.encode_record,
+                build_payload=partial(codec.history_frame, room=name),
+            )
+            for protocol, codec in codecs.items()
+        }
+        # Set for rooms that batch their new messages, see WebsocketChatManager.set_coalescing()
+        self.coalescer: Optional[MessageCoalescer] = None
+
+    def __contains__(self, websocket: WebSocket) -> bool:
+        return id(websocket) in self.members
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    @property
+    def websockets(self) -> Iterable[WebSocket]:
+        return self.members.values()
+
+    def add(self, websocket: WebSocket):
+        self.members[id(websocket)] = websocket
+
+    def remove(self, websocket: WebSocket):
+        self.members.pop(id(websocket), None)
+
+    def append_message(self, message: ChatMessage, message_id: Optional[int] = None) -> Optional[Dict[str, Payload]]:
+        """
+        Stores the message, returns the 'newMessage' frame for each subprotocol.
+        Returns None for a message with an id that was already stored.
+        """
+        encoded_records = self.store_message(message, message_id)
+        if encoded_records is None:
+            return None
+        return {
+            protocol: self.codecs[protocol].new_message_frame(encoded_record, self.name)
+            for protocol, encoded_record in encoded_records.items()
+        }
+
+    def store_message(self, message: ChatMessage, message_id: Optional[int] = None) -> Optional[Dict[str, Payload]]:
+        """ Like append_message(), but returns the message encoded for each subprotocol instead of the frames """
+        if message_id is not None:
+            if message_id < self.history.next_id:
+                return None
+            if message_id > self.history.next_id:
+                # Messages were missed, only keep consecutive ids
+                self.clear(message_id)
+        record = self.history.append(message.timestamp, message.author, message.message, message_id)
+        return self.encode_record(record)
+
+    def clear(self, next_id: Optional[int] = None):
+        self.history.clear(next_id)
+        for snapshot in self.history_snapshots.values():
+            snapshot.clear()
+
+    def load_history(self, records: List[HistoryRecord]):
+        """ Replaces the history with the given records, newer messages that are already stored are kept """
+        if not records:
+            return
+        newer = [record for record in self.history if record.id > records[-1].id]
+        self.clear(records[0].id)
+        for record in records + newer:
+            self.store_message(ChatMessage(record.timestamp, record.author, record.message), record.id)
+
+    def encode_record(self, record: HistoryRecord) -> Dict[str, Payload]:
+        # Serialize once per subprotocol for all recipients and the history snapshot
+        return {protocol: snapshot.append(record) for protocol, snapshot in self.history_snapshots.items()}
+
+    def history_payload(self, protocol: str) -> Payload:
+        return self.history_snapshots[protocol].payload
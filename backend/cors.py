@@ -0,0 +1,72 @@
+"""
+CORS origin rules, e.g. CORS_ORIGINS='https://burnysc2.github.io,http://localhost:1-65535,https://*.example.com'
+    https://burnysc2.github.io      exact origin
+    http://localhost:1-65535        any explicit port in the inclusive range
+    https://*.example.com           any subdomain, not example.com itself
+    re:https://pr-\\d+\\.example\\.com  regular expression matching the whole origin
+Exact origins are a set lookup, port ranges a dict lookup, wildcards and regular expressions are combined into one regex.
+"""
+import re
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from starlette.middleware.cors import CORSMiddleware
+from starlette.types import ASGIApp
+
+_PORT_RANGE = re.compile(r'(?P<base>[a-z][a-z0-9+.-]*://[^/:]+):(?P<low>\d+)-(?P<high>\d+)')
+
+
+class CorsPolicy:
+    def __init__(self, rules: Sequence[str]):
+        self.exact: Set[str] = set()
+        # 'scheme://host' -> inclusive port ranges
+        self.port_ranges: Dict[str, List[Tuple[int, int]]] = {}
+        patterns: List[str] = []
+        for rule in rules:
+            rule = rule.strip().rstrip('/')
+            if not rule:
+                continue
+            if rule.startswith('re:'):
+                patterns.append(rule[3:])
+                continue
+            port_range = _PORT_RANGE.fullmatch(rule)
+            if port_range is not None:
+                low, high = int(port_range.group('low')), int(port_range.group('high'))
+                if not 0 < low <= high < 2**16:
+                    raise ValueError(f'Invalid port range in CORS rule: {rule}')
+                self.port_ranges.setdefault(port_range.group('base'), []).append((low, high))
+            elif '*' in rule:
+                # Only whole labels may be wildcards, '*' never matches a '.', ':' or '/'
+                patterns.append(re.escape(rule).replace(r'\*', r'[^./:]+'))
+            else:
+                self.exact.add(rule)
+        self.pattern: Optional['re.Pattern[str]'] = None
+        if patterns:
+            self.pattern = re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+
+    @classmethod
+    def from_config(cls, value: str) -> 'CorsPolicy':
+        """ Rules separated by commas """
+        return cls(value.split(','))
+
+    def is_allowed(self, origin: str) -> bool:
+        if origin in self.exact:
+            return True
+        if self.port_ranges:
+            base, _, port = origin.rpartition(':')
+            ranges = self.port_ranges.get(base)
+            if ranges is not None and port.isdigit() and port[0] != '0':
+                port_number = int(port)
+                for low, high in ranges:
+                    if low <= port_number <= high:
+                        return True
+        return self.pattern is not None and self.pattern.fullmatch(origin) is not None
+
+
+class CorsPolicyMiddleware(CORSMiddleware):
+    """ starlette's CORSMiddleware, but origins are checked by a CorsPolicy instead of a list """
+    def __init__(self, app: ASGIApp, policy: CorsPolicy, **kwargs):
+        super().__init__(app, **kwargs)
+        self.policy = policy
+
+    def is_allowed_origin(self, origin: str) -> bool:
+        return self.policy.is_allowed(origin)
@@ -0,0 +1,172 @@
+"""
+Latency statistics, memory sampling and the result files of the load test.
+Results are saved as JSON named after the time and the git commit, so runs of different commits can be compared.
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+ROOT_FOLDER = Path(__file__).parent.parent.parent
+RESULTS_FOLDER = ROOT_FOLDER / 'loadtest_results'
+
+# (flattened result key, whether a higher value is better) of the values shown when comparing two runs
+COMPARED_VALUES: List[Tuple[str, bool]] = [
+    ('chat.throughput_per_s', True),
+    ('chat.latency_ms.p50', False),
+    ('chat.latency_ms.p99', False),
+    ('chat.connect_ms.p99', False),
+    ('todo.throughput_per_s', True),
+    ('todo.latency_ms.p50', False),
+    ('todo.latency_ms.p99', False),
+    ('memory.peak_rss_mb', False),
+]
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """ Nearest rank percentile of an ascending list """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class LatencyRecorder:
+    def __init__(self):
+        # Seconds
+        self.values: List[float] = []
+
+    def record(self, seconds: float):
+        self.values.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def summary(self) -> Dict[str, float]:
+        """ Milliseconds """
+        values = sorted(self.values)
+        if not values:
+            return {'count': 0}
+        return {
+            'count': len(values),
+            'mean': round(sum(values) / len(values) * 1000, 3),
+            'p50': round(percentile(values, 0.5) * 1000, 3),
+            'p90': round(percentile(values, 0.9) * 1000, 3),
+            'p99': round(percentile(values, 0.99) * 1000, 3),
+            'max': round(values[-1] * 1000, 3),
+        }
+
+
+def _rss_bytes(pid: int) -> Optional[int]:
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        return psutil.Process(pid).memory_info().rss
+    except psutil.Error:
+        return None
+
+
+class MemorySampler:
+    """ Samples the resident memory of the server process while the load test runs """
+    def __init__(self, pid: Optional[int], interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[int] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def sample(self):
+        if self.pid is None:
+            return
+        rss = _rss_bytes(self.pid)
+        if rss is not None:
+            self.samples.append(rss)
+
+    async def _run(self):
+        while 1:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self) -> Dict[str, Any]:
+        if self.task is not None:
+            self.task.cancel()
+        self.sample()
+        if self.samples:
+            return {
+                'start_rss_mb': round(self.samples[0] / 2**20, 1),
+                'end_rss_mb': round(self.samples[-1] / 2**20, 1),
+                'peak_rss_mb': round(max(self.samples) / 2**20, 1),
+            }
+        if self.pid == os.getpid() and sys.platform != 'win32':
+            # psutil is not installed, only the peak of this process is known
+            import resource
+            peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Bytes on macOS, kilobytes on linux
+            peak = peak_kb if sys.platform == 'darwin' else peak_kb * 1024
+            return {'peak_rss_mb': round(peak / 2**20, 1)}
+        return {}
+
+
+def git_commit() -> str:
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=ROOT_FOLDER,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return result.stdout.strip()
+
+
+def save_results(results: Dict[str, Any], folder: Path = RESULTS_FOLDER) -> Path:
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder / f'{time.strftime("%Y%m%d-%H%M%S")}_{results["meta"]["commit"]}.json'
+    path.write_text(json.dumps(results, indent=2))
+    return path
+
+
+def latest_results(folder: Path = RESULTS_FOLDER) -> Optional[Path]:
+    """ The newest saved result file, file names start with the time so they sort chronologically """
+    paths = sorted(folder.glob('*.json'))
+    return paths[-1] if paths else None
+
+
+def flatten(results: Dict[str, Any], prefix: str = '') -> Dict[str, Any]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(before: Dict[str, Any], after: Dict[str, Any]) -> str:
+    """ Table of the main values of two runs, with the change in percent """
+    before_values, after_values = flatten(before), flatten(after)
+    lines = [
+        f'{"":<26} {before["meta"]["commit"]:>12} {after["meta"]["commit"]:>12} {"change":>9}',
+    ]
+    for load in ('chat_load', 'todo_load'):
+        if before['meta'].get(load) != after['meta'].get(load):
+            lines.append(f'Note: the runs used a different {load.replace("_", " ")}')
+    for key, higher_is_better in COMPARED_VALUES:
+        old, new = before_values.get(key), after_values.get(key)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        regression = change < 0 if higher_is_better else change > 0
+        marker = ' !' if regression and abs(change) >= 10 else ''
+        lines.append(f'{key:<26} {old:>12} {new:>12} {change:>+8.1f}%{marker}')
+    return '\n'.join(lines)
@@ -0,0 +1,149 @@
+"""
+Load test of the chat websocket and the todo routes, run with:
+poetry run python -m backend.loadtest.run                                # in-process through the ASGI app
+poetry run python -m backend.loadtest.run --url http://localhost:8000    # against a running server
+poetry run python -m backend.loadtest.run --start-server                 # starts uvicorn like the e2e tests
+Reports throughput, latency percentiles and memory of the server process. Results are saved to loadtest_results/
+and compared with the previous result file, run the same command on two commits to compare them.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Set
+
+from backend.loadtest.report import RESULTS_FOLDER, MemorySampler, compare, git_commit, latest_results, save_results
+from backend.loadtest.scenarios import ChatLoad, TodoLoad, run_chat, run_todo
+from backend.loadtest.transport import AsgiTransport, NetworkTransport, Transport
+
+
+async def wait_until_reachable(transport: Transport, timeout: float = 10):
+    client = await transport.http_client()
+    deadline = time.perf_counter() + timeout
+    try:
+        while 1:
+            try:
+                status, _ = await client.request('GET', '/')
+                if status == 200:
+                    return
+            except OSError:
+                if time.perf_counter() > deadline:
+                    raise
+            await asyncio.sleep(0.2)
+    finally:
+        await client.close()
+
+
+async def run_load_test(
+    transport: Transport,
+    scenarios: Set[str],
+    chat_load: ChatLoad,
+    todo_load: TodoLoad,
+    server_pid: Optional[int] = None,
+) -> Dict[str, Any]:
+    results: Dict[str, Any] = {
+        'meta': {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'transport': transport.name,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'chat_load': vars(chat_load),
+            'todo_load': vars(todo_load),
+        },
+    }
+    await transport.start()
+    memory = MemorySampler(server_pid)
+    memory.start()
+    try:
+        if 'chat' in scenarios:
+            results['chat'] = await run_chat(transport, chat_load)
+        if 'todo' in scenarios:
+            results['todo'] = await run_todo(transport, todo_load)
+    finally:
+        results['memory'] = memory.stop()
+        await transport.stop()
+    return results
+
+
+def create_asgi_transport(log_level: str, database_folder: Path) -> AsgiTransport:
+    # Imported here, so running against a server does not import the app
+    from backend.logging_config import configure_logging
+    from backend.main import app
+    from backend.routes import todolist
+
+    # Logging every chat message to the terminal would dominate the measurement
+    configure_logging(level=log_level)
+    todolist.SQLITE_FILENAME = str(database_folder / 'todos.db')
+    return AsgiTransport(app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help='Server to test, e.g. http://localhost:8000, default: in-process')
+    target.add_argument('--start-server', action='store_true', help='Start uvicorn on a free port and test it')
+    parser.add_argument('--server-pid', type=int, help='Process to sample the memory of when using --url')
+    parser.add_argument('--scenarios', default='chat,todo', help='Comma separated: chat, todo')
+    parser.add_argument('--chat-clients', type=int, default=ChatLoad.clients)
+    parser.add_argument('--chat-messages', type=int, default=ChatLoad.messages_per_client, help='Per client')
+    parser.add_argument('--chat-interval', type=float, default=ChatLoad.interval, help='Seconds between messages')
+    parser.add_argument('--todo-workers', type=int, default=TodoLoad.workers)
+    parser.add_argument('--todo-requests', type=int, default=TodoLoad.requests_per_worker, help='Per worker')
+    parser.add_argument('--todo-mix', default=TodoLoad.mix)
+    parser.add_argument('--seed', type=int, default=TodoLoad.seed)
+    parser.add_argument('--log-level', default='WARNING', help='Log level of the in-process app')
+    parser.add_argument('--results-folder', type=Path, default=RESULTS_FOLDER)
+    parser.add_argument('--compare', type=Path, help='Result file to compare with, default: the previous result')
+    parser.add_argument('--no-save', action='store_true', help='Do not save the result')
+    args = parser.parse_args()
+
+    chat_load = ChatLoad(clients=args.chat_clients, messages_per_client=args.chat_messages, interval=args.chat_interval)
+    todo_load = TodoLoad(
+        workers=args.todo_workers, requests_per_worker=args.todo_requests, mix=args.todo_mix, seed=args.seed
+    )
+    scenarios = {scenario.strip() for scenario in args.scenarios.split(',')}
+
+    started_processes: Set[int] = set()
+    created_files: Set[Path] = set()
+    server_pid: Optional[int] = args.server_pid
+    with tempfile.TemporaryDirectory() as database_folder:
+        transport: Transport
+        if args.url:
+            transport = NetworkTransport(args.url)
+        elif args.start_server:
+            from test.tester_helper import find_next_free_port, start_backend_dev_server
+            port = find_next_free_port()
+            start_backend_dev_server(port, started_processes, created_files)
+            server_pid = next(iter(started_processes), None)
+            transport = NetworkTransport(f'http://localhost:{port}')
+        else:
+            transport = create_asgi_transport(args.log_level, Path(database_folder))
+            server_pid = os.getpid()
+
+        try:
+            if isinstance(transport, NetworkTransport):
+                asyncio.run(wait_until_reachable(transport))
+            results = asyncio.run(run_load_test(transport, scenarios, chat_load, todo_load, server_pid))
+        finally:
+            if started_processes:
+                from test.tester_helper import kill_processes, remove_leftover_files
+                kill_processes(started_processes)
+                remove_leftover_files(created_files)
+
+    print(json.dumps(results, indent=2))
+    previous = args.compare or latest_results(args.results_folder)
+    if not args.no_save:
+        path = save_results(results, args.results_folder)
+        print(f'\nSaved results to {path}')
+    if previous is not None:
+        print(f'\nCompared with {previous}:')
+        print(compare(json.loads(previous.read_text()), results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Load test scenarios: concurrent chat clients and mixed todo CRUD traffic.
+"""
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, List, Tuple
+
+from backend.loadtest.report import LatencyRecorder
+from backend.loadtest.transport import Transport, WebSocketClient
+
+
+@dataclass
+class ChatLoad:
+    # Concurrent websocket clients, all in the default room
+    clients: int = 50
+    # Messages sent by every client, every client receives clients * messages_per_client messages
+    # Stay within CHAT_MESSAGE_RATE and CHAT_MESSAGE_BURST of the server, or messages are dropped
+    messages_per_client: int = 20
+    # Seconds between two messages of the same client
+    interval: float = 0.01
+    # Seconds to wait for outstanding messages after the last one was sent
+    timeout: float = 30
+
+
+@dataclass
+class TodoLoad:
+    # Concurrent HTTP clients, each sends its requests one after another
+    workers: int = 20
+    requests_per_worker: int = 100
+    # Relative weights of the operations
+    mix: str = 'list=50,create=25,delete=15,search=10'
+    seed: int = 0
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(','):
+        operation, _, weight = item.partition('=')
+        weights[operation.strip()] = float(weight)
+    unknown = set(weights) - {'list', 'create', 'delete', 'search'}
+    if unknown:
+        raise ValueError(f'Unknown todo operations: {sorted(unknown)}, choose from: list, create, delete, search')
+    return weights
+
+
+async def _connect_chat_client(transport: Transport, name: str) -> WebSocketClient:
+    websocket = await transport.websocket('/chatws')
+    await websocket.send_text(json.dumps({'tryToConnectUser': name}))
+    # 'connectUser', then the history of the default room
+    while 1:
+        frame = json.loads(await websocket.receive_text())
+        if 'error' in frame:
+            raise RuntimeError(f'Could not connect chat client {name}: {frame["error"]}')
+        if 'newMessageHistory' in frame:
+            return websocket
+
+
+async def run_chat(transport: Transport, load: ChatLoad) -> Dict[str, Any]:
+    """
+    Every client sends its messages to the default room and reads the messages of all clients.
+    The latency of a message is the time until its sender received it back.
+    """
+    # Usernames are unique per run, so the test can run against a server that has other users
+    run_id = uuid.uuid4().hex[:8]
+    connect_latency = LatencyRecorder()
+    message_latency = LatencyRecorder()
+
+    async def connect(index: int) -> Tuple[str, WebSocketClient]:
+        name = f'load{run_id}_{index}'
+        start = time.perf_counter()
+        websocket = await _connect_chat_client(transport, name)
+        connect_latency.record(time.perf_counter() - start)
+        return name, websocket
+
+    clients = await asyncio.gather(*(connect(index) for index in range(load.clients)))
+    expected_per_client = load.clients * load.messages_per_client
+    sent_at: Dict[str, float] = {}
+    delivered = 0
+    frames = 0
+
+    async def read(name: str, websocket: WebSocketClient):
+        nonlocal delivered, frames
+        received = 0
+        try:
+            while received < expected_per_client:
+                frame = json.loads(await websocket.receive_text())
+                frames += 1
+                # Rooms that coalesce their messages send several in one 'newMessages' frame
+                records = frame['newMessages'] if 'newMessages' in frame else [frame.get('newMessage')]
+                for record in records:
+                    if record is None:
+                        continue
+                    received += 1
+                    delivered += 1
+                    if record['author'] == name:
+                        message_latency.record(time.perf_counter() - sent_at[record['message']])
+        except ConnectionError:
+            # E.g. disconnected as slow consumer, the missing messages count as lost
+            pass
+
+    async def write(name: str, websocket: WebSocketClient):
+        for seq in range(load.messages_per_client):
+            text = f'{name}:{seq}'
+            sent_at[text] = time.perf_counter()
+            await websocket.send_text(json.dumps({'sendChatMessage': {'author': name, 'message': text}}))
+            await asyncio.sleep(load.interval)
+
+    start = time.perf_counter()
+    readers = [asyncio.create_task(read(name, websocket)) for name, websocket in clients]
+    await asyncio.gather(*(write(name, websocket) for name, websocket in clients))
+    _, pending = await asyncio.wait(readers, timeout=load.timeout)
+    duration = time.perf_counter() - start
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*(websocket.close() for _, websocket in clients), return_exceptions=True)
+
+    return {
+        'clients': load.clients,
+        'messages_sent': len(sent_at),
+        'messages_expected': expected_per_client * load.clients,
+        'messages_delivered': delivered,
+        'frames_received': frames,
+        'duration_s': round(duration, 3),
+        # Delivered messages, every sent message is delivered to all clients
+        'throughput_per_s': round(delivered / duration, 1),
+        'latency_ms': message_latency.summary(),
+        'connect_ms': connect_latency.summary(),
+    }
+
+
+async def run_todo(transport: Transport, load: TodoLoad) -> Dict[str, Any]:
+    weights = parse_mix(load.mix)
+    operations: List[str] = list(weights)
+    latency = LatencyRecorder()
+    operation_latency = {operation: LatencyRecorder() for operation in operations}
+    errors = {operation: 0 for operation in operations}
+    # Ids created by this run, deletes only remove these
+    created: List[int] = []
+
+    async def worker(index: int):
+        rng = random.Random(load.seed * 1_000_000 + index)
+        client = await transport.http_client()
+        for request_index in range(load.requests_per_worker):
+            operation = rng.choices(operations, [weights[operation] for operation in operations])[0]
+            if operation == 'delete' and not created:
+                operation = 'create'
+            start = time.perf_counter()
+            if operation == 'list':
+                status, _ = await client.request('GET', '/api?limit=100')
+            elif operation == 'create':
+                status, body = await client.request(
+                    'POST', '/api_bulk', {'todos': [f'load test todo {index} {request_index}']}
+                )
+                if status == 200:
+                    created.extend(json.loads(body)['ids'])
+            elif operation == 'delete':
+                todo_id = created.pop(rng.randrange(len(created)))
+                status, _ = await client.request('DELETE', f'/api/{todo_id}')
+            else:
+                status, _ = await client.request('GET', '/api_search?q=load%20todo')
+            duration = time.perf_counter() - start
+            latency.record(duration)
+            operation_latency.setdefault(operation, LatencyRecorder()).record(duration)
+            if status >= 400:
+                errors[operation] = errors.get(operation, 0) + 1
+        await client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(index) for index in range(load.workers)))
+    duration = time.perf_counter() - start
+
+    # Leave the database as it was, not measured
+    if created:
+        client = await transport.http_client()
+        await client.request('DELETE', '/api_bulk', {'ids': created})
+        await client.close()
+
+    return {
+        'workers': load.workers,
+        'requests': len(latency),
+        'errors': sum(errors.values()),
+        'duration_s': round(duration, 3),
+        'throughput_per_s': round(len(latency) / duration, 1),
+        'latency_ms': latency.summary(),
+        'operations': {
+            operation: {
+                **recorder.summary(), 'errors': errors.get(operation, 0)
+            }
+            for operation, recorder in operation_latency.items() if len(recorder)
+        },
+    }
@@ -0,0 +1,278 @@
+"""
+Clients for the load test: in-process through the ASGI app, or over the network against a running uvicorn.
+"""
+import asyncio
+import json
+from typing import Any, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import h11
+from starlette.types import ASGIApp, Message
+
+# (status code, response body)
+HttpResponse = Tuple[int, bytes]
+
+
+class HttpClient:
+    """ One client connection, requests of one client are sent one after another """
+    async def request(self, method: str, path: str, json_body: Any = None) -> HttpResponse:
+        raise NotImplementedError()
+
+    async def close(self):
+        pass
+
+
+class WebSocketClient:
+    async def send_text(self, data: str):
+        raise NotImplementedError()
+
+    async def receive_text(self) -> str:
+        """ Raises ConnectionError when the server closed the connection """
+        raise NotImplementedError()
+
+    async def close(self):
+        raise NotImplementedError()
+
+
+class Transport:
+    name = ''
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def http_client(self) -> HttpClient:
+        raise NotImplementedError()
+
+    async def websocket(self, path: str) -> WebSocketClient:
+        raise NotImplementedError()
+
+
+def _json_body(json_body: Any) -> bytes:
+    return b'' if json_body is None else json.dumps(json_body).encode()
+
+
+class AsgiHttpClient(HttpClient):
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def request(self, method: str, path: str, json_body: Any = None) -> HttpResponse:
+        path, _, query = path.partition('?')
+        body = _json_body(json_body)
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': query.encode(),
+            'root_path': '',
+            'headers': [(b'host', b'loadtest'), (b'content-type', b'application/json')],
+            'client': ('127.0.0.1', 50000),
+            'server': ('loadtest', 80),
+        }
+        request_sent = False
+        status = 0
+        chunks: List[bytes] = []
+
+        async def receive() -> Message:
+            nonlocal request_sent
+            if request_sent:
+                # Only asked for again when the app waits for a disconnect, e.g. a streaming response
+                await asyncio.Future()
+            request_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+
+        await self.app(scope, receive, send)
+        return status, b''.join(chunks)
+
+
+class AsgiWebSocketClient(WebSocketClient):
+    def __init__(self, app: ASGIApp, path: str):
+        path, _, query = path.partition('?')
+        self.scope = {
+            'type': 'websocket',
+            'asgi': {'version': '3.0'},
+            'scheme': 'ws',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': query.encode(),
+            'root_path': '',
+            'headers': [(b'host', b'loadtest')],
+            'subprotocols': [],
+            'client': ('127.0.0.1', 50000),
+            'server': ('loadtest', 80),
+        }
+        self.to_app: 'asyncio.Queue[Message]' = asyncio.Queue()
+        self.from_app: 'asyncio.Queue[Optional[str]]' = asyncio.Queue()
+        self.accepted = asyncio.Event()
+        self.closed = False
+        self.task = asyncio.create_task(app(self.scope, self.to_app.get, self._send))
+
+    async def _send(self, message: Message):
+        if message['type'] == 'websocket.accept':
+            self.accepted.set()
+        elif message['type'] == 'websocket.send':
+            text = message.get('text')
+            self.from_app.put_nowait(text if text is not None else message['bytes'].decode())
+        elif message['type'] == 'websocket.close':
+            self.closed = True
+            self.accepted.set()
+            self.from_app.put_nowait(None)
+
+    async def connect(self):
+        self.to_app.put_nowait({'type': 'websocket.connect'})
+        await self.accepted.wait()
+        if self.closed:
+            raise ConnectionError('Websocket was rejected')
+
+    async def send_text(self, data: str):
+        self.to_app.put_nowait({'type': 'websocket.receive', 'text': data})
+
+    async def receive_text(self) -> str:
+        text = await self.from_app.get()
+        if text is None:
+            raise ConnectionError('Websocket was closed by the server')
+        return text
+
+    async def close(self):
+        self.to_app.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+        await self.task
+
+
+class AsgiTransport(Transport):
+    """ Calls the ASGI app directly, measures the app without network and server overhead """
+    name = 'asgi'
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.lifespan_task: Optional[asyncio.Task] = None
+
+    async def _lifespan(self, message_type: str):
+        self.lifespan_messages.put_nowait({'type': f'lifespan.{message_type}'})
+        event = await self.lifespan_events.get()
+        if not event['type'].endswith('.complete'):
+            raise RuntimeError(f'Lifespan {message_type} failed: {event.get("message")}')
+
+    async def start(self):
+        # Created here, queues are bound to the running event loop in python 3.7
+        self.lifespan_messages: 'asyncio.Queue[Message]' = asyncio.Queue()
+        self.lifespan_events: 'asyncio.Queue[Message]' = asyncio.Queue()
+        scope = {'type': 'lifespan', 'asgi': {'version': '3.0'}}
+        self.lifespan_task = asyncio.create_task(
+            self.app(scope, self.lifespan_messages.get, self.lifespan_events.put)
+        )
+        await self._lifespan('startup')
+
+    async def stop(self):
+        await self._lifespan('shutdown')
+        assert self.lifespan_task
+        await self.lifespan_task
+
+    async def http_client(self) -> HttpClient:
+        return AsgiHttpClient(self.app)
+
+    async def websocket(self, path: str) -> WebSocketClient:
+        websocket = AsgiWebSocketClient(self.app, path)
+        await websocket.connect()
+        return websocket
+
+
+class NetworkHttpClient(HttpClient):
+    """ A keep-alive HTTP/1.1 connection, h11 is installed with uvicorn """
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.connection = h11.Connection(h11.CLIENT)
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(self, method: str, path: str, json_body: Any = None) -> HttpResponse:
+        if self.writer is None or self.connection.our_state is h11.MUST_CLOSE:
+            await self.close()
+            self.connection = h11.Connection(h11.CLIENT)
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        assert self.reader and self.writer
+        body = _json_body(json_body)
+        headers = [('host', f'{self.host}:{self.port}'), ('content-length', str(len(body)))]
+        if body:
+            headers.append(('content-type', 'application/json'))
+        data = self.connection.send(h11.Request(method=method, target=path, headers=headers))
+        if body:
+            data += self.connection.send(h11.Data(data=body))
+        data += self.connection.send(h11.EndOfMessage())
+        self.writer.write(data)
+        await self.writer.drain()
+
+        status = 0
+        chunks: List[bytes] = []
+        while 1:
+            event = self.connection.next_event()
+            if event is h11.NEED_DATA:
+                self.connection.receive_data(await self.reader.read(65536))
+            elif isinstance(event, h11.Response):
+                status = event.status_code
+            elif isinstance(event, h11.Data):
+                chunks.append(bytes(event.data))
+            elif isinstance(event, (h11.EndOfMessage, h11.ConnectionClosed)):
+                break
+        if self.connection.our_state is h11.DONE and self.connection.their_state is h11.DONE:
+            self.connection.start_next_cycle()
+        return status, b''.join(chunks)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class NetworkWebSocketClient(WebSocketClient):
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def send_text(self, data: str):
+        await self.connection.send(data)
+
+    async def receive_text(self) -> str:
+        import websockets
+        try:
+            data = await self.connection.recv()
+        except websockets.ConnectionClosed as e:
+            raise ConnectionError('Websocket was closed by the server') from e
+        return data if isinstance(data, str) else data.decode()
+
+    async def close(self):
+        await self.connection.close()
+
+
+class NetworkTransport(Transport):
+    """ Sends requests to a running server, e.g. http://localhost:8000 """
+    name = 'network'
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.url = url.rstrip('/')
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 80
+        self.websocket_url = f'ws://{self.host}:{self.port}'
+
+    async def http_client(self) -> HttpClient:
+        return NetworkHttpClient(self.host, self.port)
+
+    async def websocket(self, path: str) -> WebSocketClient:
+        # The websockets library is installed with uvicorn[standard]
+        import websockets
+        connection = await websockets.connect(f'{self.websocket_url}{path}', max_queue=None)
+        return NetworkWebSocketClient(connection)
+
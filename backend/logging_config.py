@@ -0,0 +1,185 @@
+"""
+Logging configuration, e.g.
+LOG_FORMAT=json LOG_LEVELS='backend.todo=DEBUG,backend.chat=WARNING' LOG_SAMPLE_RATES='chat_message=0.01'
+Records are written by a background thread (LOG_BACKGROUND), so the event loop does not wait for the log I/O.
+High volume events, like every chat message, are logged through a SampledEvent: only every n-th event is formatted
+and logged, a rate of 0 turns the event off.
+"""
+import asyncio
+import json
+import os
+import queue
+import sys
+import threading
+from typing import Any, Dict, Optional, TextIO
+
+from loguru import logger
+
+ENV = os.environ.copy()
+# Minimum level of all modules without an entry in LOG_LEVELS
+LOG_LEVEL: str = ENV.get('LOG_LEVEL', 'INFO')
+# Level per module and its submodules: 'module=LEVEL' separated by commas
+LOG_LEVELS: str = ENV.get('LOG_LEVELS', '')
+# 'text' for humans or 'json' with one object per line
+LOG_FORMAT: str = ENV.get('LOG_FORMAT', 'text')
+# Write records from a background thread instead of the logging thread
+LOG_BACKGROUND: bool = ENV.get('LOG_BACKGROUND', 'True') == 'True'
+# Fraction of the high volume events that is logged: 'event=rate' separated by commas, events not listed are all logged
+LOG_SAMPLE_RATES: str = ENV.get('LOG_SAMPLE_RATES', '')
+
+# Id of the handler added by configure_logging(), None while loguru still has its default handler
+handler_id: Optional[int] = None
+
+
+def _parse_mapping(value: str) -> Dict[str, str]:
+    """ 'a=1,b=2' -> {'a': '1', 'b': '2'} """
+    mapping = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        key, _, item_value = item.partition('=')
+        mapping[key.strip()] = item_value.strip()
+    return mapping
+
+
+def parse_levels(value: str) -> Dict[str, str]:
+    return {module: level.upper() for module, level in _parse_mapping(value).items()}
+
+
+def parse_sample_rates(value: str) -> Dict[str, float]:
+    return {event: float(rate) for event, rate in _parse_mapping(value).items()}
+
+
+class JsonSink:
+    """ Writes one JSON object per record """
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+
+    def write(self, message):
+        record = message.record
+        entry: Dict[str, Any] = {
+            'time': record['time'].isoformat(),
+            'level': record['level'].name,
+            'module': record['name'],
+            'function': record['function'],
+            'line': record['line'],
+            'message': record['message'],
+        }
+        entry.update(record['extra'])
+        if record['exception'] is not None:
+            # The formatted traceback is appended to the message by loguru
+            entry['exception'] = str(message)[len(record['message']):].strip()
+        self.stream.write(json.dumps(entry, default=str) + '\n')
+
+    def flush(self):
+        self.stream.flush()
+
+
+class BackgroundSink:
+    """
+    Hands the records to a writer thread, the logging thread only appends to a queue.
+    The writer writes everything that is queued and flushes once per batch.
+    loguru's own enqueue=True pickles every record through a pipe, which costs the logging thread more than writing
+    to a file or terminal directly.
+    """
+    def __init__(self, target):
+        self.target = target
+        self.queue: 'queue.Queue[Optional[str]]' = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def write(self, message: str):
+        self.queue.put(message)
+
+    def _run(self):
+        while 1:
+            messages = [self.queue.get()]
+            while not self.queue.empty():
+                messages.append(self.queue.get_nowait())
+            try:
+                for message in messages:
+                    if message is not None:
+                        self.target.write(message)
+                self.target.flush()
+            except (OSError, ValueError):
+                # The stream was closed, e.g. at exit, the records are lost but the thread keeps draining the queue
+                pass
+            for _ in messages:
+                self.queue.task_done()
+            if None in messages:
+                return
+
+    def join(self):
+        """ Blocks until all queued records are written """
+        self.queue.join()
+
+    async def complete(self):
+        """ Awaited by logger.complete() """
+        await asyncio.get_running_loop().run_in_executor(None, self.join)
+
+    def stop(self):
+        """ Called by logger.remove() and at exit, writes the remaining records """
+        self.queue.put(None)
+        self.thread.join()
+
+
+def configure_logging(
+    level: str = LOG_LEVEL,
+    levels: str = LOG_LEVELS,
+    log_format: str = LOG_FORMAT,
+    background: bool = LOG_BACKGROUND,
+    sink: Optional[TextIO] = None,
+) -> int:
+    """ Replaces all handlers with a single handler, returns its id """
+    # pylint: disable=W0603
+    global handler_id
+    if log_format not in {'text', 'json'}:
+        raise ValueError(f'Unknown log format: {log_format!r}, choose one of: text, json')
+    level_filter = {'': level.upper(), **parse_levels(levels)}
+    # Records below the lowest configured level are dropped by loguru before they are formatted
+    min_level = min(logger.level(name).no for name in level_filter.values())
+    stream = sink or sys.stderr
+    target = JsonSink(stream) if log_format == 'json' else stream
+    options: Dict[str, Any] = {'level': min_level, 'filter': level_filter, 'diagnose': False}
+    if log_format == 'json':
+        options['format'] = '{message}'
+    else:
+        options['colorize'] = stream.isatty()
+    logger.remove()
+    handler_id = logger.add(BackgroundSink(target) if background else target, **options)
+    return handler_id
+
+
+def logging_configured() -> bool:
+    return handler_id is not None
+
+
+class SampledEvent:
+    """
+    A log call site that is hit for every message or request.
+    The message is only formatted for sampled events, so pass the values as arguments instead of using an f-string:
+        chat_message_log.info('New message from {}', author)
+    """
+    def __init__(self, name: str, rate: Optional[float] = None):
+        self.name = name
+        if rate is None:
+            rate = parse_sample_rates(LOG_SAMPLE_RATES).get(name, 1)
+        # Every n-th event is logged, 0 logs none
+        self.every = 0 if rate <= 0 else max(1, round(1 / rate))
+        self.count = 0
+
+    def _log(self, level: str, message: str, *args, **kwargs):
+        if not self.every:
+            return
+        self.count += 1
+        if self.count < self.every:
+            return
+        self.count = 0
+        # depth=2: the record shows the caller of info() or debug() instead of this module
+        logger.opt(depth=2).bind(event=self.name, sample_every=self.every).log(level, message, *args, **kwargs)
+
+    def info(self, message: str, *args, **kwargs):
+        self._log('INFO', message, *args, **kwargs)
+
+    def debug(self, message: str, *args, **kwargs):
+        self._log('DEBUG', message, *args, **kwargs)
@@ -1,49 +1,103 @@
-import asyncio
 import os
 
-import uvicorn
 from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
 
-from backend.routes.chat import chat_router
+from backend.cors import CorsPolicy, CorsPolicyMiddleware
+from backend.logging_config import configure_logging, logging_configured
+from backend.metrics import MetricsMiddleware
+from backend.routes.chat import chat_router, websocket_chat_manager
 from backend.routes.hello_world import background_task_function, hello_world_router
-from backend.routes.todolist import create_database_if_not_exist, get_db, todo_list_router
+from backend.routes.metrics import metrics_router
+from backend.routes.todolist import close_database, create_database_if_not_exist, todo_feed, todo_list_router
+from backend.scheduler import scheduler
 
 ENV = os.environ.copy()
+# Allowed origins, see backend/cors.py for the rule format
+CORS_ORIGINS: str = ENV.get('CORS_ORIGINS', 'https://burnysc2.github.io,http://localhost:1-65535')
+# Log the duration of every startup and shutdown hook, see backend/startup_profiler.py
+STARTUP_PROFILE: bool = ENV.get('STARTUP_PROFILE', 'False') == 'True'
 
 app = FastAPI()
 app.include_router(hello_world_router)
 app.include_router(chat_router)
 app.include_router(todo_list_router)
-
-origins = [
-    'https://burnysc2.github.io',
-] + [f'http://localhost:{i}' for i in range(1, 2**16)]
+app.include_router(metrics_router)
 
 app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
+    CorsPolicyMiddleware,
+    policy=CorsPolicy.from_config(CORS_ORIGINS),
     allow_credentials=True,
     allow_methods=['*'],
     allow_headers=['*'],
 )
+# Added last so it is the outermost middleware and the measured latency includes the CORS middleware
+app.add_middleware(MetricsMiddleware)
+
+scheduler.add_periodic(
+    'hello_world',
+    background_task_function,
+    interval=60 * 60,
+    args=('hello', ),
+    kwargs={'other_text': ' world!'},
+)
 
 
+# One hook per subsystem, so the startup profiler can time them separately
 @app.on_event('startup')
 async def startup_event():
-    asyncio.create_task(background_task_function('hello', other_text=' world!'))
-    create_database_if_not_exist()
+    # On startup instead of on import, so importing the app does not replace the log handlers of the importer,
+    # e.g. the load test configures its own level
+    if not logging_configured():
+        configure_logging()
     logger.info('Hello world!')
 
 
+@app.on_event('startup')
+async def start_todo_database():
+    await create_database_if_not_exist()
+
+
+@app.on_event('startup')
+async def start_chat():
+    await websocket_chat_manager.start()
+
+
+@app.on_event('startup')
+async def start_scheduler():
+    # Last, so jobs can use everything started before
+    scheduler.start()
+
+
+@app.on_event('shutdown')
+async def stop_scheduler():
+    # First, so no job runs while the subsystems it uses shut down
+    await scheduler.stop()
+
+
 @app.on_event('shutdown')
-def shutdown_event():
-    db = get_db()
-    if db():
-        db.close()
+async def stop_chat():
+    await websocket_chat_manager.stop()
+
+
+@app.on_event('shutdown')
+async def stop_todo_database():
+    todo_feed.close()
+    await close_database()
+
+
+@app.on_event('shutdown')
+async def shutdown_event():
     logger.info('Bye world!')
+    # Wait until the background thread has written all records
+    await logger.complete()
+
 
+if STARTUP_PROFILE:
+    from backend.startup_profiler import profile_hooks
+    profile_hooks(app)
 
 if __name__ == '__main__':
+    # Only needed when started directly, workers started by 'uvicorn backend.main:app' do not import it twice
+    import uvicorn
     uvicorn.run('__main__:app', host='0.0.0.0', port=8000, reload=True)
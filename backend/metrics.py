@@ -0,0 +1,249 @@
+"""
+In-process metrics exposed at GET /metrics in the prometheus text format.
+Counters only increase, prometheus computes the per second rates, e.g. rate(chat_frames_received_total[1m]).
+Recording a value is a few dict and list operations, so the metrics are always on.
+"""
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+Labels = Tuple[str, ...]
+# (name suffix, label names, label values, value)
+Sample = Tuple[str, Sequence[str], Labels, float]
+M = TypeVar('M', bound='Metric')
+
+# Starlette appends '; charset=utf-8'
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+# Seconds, from 1ms to 10s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Seconds, from 10µs to 100ms
+FAN_OUT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.1)
+# Seconds, from 1ms to 10min
+JOB_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600)
+# Bytes, from 100B to 10MB
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+
+def _format_labels(names: Sequence[str], values: Labels) -> str:
+    if not names:
+        return ''
+    escaped = (value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+    def samples(self) -> Iterator[Sample]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, names, values, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        function: Optional[Callable[[], float]] = None,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.values: Dict[Labels, float] = {}
+        # Reads the value on every scrape, for counts that are already kept somewhere else
+        self.function = function
+
+    def inc(self, amount: float = 1, labels: Labels = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels: Labels = ()) -> float:
+        if self.function is not None:
+            return self.function()
+        return self.values.get(labels, 0)
+
+    def samples(self) -> Iterator[Sample]:
+        if self.function is not None:
+            yield '', (), (), self.function()
+            return
+        for labels, value in self.values.items():
+            yield '', self.label_names, labels, value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1, labels: Labels = ()):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, value: float, labels: Labels = ()):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.upper_bounds: List[float] = [float(bound) for bound in sorted(buckets)] + [float('inf')]
+        # Per label values: the count of each bucket (not cumulative), the sum and the count of observed values
+        self.bucket_counts: Dict[Labels, List[int]] = {}
+        self.sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        counts = self.bucket_counts.get(labels)
+        if counts is None:
+            counts = self.bucket_counts[labels] = [0] * len(self.upper_bounds)
+            self.sums[labels] = 0
+        # Buckets are 'less than or equal', bisect_left finds the first upper bound >= value
+        counts[bisect_left(self.upper_bounds, value)] += 1
+        self.sums[labels] += value
+
+    def count(self, labels: Labels = ()) -> int:
+        return sum(self.bucket_counts.get(labels, ()))
+
+    def samples(self) -> Iterator[Sample]:
+        bucket_names = self.label_names + ('le', )
+        for labels, counts in self.bucket_counts.items():
+            cumulative = 0
+            for upper_bound, count in zip(self.upper_bounds, counts):
+                cumulative += count
+                yield '_bucket', bucket_names, labels + (_format_value(upper_bound), ), cumulative
+            yield '_sum', self.label_names, labels, self.sums[labels]
+            yield '_count', self.label_names, labels, cumulative
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name!r} is already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        function: Optional[Callable[[], float]] = None,
+    ) -> Counter:
+        return self.register(Counter(name, documentation, label_names, function))
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        function: Optional[Callable[[], float]] = None,
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names, function))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+
+class HttpMetrics:
+    """ The metrics recorded by MetricsMiddleware """
+    def __init__(self, registry: MetricsRegistry):
+        self.in_flight = registry.gauge('http_requests_in_flight', 'HTTP requests being handled')
+        self.requests = registry.counter('http_requests_total', 'Handled HTTP requests', ('method', 'route', 'status'))
+        self.latency = registry.histogram(
+            'http_request_duration_seconds', 'Time until the response was sent completely', ('method', 'route')
+        )
+        self.response_size = registry.histogram(
+            'http_response_size_bytes', 'Size of the response body', ('method', 'route'), buckets=SIZE_BUCKETS
+        )
+
+
+metrics_registry = MetricsRegistry()
+# Created once here, starlette creates a new middleware instance whenever the middleware stack is rebuilt
+http_metrics = HttpMetrics(metrics_registry)
+
+
+class MetricsMiddleware:
+    """
+    Records latency, status and response size of every HTTP request, labelled by route template (e.g. /api/{todo_id})
+    instead of the path, so the amount of label values stays bounded.
+    """
+    def __init__(self, app: ASGIApp, metrics: HttpMetrics = http_metrics):
+        self.app = app
+        self.metrics = metrics
+        # Endpoint -> route template, filled on first use of every route
+        self.route_paths: Dict[Callable, str] = {}
+
+    def route_of(self, scope: Scope) -> str:
+        # The router stores the matched endpoint in the scope, which is shared with this middleware
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        path = self.route_paths.get(endpoint)
+        if path is None:
+            router = scope.get('router')
+            routes = router.routes if router is not None else []
+            path = next((route.path for route in routes if getattr(route, 'endpoint', None) is endpoint), 'unmatched')
+            self.route_paths[endpoint] = path
+        return path
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        size = 0
+
+        async def send_wrapper(message: Message):
+            nonlocal status, size
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                size += len(message.get('body', b''))
+            await send(message)
+
+        metrics = self.metrics
+        metrics.in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start
+            metrics.in_flight.dec()
+            labels = (scope['method'], self.route_of(scope))
+            metrics.requests.inc(labels=labels + (str(status), ))
+            metrics.latency.observe(duration, labels)
+            metrics.response_size.observe(size, labels)
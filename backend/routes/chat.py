@@ -1,82 +1,529 @@
-import json
+import asyncio
+import os
 import time
-from dataclasses import dataclass
-from typing import Dict, List
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Set
 
-from dataclasses_json import DataClassJsonMixin
 from fastapi import WebSocket
 from fastapi.routing import APIRouter
 from loguru import logger
 from starlette.websockets import WebSocketDisconnect
 
+from backend.chat.admission import RATE_LIMITED, AdmissionControl
+from backend.chat.backplane import ChatBackplane, InProcessBackplane, create_backplane
+from backend.chat.binary_codec import BinaryCodec
+from backend.chat.broadcast import BroadcastEngine, SlowConsumerPolicy
+from backend.chat.coalescer import MessageCoalescer, parse_room_windows
+from backend.chat.codec import ChatCodec, FrameDecodeError, Payload, get_codec
+from backend.chat.history import HistoryRecord
+from backend.chat.liveness import IDLE_CLOSE_CODE, ConnectionLiveness
+from backend.chat.message_log import MessageLog
+from backend.chat.protocol import (
+    BINARY_SUBPROTOCOL,
+    DEFAULT_ROOM,
+    JSON_SUBPROTOCOL,
+    ChatMessage,
+    HistoryPage,
+    InboundFrame,
+    RequestHistory,
+)
+from backend.chat.room import ChatRoom
+from backend.logging_config import SampledEvent
+from backend.metrics import FAN_OUT_BUCKETS, metrics_registry
+from backend.scheduler import scheduler
+
+ENV = os.environ.copy()
+# Maximum amount of frames that may be queued for a single client before the slow consumer policy kicks in
+CHAT_SEND_QUEUE_SIZE: int = int(ENV.get('CHAT_SEND_QUEUE_SIZE', '256'))
+# What to do with clients that can not keep up: 'drop_oldest' or 'disconnect'
+CHAT_SLOW_CONSUMER_POLICY: str = ENV.get('CHAT_SLOW_CONSUMER_POLICY', 'drop_oldest')
+# Maximum amount of messages kept in memory per room, older messages are dropped
+CHAT_HISTORY_SIZE: int = int(ENV.get('CHAT_HISTORY_SIZE', '10000'))
+# Amount of messages sent on join and maximum amount of messages per requested history page
+CHAT_HISTORY_PAGE_SIZE: int = int(ENV.get('CHAT_HISTORY_PAGE_SIZE', '100'))
+# Rooms a single connection may be a member of at the same time, every room keeps its own history
+CHAT_MAX_ROOMS_PER_CONNECTION: int = int(ENV.get('CHAT_MAX_ROOMS_PER_CONNECTION', '20'))
+# Longer room names are rejected
+CHAT_MAX_ROOM_NAME_LENGTH: int = int(ENV.get('CHAT_MAX_ROOM_NAME_LENGTH', '64'))
+# Serialization library used for chat frames: 'auto', 'msgspec', 'orjson' or 'json'
+CHAT_CODEC: str = ENV.get('CHAT_CODEC', 'auto')
+# How messages and usernames are shared between workers: 'memory' (single worker) or 'socket' (local unix socket)
+CHAT_BACKPLANE: str = ENV.get('CHAT_BACKPLANE', 'memory')
+CHAT_BACKPLANE_SOCKET: str = ENV.get('CHAT_BACKPLANE_SOCKET', '/tmp/fastapi_chat_backplane.sock')
+# Folder of the durable chat history, restored on startup, empty keeps the history in memory only
+CHAT_LOG_FOLDER: str = ENV.get('CHAT_LOG_FOLDER', '')
+# Seconds between writes (and fsyncs) of the chat log, the messages of the last interval are lost on a crash
+CHAT_LOG_FLUSH_INTERVAL: float = float(ENV.get('CHAT_LOG_FLUSH_INTERVAL', '0.1'))
+# Bytes after which the chat log continues in a new segment file
+CHAT_LOG_SEGMENT_SIZE: int = int(ENV.get('CHAT_LOG_SEGMENT_SIZE', str(16 * 2**20)))
+# Closed segments are compacted into one when there are more than this
+CHAT_LOG_COMPACT_SEGMENTS: int = int(ENV.get('CHAT_LOG_COMPACT_SEGMENTS', '8'))
+# Messages older than this are dropped on compaction, 0 keeps them until they leave the room history
+CHAT_LOG_RETENTION_DAYS: float = float(ENV.get('CHAT_LOG_RETENTION_DAYS', '0'))
+# Seconds between scheduled compactions of the chat log, which also apply the retention, 0 only compacts on size
+CHAT_LOG_COMPACT_INTERVAL: float = float(ENV.get('CHAT_LOG_COMPACT_INTERVAL', '3600'))
+# Seconds without a frame from a client after which the server sends it a 'ping', 0 disables reaping
+CHAT_IDLE_TIMEOUT: float = float(ENV.get('CHAT_IDLE_TIMEOUT', '60'))
+# Seconds a client has to answer a 'ping' with any frame before its connection is closed
+CHAT_PONG_TIMEOUT: float = float(ENV.get('CHAT_PONG_TIMEOUT', '20'))
+# Seconds between two runs of the idle connection reaper
+CHAT_REAP_INTERVAL: float = float(ENV.get('CHAT_REAP_INTERVAL', '5'))
+# Seconds the new messages of a room are collected and sent as one 'newMessages' frame, 0 sends each message right away
+CHAT_COALESCE_WINDOW: float = float(ENV.get('CHAT_COALESCE_WINDOW', '0'))
+# A batch is sent before the window ends once it has this many messages
+CHAT_COALESCE_MAX_MESSAGES: int = int(ENV.get('CHAT_COALESCE_MAX_MESSAGES', '100'))
+# Window of single rooms, overrides CHAT_COALESCE_WINDOW: 'room=seconds' separated by commas, e.g. 'general=0.05,dev=0'
+CHAT_COALESCE_ROOMS: str = ENV.get('CHAT_COALESCE_ROOMS', '')
+# Inbound frames per second a connection may send on average, further frames are dropped, 0 disables the limit
+CHAT_FRAME_RATE: float = float(ENV.get('CHAT_FRAME_RATE', '50'))
+# Frames a connection may send at once before CHAT_FRAME_RATE applies
+CHAT_FRAME_BURST: float = float(ENV.get('CHAT_FRAME_BURST', '100'))
+# Chat messages per second a username may send on average, further messages are dropped, 0 disables the limit
+CHAT_MESSAGE_RATE: float = float(ENV.get('CHAT_MESSAGE_RATE', '20'))
+# Chat messages a username may send at once before CHAT_MESSAGE_RATE applies
+CHAT_MESSAGE_BURST: float = float(ENV.get('CHAT_MESSAGE_BURST', '40'))
+# Larger inbound frames (characters of text frames, bytes of binary frames) are dropped without decoding them
+CHAT_MAX_FRAME_SIZE: int = int(ENV.get('CHAT_MAX_FRAME_SIZE', '65536'))
+
+# Application close code (4000-4999) of connections whose username another worker took during a backplane failover
+USERNAME_LOST_CLOSE_CODE = 4001
+
 chat_router = APIRouter()
+frames_received = metrics_registry.counter('chat_frames_received_total', 'Frames received from /chatws connections')
+broadcast_duration = metrics_registry.histogram(
+    'chat_broadcast_seconds',
+    'Time to store a new message and queue it for all room members',
+    buckets=FAN_OUT_BUCKETS,
+)
+# One log line per chat message or invalid frame, can be sampled with LOG_SAMPLE_RATES
+chat_message_log = SampledEvent('chat_message')
+invalid_frame_log = SampledEvent('chat_invalid_frame')
 
 
-@dataclass
-class ChatMessage(DataClassJsonMixin):
-    timestamp: float
-    author: str
-    message: str
+def create_message_log(history_size: int) -> Optional[MessageLog]:
+    if not CHAT_LOG_FOLDER:
+        return None
+    return MessageLog(
+        Path(CHAT_LOG_FOLDER),
+        history_size,
+        flush_interval=CHAT_LOG_FLUSH_INTERVAL,
+        segment_size=CHAT_LOG_SEGMENT_SIZE,
+        compact_segments=CHAT_LOG_COMPACT_SEGMENTS,
+        retention=CHAT_LOG_RETENTION_DAYS * 24 * 3600,
+    )
 
 
 class WebsocketChatManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(
+        self,
+        send_queue_size: int = CHAT_SEND_QUEUE_SIZE,
+        slow_consumer_policy: SlowConsumerPolicy = SlowConsumerPolicy(CHAT_SLOW_CONSUMER_POLICY),
+        history_size: int = CHAT_HISTORY_SIZE,
+        history_page_size: int = CHAT_HISTORY_PAGE_SIZE,
+        codec: Optional[ChatCodec] = None,
+        backplane: Optional[ChatBackplane] = None,
+        message_log: Optional[MessageLog] = None,
+        idle_timeout: float = CHAT_IDLE_TIMEOUT,
+        pong_timeout: float = CHAT_PONG_TIMEOUT,
+        reap_interval: float = CHAT_REAP_INTERVAL,
+        coalesce_window: float = CHAT_COALESCE_WINDOW,
+        coalesce_max_messages: int = CHAT_COALESCE_MAX_MESSAGES,
+        room_coalesce_windows: Optional[Dict[str, float]] = None,
+        admission: Optional[AdmissionControl] = None,
+        max_rooms_per_connection: int = CHAT_MAX_ROOMS_PER_CONNECTION,
+        max_room_name_length: int = CHAT_MAX_ROOM_NAME_LENGTH,
+    ):
+        # Codec for clients that did not request a subprotocol
+        self.codec: ChatCodec = codec or get_codec(CHAT_CODEC)
+        self.codecs: Dict[str, ChatCodec] = {
+            JSON_SUBPROTOCOL: self.codec,
+            BINARY_SUBPROTOCOL: BinaryCodec(),
+        }
+        # Starlette websockets are not hashable, so connections are keyed by id(websocket)
+        self.active_connections: Dict[int, WebSocket] = {}
+        # Username <-> websocket in both directions, so lookups on join, leave and disconnect are O(1)
         self.usernames: Dict[str, WebSocket] = {}
-        self.messages_history: List[ChatMessage] = []
+        self.websocket_usernames: Dict[int, str] = {}
+        self.liveness = ConnectionLiveness(idle_timeout, pong_timeout)
+        self.admission: AdmissionControl = admission or AdmissionControl(
+            frame_rate=CHAT_FRAME_RATE,
+            frame_burst=CHAT_FRAME_BURST,
+            message_rate=CHAT_MESSAGE_RATE,
+            message_burst=CHAT_MESSAGE_BURST,
+            max_frame_size=CHAT_MAX_FRAME_SIZE,
+        )
+        self.reap_interval = reap_interval
+        self.reaper_task: Optional[asyncio.Task] = None
+        self.history_size = history_size
+        self.history_page_size = history_page_size
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_messages = coalesce_max_messages
+        self.room_coalesce_windows: Dict[str, float] = (
+            parse_room_windows(CHAT_COALESCE_ROOMS) if room_coalesce_windows is None else room_coalesce_windows
+        )
+        self.rooms: Dict[str, ChatRoom] = {}
+        self.max_rooms_per_connection = max_rooms_per_connection
+        self.max_room_name_length = max_room_name_length
+        # Names of the rooms each connection is a member of
+        self.connection_rooms: Dict[int, Set[str]] = {}
+        # History of rooms read from the message log, restored when the room is created
+        self.recovered_history: Dict[str, List[HistoryRecord]] = {}
+        self.get_or_create_room(DEFAULT_ROOM)
+        self.broadcast_engine = BroadcastEngine(
+            max_queue_size=send_queue_size,
+            policy=slow_consumer_policy,
+            on_close=self.disconnect,
+        )
+        self.backplane: ChatBackplane = backplane or create_backplane(
+            CHAT_BACKPLANE,
+            CHAT_BACKPLANE_SOCKET,
+            history_size,
+        )
+        self.backplane.attach(self.deliver_message, username_lost=self.username_lost)
+        self.message_log: Optional[MessageLog] = message_log or create_message_log(history_size)
+        if self.message_log is not None and not isinstance(self.backplane, InProcessBackplane):
+            # Message ids are assigned by the backplane hub with multiple workers, every worker would log every message
+            raise ValueError('The durable chat log (CHAT_LOG_FOLDER) requires CHAT_BACKPLANE=memory')
+
+    async def start(self):
+        if self.message_log is not None:
+            self.recovered_history = await self.message_log.open()
+            self.rooms[DEFAULT_ROOM].load_history(self.recovered_history.pop(DEFAULT_ROOM, []))
+        await self.backplane.start()
+        # Catch up with the messages other workers received before this worker started
+        await self._load_room_history(self.rooms[DEFAULT_ROOM])
+        if self.liveness.idle_timeout > 0:
+            self.reaper_task = asyncio.create_task(self._run_reaper())
+
+    async def stop(self):
+        if self.reaper_task is not None:
+            self.reaper_task.cancel()
+            self.reaper_task = None
+        for room in self.rooms.values():
+            if room.coalescer is not None:
+                room.coalescer.close()
+        await self.backplane.stop()
+        self.broadcast_engine.close()
+        if self.message_log is not None:
+            await self.message_log.close()
 
     async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+        # Use the first subprotocol requested by the client that the server supports
+        requested_protocols = websocket.scope.get('subprotocols', [])
+        protocol = next((p for p in requested_protocols if p in self.codecs), None)
+        await websocket.accept(subprotocol=protocol)
+        self.active_connections[id(websocket)] = websocket
+        self.liveness.add(id(websocket), time.monotonic())
+        self.admission.add(id(websocket), time.monotonic())
+        self.broadcast_engine.add(websocket, protocol=protocol or JSON_SUBPROTOCOL)
 
     async def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        # May be called twice: once by the broadcast engine when sending failed, and once by the websocket endpoint
+        self.active_connections.pop(id(websocket), None)
+        self.liveness.remove(id(websocket))
+        self.admission.remove(id(websocket))
+        self.broadcast_engine.remove(websocket)
+        for room_name in self.connection_rooms.pop(id(websocket), set()):
+            self._leave_room(room_name, websocket)
 
-    @staticmethod
-    async def send_personal_message(message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+    async def _run_reaper(self):
+        while 1:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.reap_idle_connections()
+            except Exception:  # pylint: disable=W0703
+                logger.exception('Reaping idle chat connections failed')
+
+    async def reap_idle_connections(self, now: Optional[float] = None):
+        """ Pings idle connections and closes the ones that did not answer the previous ping """
+        to_ping, to_reap = self.liveness.due(time.monotonic() if now is None else now)
+        for connection_id in to_ping:
+            await self.send_personal_json({'ping': time.time()}, self.active_connections[connection_id])
+        reaped = [self.active_connections[connection_id] for connection_id in to_reap]
+        for websocket in reaped:
+            name = await self.disconnect_username(websocket=websocket)
+            await self.disconnect(websocket)
+            logger.info(f'Reaped idle chat connection of {name}')
+        # A half-open connection may never complete the close handshake
+        await asyncio.gather(*(self._close(websocket) for websocket in reaped))
 
     @staticmethod
-    async def send_personal_json(message: Dict, websocket: WebSocket):
-        await websocket.send_text(json.dumps(message))
+    async def _close(websocket: WebSocket, code: int = IDLE_CLOSE_CODE):
+        try:
+            await asyncio.wait_for(websocket.close(code=code), timeout=1)
+        except (RuntimeError, OSError, asyncio.TimeoutError):
+            pass
 
-    async def broadcast_new_message(self, message: ChatMessage):
-        self.messages_history.append(message)
-        message_to_send = {'newMessage': message.to_dict()}
-        for connection in self.active_connections:
-            try:
-                await self.send_personal_json(message_to_send, connection)
-            except RuntimeError:
-                await self.disconnect(connection)
+    def codec_of(self, websocket: WebSocket) -> ChatCodec:
+        protocol = self.broadcast_engine.protocol_of(websocket)
+        return self.codec if protocol is None else self.codecs[protocol]
+
+    async def receive_frame(self, websocket: WebSocket) -> Optional[InboundFrame]:
+        """
+        Returns the next admitted frame sent by the client, or None if the frame was invalid.
+        Frames over the limits of the connection are dropped here without decoding them.
+        """
+        while 1:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                raise WebSocketDisconnect(message.get('code', 1000))
+            frames_received.inc()
+            now = time.monotonic()
+            self.liveness.seen(id(websocket), now)
+            data: Payload = message['text'] if message.get('text') is not None else message['bytes']
+            was_throttled = self.admission.is_throttled(id(websocket))
+            error = self.admission.admit_frame(id(websocket), len(data), now)
+            if error is None:
+                break
+            # A rate limited client is told once, not for every dropped frame
+            if error != RATE_LIMITED or not was_throttled:
+                await self.send_personal_json({'error': error}, websocket)
+        try:
+            return self.codec_of(websocket).decode(data)
+        except FrameDecodeError:
+            return None
+
+    async def send_personal_message(self, message: Payload, websocket: WebSocket):
+        # Go through the send queue so personal messages and broadcasts arrive in order
+        if websocket in self.broadcast_engine:
+            self.broadcast_engine.send(message, websocket)
+        elif isinstance(message, bytes):
+            await websocket.send_bytes(message)
+        else:
+            await websocket.send_text(message)
+
+    async def send_personal_json(self, message: Dict, websocket: WebSocket):
+        await self.send_personal_message(self.codec_of(websocket).encode(message), websocket)
+
+    def get_or_create_room(self, name: str) -> ChatRoom:
+        room = self.rooms.get(name)
+        if room is None:
+            room = ChatRoom(name, self.codecs, self.history_size, self.history_page_size)
+            room.load_history(self.recovered_history.pop(name, []))
+            self._configure_coalescing(room)
+            self.rooms[name] = room
+        return room
+
+    def set_coalescing(self, room_name: str, window: float):
+        """ Sets the batching window of a room, also used when the room is created again, 0 disables batching """
+        self.room_coalesce_windows[room_name] = window
+        room = self.rooms.get(room_name)
+        if room is not None:
+            self._configure_coalescing(room)
+
+    def _configure_coalescing(self, room: ChatRoom):
+        if room.coalescer is not None:
+            room.coalescer.flush()
+            room.coalescer = None
+        window = self.room_coalesce_windows.get(room.name, self.coalesce_window)
+        if window > 0:
+            room.coalescer = MessageCoalescer(
+                room.name,
+                self.codecs,
+                partial(self._send_to_room, room),
+                window=window,
+                max_messages=self.coalesce_max_messages,
+            )
+
+    def _send_to_room(self, room: ChatRoom, payloads: Dict[str, Payload]):
+        self.broadcast_engine.broadcast_by_protocol(payloads, room.websockets)
+
+    def in_room(self, room_name: str, websocket: WebSocket) -> bool:
+        return room_name in self.connection_rooms.get(id(websocket), ())
+
+    async def _load_room_history(self, room: ChatRoom):
+        records = await self.backplane.fetch_history(room.name)
+        if records is not None:
+            room.load_history(records)
+
+    def join_error(self, room_name: str, websocket: WebSocket) -> Optional[str]:
+        """ Why the connection may not join the room, None if it may """
+        if not room_name or len(room_name) > self.max_room_name_length:
+            return 'invalidRoomName'
+        rooms = self.connection_rooms.get(id(websocket), set())
+        if room_name not in rooms and len(rooms) >= self.max_rooms_per_connection:
+            return 'tooManyRooms'
+        return None
+
+    async def join_room(self, room_name: str, websocket: WebSocket):
+        """ Adds the connection to the room and sends the newest page of the room history """
+        is_new_room = room_name not in self.rooms
+        room = self.get_or_create_room(room_name)
+        if room.coalescer is not None:
+            # The pending messages are part of the history the new member receives
+            room.coalescer.flush()
+        room.add(websocket)
+        if is_new_room:
+            # Other workers may already have members and messages in this room
+            await self._load_room_history(room)
+        self.connection_rooms.setdefault(id(websocket), set()).add(room_name)
+        await self.send_message_history(websocket, room_name)
+
+    async def leave_room(self, room_name: str, websocket: WebSocket):
+        rooms = self.connection_rooms.get(id(websocket))
+        if rooms is not None:
+            rooms.discard(room_name)
+        self._leave_room(room_name, websocket)
+        await self.send_personal_json({'leftRoom': room_name}, websocket)
+
+    def _leave_room(self, room_name: str, websocket: WebSocket):
+        room = self.rooms.get(room_name)
+        if room is None:
+            return
+        room.remove(websocket)
+        # Empty rooms and their history are dropped, only the default room lives forever
+        if not room and room_name != DEFAULT_ROOM:
+            self.rooms.pop(room_name)
+            if room.coalescer is not None:
+                room.coalescer.close()
+
+    async def broadcast_new_message(self, message: ChatMessage, room_name: str = DEFAULT_ROOM):
+        # Goes through the backplane so the members on all workers receive it
+        await self.backplane.publish(room_name, message)
+
+    async def deliver_message(self, room_name: str, message: ChatMessage, message_id: Optional[int] = None):
+        """ Called by the backplane for every message published by any worker """
+        room = self.rooms.get(room_name)
+        if room is None:
+            # No local members, the history is fetched from the backplane when somebody joins
+            return
+        start = time.perf_counter()
+        if room.coalescer is None:
+            payloads = room.append_message(message, message_id)
+            if payloads is None:
+                return
+            self.broadcast_engine.broadcast_by_protocol(payloads, room.websockets)
+        else:
+            encoded_records = room.store_message(message, message_id)
+            if encoded_records is None:
+                return
+            room.coalescer.add(encoded_records)
+        broadcast_duration.observe(time.perf_counter() - start)
+        if self.message_log is not None:
+            self.message_log.append(room_name, room.history.last(1)[0])
+
+    def admit_message(self, name: str) -> bool:
+        """ Whether the user may send another chat message """
+        return self.admission.admit_message(name, time.monotonic())
 
     def name_taken(self, name: str):
         return name in self.usernames
 
+    async def reserve_username(self, name: str) -> bool:
+        """ Returns True if the name was free on all workers and is now reserved for the caller """
+        if self.name_taken(name):
+            return False
+        return await self.backplane.reserve_username(name)
+
     def verify(self, name: str, websocket: WebSocket):
-        return name in self.usernames and self.usernames[name] == websocket
+        return self.websocket_usernames.get(id(websocket)) == name
+
+    def username_of(self, websocket: WebSocket) -> Optional[str]:
+        return self.websocket_usernames.get(id(websocket))
 
     async def connect_username(self, name: str, websocket: WebSocket):
         assert name not in self.usernames
+        assert id(websocket) not in self.websocket_usernames
         self.usernames[name] = websocket
+        self.websocket_usernames[id(websocket)] = name
         await self.send_personal_json({'connectUser': name}, websocket)
-        await self.send_message_history(websocket)
+        await self.join_room(DEFAULT_ROOM, websocket)
 
-    async def send_message_history(self, websocket: WebSocket):
-        await self.send_personal_json({'newMessageHistory': [m.to_dict() for m in self.messages_history]}, websocket)
+    async def send_message_history(self, websocket: WebSocket, room_name: str = DEFAULT_ROOM):
+        """ Only the newest page is sent on join, older messages can be requested with 'requestHistory' """
+        protocol = self.broadcast_engine.protocol_of(websocket) or JSON_SUBPROTOCOL
+        await self.send_personal_message(self.rooms[room_name].history_payload(protocol), websocket)
 
-    async def disconnect_username(self, name: str = None, websocket: WebSocket = None):
-        if name is not None:
-            assert name in self.usernames
-            self.usernames.pop(name)
+    async def send_history_page(self, request: RequestHistory, websocket: WebSocket):
+        """
+        Send a page of older messages.
+        Request body is either {"since": <timestamp>, "limit": <n>} or {"beforeId": <message id>, "limit": <n>},
+        with an optional "room"
+        """
+        room_name = request.room or DEFAULT_ROOM
+        if not self.in_room(room_name, websocket):
+            await self.send_personal_json({'error': 'notInRoom'}, websocket)
+            return
+        history = self.rooms[room_name].history
+        limit = self.history_page_size if request.limit is None else request.limit
+        limit = max(0, min(limit, self.history_page_size))
+        records: List[HistoryRecord]
+        if request.beforeId is not None:
+            records, has_more = history.before(request.beforeId, limit)
         else:
-            assert websocket
-            for username, ws in self.usernames.items():
-                if ws == websocket:
-                    self.usernames.pop(username)
-                    return username
+            records, has_more = history.since(request.since or 0, limit)
+        page = HistoryPage(messages=records, hasMore=has_more, room=room_name)
+        await self.send_personal_json({'historyPage': page}, websocket)
+
+    async def username_lost(self, name: str):
+        """ Called by the backplane when another worker holds the username now, its local user is disconnected """
+        websocket = self.usernames.get(name)
+        if websocket is None:
+            return
+        await self.disconnect_username(name)
+        await self.disconnect(websocket)
+        await self._close(websocket, code=USERNAME_LOST_CLOSE_CODE)
+
+    async def disconnect_username(self, name: str = None, websocket: WebSocket = None) -> Optional[str]:
+        if name is not None:
+            websocket = self.usernames.pop(name)
+            self.websocket_usernames.pop(id(websocket), None)
+            self.admission.release_user(name, time.monotonic())
+            await self.backplane.release_username(name)
+            return name
+        assert websocket
+        username = self.websocket_usernames.pop(id(websocket), None)
+        if username is not None:
+            self.usernames.pop(username, None)
+            self.admission.release_user(username, time.monotonic())
+            await self.backplane.release_username(username)
+        return username
 
 
 websocket_chat_manager = WebsocketChatManager()
+if websocket_chat_manager.message_log is not None and CHAT_LOG_COMPACT_INTERVAL > 0:
+    scheduler.add_periodic(
+        'chat_log_compaction',
+        websocket_chat_manager.message_log.compact_in_background,
+        interval=CHAT_LOG_COMPACT_INTERVAL,
+        jitter=CHAT_LOG_COMPACT_INTERVAL / 10,
+    )
+metrics_registry.gauge(
+    'chat_connections',
+    'Open /chatws connections',
+    function=lambda: len(websocket_chat_manager.active_connections),
+)
+metrics_registry.counter(
+    'chat_frames_sent_total',
+    'Frames sent to /chatws connections',
+    function=lambda: websocket_chat_manager.broadcast_engine.sent_frames,
+)
+metrics_registry.counter(
+    'chat_pings_sent_total',
+    'Pings sent to idle /chatws connections',
+    function=lambda: websocket_chat_manager.liveness.pings_sent,
+)
+metrics_registry.counter(
+    'chat_connections_reaped_total',
+    '/chatws connections closed because they did not answer a ping',
+    function=lambda: websocket_chat_manager.liveness.reaped,
+)
+metrics_registry.counter(
+    'chat_frames_dropped_total',
+    'Inbound /chatws frames dropped because the connection exceeded its frame rate',
+    function=lambda: websocket_chat_manager.admission.dropped_frames,
+)
+metrics_registry.counter(
+    'chat_frames_oversized_total',
+    'Inbound /chatws frames dropped because they exceeded the maximum frame size',
+    function=lambda: websocket_chat_manager.admission.oversized_frames,
+)
+metrics_registry.counter(
+    'chat_messages_rate_limited_total',
+    'Chat messages dropped because the user exceeded the message rate',
+    function=lambda: websocket_chat_manager.admission.dropped_messages,
+)
 
 
 @chat_router.websocket('/chatws')
@@ -84,40 +531,72 @@ async def websocket_endpoint(websocket: WebSocket):
     await websocket_chat_manager.connect(websocket)
     try:
         while 1:
-            data = await websocket.receive_text()
-            data_json = json.loads(data)
-            if 'message' in data_json:
+            frame = await websocket_chat_manager.receive_frame(websocket)
+            if frame is None:
+                invalid_frame_log.info('Received invalid frame from client')
+                continue
+            if frame.message is not None:
                 # Example message from client on connect
-                message = data_json['message']
+                message = frame.message
                 logger.info(f'Message from client was: {message}')
                 await websocket_chat_manager.send_personal_json({'message': 'Hello from server!'}, websocket)
-            elif 'tryToConnectUser' in data_json:
+            elif frame.tryToConnectUser is not None:
                 # Client is trying to join chat
-                name = data_json['tryToConnectUser']
+                name = frame.tryToConnectUser
                 logger.info(f'User is trying to connect with username: {name}')
-                if not websocket_chat_manager.name_taken(name):
+                if websocket_chat_manager.username_of(websocket) is not None:
+                    await websocket_chat_manager.send_personal_json({'error': 'alreadyConnected'}, websocket)
+                elif await websocket_chat_manager.reserve_username(name):
                     logger.info(f'Name was not yet taken! Accepting user: {name}')
                     await websocket_chat_manager.connect_username(name, websocket)
 
                 else:
                     await websocket_chat_manager.send_personal_json({'error': 'usernameTaken'}, websocket)
-            elif 'sendChatMessage' in data_json:
+            elif frame.sendChatMessage is not None:
                 # Client wrote a message
-                message_data = data_json['sendChatMessage']
-                author = message_data['author']
-                if websocket_chat_manager.verify(author, websocket):
-                    message = message_data['message']
-                    logger.info(f'Broadcasting new message from {author}: {message}')
-                    await websocket_chat_manager.broadcast_new_message(
-                        ChatMessage(
-                            # timestamp=message_data["timestamp"],
-                            timestamp=time.time(),
-                            author=author,
-                            message=message,
-                        ),
-                    )
+                author = frame.sendChatMessage.author
+                room_name = frame.sendChatMessage.room or DEFAULT_ROOM
+                if not websocket_chat_manager.verify(author, websocket):
+                    continue
+                if not websocket_chat_manager.in_room(room_name, websocket):
+                    await websocket_chat_manager.send_personal_json({'error': 'notInRoom'}, websocket)
+                    continue
+                if not websocket_chat_manager.admit_message(author):
+                    await websocket_chat_manager.send_personal_json({'error': RATE_LIMITED}, websocket)
+                    continue
+                message = frame.sendChatMessage.message
+                chat_message_log.info('Broadcasting new message from {} in {}: {}', author, room_name, message)
+                await websocket_chat_manager.broadcast_new_message(
+                    ChatMessage(
+                        timestamp=time.time(),
+                        author=author,
+                        message=message,
+                    ),
+                    room_name,
+                )
+            elif frame.requestHistory is not None:
+                # Client scrolled up and wants older messages
+                await websocket_chat_manager.send_history_page(frame.requestHistory, websocket)
+            elif frame.joinRoom is not None:
+                # Only users with a username may join rooms, the room history is the response
+                if websocket_chat_manager.username_of(websocket) is None:
+                    await websocket_chat_manager.send_personal_json({'error': 'notConnected'}, websocket)
+                    continue
+                error = websocket_chat_manager.join_error(frame.joinRoom, websocket)
+                if error is not None:
+                    await websocket_chat_manager.send_personal_json({'error': error}, websocket)
+                else:
+                    await websocket_chat_manager.join_room(frame.joinRoom, websocket)
+            elif frame.leaveRoom is not None:
+                await websocket_chat_manager.leave_room(frame.leaveRoom, websocket)
+            elif frame.pong is not None:
+                # Answer to a ping, receiving it already marked the connection as alive
+                pass
 
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Also after an unexpected error, so the connection and the username are never leaked
         await websocket_chat_manager.disconnect(websocket)
         name = await websocket_chat_manager.disconnect_username(websocket=websocket)
         logger.info(f'Username disconnected: {name}!')
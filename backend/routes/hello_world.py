@@ -1,5 +1,3 @@
-import asyncio
-
 from fastapi.routing import APIRouter
 from loguru import logger
 
@@ -12,7 +10,5 @@ def hello_world():
 
 
 async def background_task_function(my_text: str, other_text: str = ' something!'):
-    """A background function that gets called once"""
-    while 1:
-        await asyncio.sleep(60 * 60)
-        logger.info(f'Repeated {my_text}{other_text}')
+    """A background job that is run every hour by the scheduler"""
+    logger.info(f'Repeated {my_text}{other_text}')
@@ -0,0 +1,12 @@
+from fastapi.routing import APIRouter
+from starlette.responses import Response
+
+from backend.metrics import CONTENT_TYPE, metrics_registry
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get('/metrics')
+def metrics():
+    """ All metrics in the prometheus text format """
+    return Response(metrics_registry.render(), media_type=CONTENT_TYPE)
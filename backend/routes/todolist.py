@@ -1,64 +1,269 @@
+import json
 import os
-import sqlite3
 from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
 
-from fastapi import Request
+from fastapi import Header, HTTPException, Query, Request, Response, WebSocket
+from fastapi.responses import StreamingResponse
 from fastapi.routing import APIRouter
 from loguru import logger
 
+from backend.logging_config import SampledEvent
+from backend.metrics import metrics_registry
+from backend.todo.cache import ListingCache, etag_matches
+from backend.todo.database import SQLITE_PROFILES, PoolTimeoutError
+from backend.todo.feed import TodoChangeFeed
+from backend.todo.repository import Todo, TodoRepository
+from backend.todo.sqlite_repository import SQLiteTodoRepository
+
 ENV = os.environ.copy()
 USE_MONGO_DB: bool = ENV.get('USE_MONGO_DB', 'True') == 'True'
 USE_POSTGRES_DB: bool = ENV.get('USE_POSTGRES_DB', 'True') == 'True'
 USE_LOCAL_SQLITE_DB: bool = ENV.get('USE_LOCAL_SQLITE_DB', 'True') == 'True'
+# Where todos are stored: 'sqlite', 'postgres' or 'mongo'
+TODO_BACKEND: str = ENV.get('TODO_BACKEND', 'sqlite')
 SQLITE_FILENAME: str = ENV.get('SQLITE_FILENAME', 'todos.db')
+POSTGRES_DSN: str = ENV.get('POSTGRES_DSN', 'host=localhost port=5432 user=postgres password=changeme')
+MONGO_URL: str = ENV.get('MONGO_URL', 'mongodb://localhost:27017')
+MONGO_DATABASE: str = ENV.get('MONGO_DATABASE', 'todos')
+# Pragmas of the sqlite connections, see SQLITE_PROFILES: 'fast' (WAL, synchronous=NORMAL, mmap) or 'safe'
+TODO_SQLITE_PROFILE: str = ENV.get('TODO_SQLITE_PROFILE', 'fast')
+# Number of database connections and threads serving the todo routes, sqlite uses one extra writer connection
+TODO_DB_POOL_SIZE: int = int(ENV.get('TODO_DB_POOL_SIZE', '4'))
+# Seconds a request waits for a free connection before failing with 503
+TODO_DB_POOL_TIMEOUT: float = float(ENV.get('TODO_DB_POOL_TIMEOUT', '5'))
+# Seconds sqlite waits for a lock held by another connection
+TODO_DB_BUSY_TIMEOUT: float = float(ENV.get('TODO_DB_BUSY_TIMEOUT', '5'))
+# Largest page returned by GET /api?limit=
+TODO_PAGE_SIZE_MAX: int = int(ENV.get('TODO_PAGE_SIZE_MAX', '1000'))
+# Rows fetched per query while streaming GET /api?stream=
+TODO_STREAM_BATCH_SIZE: int = int(ENV.get('TODO_STREAM_BATCH_SIZE', '500'))
+# Milliseconds single item writes wait to be committed together with other writes, 0 commits every write on its own
+TODO_WRITE_COALESCE_MS: float = float(ENV.get('TODO_WRITE_COALESCE_MS', '0'))
+TODO_WRITE_COALESCE_MAX_BATCH: int = int(ENV.get('TODO_WRITE_COALESCE_MAX_BATCH', '500'))
+# Default and largest number of results of GET /api_search
+TODO_SEARCH_LIMIT: int = int(ENV.get('TODO_SEARCH_LIMIT', '20'))
+TODO_SEARCH_LIMIT_MAX: int = int(ENV.get('TODO_SEARCH_LIMIT_MAX', '100'))
+# Number of cached GET /api listings (pages count separately), 0 disables the cache
+TODO_CACHE_SIZE: int = int(ENV.get('TODO_CACHE_SIZE', '128'))
+# Seconds a cached listing is served, bounds how long other workers serve a listing after a write
+TODO_CACHE_TTL: float = float(ENV.get('TODO_CACHE_TTL', '5'))
+# Number of recent changes kept for /todows clients that resume
+TODO_FEED_HISTORY_SIZE: int = int(ENV.get('TODO_FEED_HISTORY_SIZE', '10000'))
+# Frames queued per /todows client before it is disconnected as too slow
+TODO_FEED_SEND_QUEUE_SIZE: int = int(ENV.get('TODO_FEED_SEND_QUEUE_SIZE', '256'))
 # TODO use different database tables when using stage = dev/staging/prod
 
 todo_list_router = APIRouter()
-db: Optional[sqlite3.Connection] = None
+repository: Optional[TodoRepository] = None
+listing_cache = ListingCache(max_entries=TODO_CACHE_SIZE, ttl=TODO_CACHE_TTL)
+# Per worker process, only correct with a single worker, see backend/todo/feed.py
+todo_feed = TodoChangeFeed(history_size=TODO_FEED_HISTORY_SIZE, send_queue_size=TODO_FEED_SEND_QUEUE_SIZE)
+# One log line per insert or delete, can be sampled with LOG_SAMPLE_RATES
+todo_insert_log = SampledEvent('todo_insert')
+todo_delete_log = SampledEvent('todo_delete')
+metrics_registry.gauge('todo_feed_connections', 'Open /todows connections', function=lambda: len(todo_feed))
+metrics_registry.counter(
+    'todo_feed_frames_sent_total',
+    'Frames sent to /todows connections',
+    function=lambda: todo_feed.broadcast_engine.sent_frames,
+)
+T = TypeVar('T')
+
 
-# TODO Communicate with postgresql and mongodb
+def create_repository() -> TodoRepository:
+    if TODO_BACKEND == 'sqlite':
+        return SQLiteTodoRepository(
+            Path(__file__).parent.parent / 'data' / SQLITE_FILENAME,
+            pool_size=TODO_DB_POOL_SIZE,
+            acquire_timeout=TODO_DB_POOL_TIMEOUT,
+            busy_timeout=TODO_DB_BUSY_TIMEOUT,
+            profile=SQLITE_PROFILES[TODO_SQLITE_PROFILE],
+            write_coalesce_window=TODO_WRITE_COALESCE_MS / 1000,
+            write_coalesce_max_batch=TODO_WRITE_COALESCE_MAX_BATCH,
+        )
+    # Imported here so the drivers are only required when the backend is used
+    if TODO_BACKEND == 'postgres':
+        from backend.todo.postgres_repository import PostgresTodoRepository
+        return PostgresTodoRepository(POSTGRES_DSN, pool_size=TODO_DB_POOL_SIZE, acquire_timeout=TODO_DB_POOL_TIMEOUT)
+    if TODO_BACKEND == 'mongo':
+        from backend.todo.mongo_repository import MongoTodoRepository
+        return MongoTodoRepository(
+            MONGO_URL,
+            database=MONGO_DATABASE,
+            pool_size=TODO_DB_POOL_SIZE,
+            acquire_timeout=TODO_DB_POOL_TIMEOUT,
+        )
+    raise ValueError(f'Unknown todo backend: {TODO_BACKEND!r}, choose one of: sqlite, postgres, mongo')
 
 
-def get_db() -> Optional[sqlite3.Connection]:
-    return db
+async def create_database_if_not_exist():
+    # pylint: disable=W0603
+    global repository
+    repository = create_repository()
+    await repository.open()
+    listing_cache.clear()
 
 
-def create_database_if_not_exist():
+async def close_database():
     # pylint: disable=W0603
-    global db
-    todos_db = Path(__file__).parent.parent / 'data' / SQLITE_FILENAME
-    if not todos_db.is_file():
-        os.makedirs(todos_db.parent, exist_ok=True)
-        db = sqlite3.connect(todos_db)
-        db.execute('CREATE TABLE todos (id INTEGER PRIMARY KEY AUTOINCREMENT, task TEXT)')
-        db.commit()
-        logger.info(f'Created new database: {todos_db.name}')
-    else:
-        db = sqlite3.connect(todos_db)
+    global repository
+    if repository is not None:
+        await repository.close()
+        repository = None
+
+
+async def storage_call(method: Callable[..., Awaitable[T]], *args: Any) -> T:
+    """ Calls a repository method, fails with 503 if no database connection became available in time """
+    try:
+        return await method(*args)
+    except PoolTimeoutError as e:
+        logger.warning(str(e))
+        raise HTTPException(status_code=503, detail='Database busy') from e
+
+
+# All writes go through these functions, so the cached listings containing the changed ids are dropped
+# and the changes are published to the /todows subscribers
+
+
+async def insert_todo(task: str) -> int:
+    assert repository is not None
+    todo_id = await storage_call(repository.insert, task)
+    listing_cache.invalidate([todo_id])
+    todo_feed.publish_inserts([{'id': todo_id, 'content': task}])
+    return todo_id
+
+
+async def insert_todos(tasks: List[str]) -> List[int]:
+    assert repository is not None
+    todo_ids = await storage_call(repository.insert_many, tasks)
+    listing_cache.invalidate(todo_ids)
+    todo_feed.publish_inserts([{'id': todo_id, 'content': task} for todo_id, task in zip(todo_ids, tasks)])
+    return todo_ids
+
+
+async def delete_todo(todo_id: int) -> int:
+    assert repository is not None
+    try:
+        deleted = await storage_call(repository.delete, todo_id)
+    finally:
+        listing_cache.invalidate([todo_id])
+    if deleted:
+        todo_feed.publish_deletes([todo_id])
+    return deleted
+
+
+async def delete_todos(todo_ids: List[int]) -> int:
+    assert repository is not None
+    try:
+        deleted = await storage_call(repository.delete_many, todo_ids)
+    finally:
+        listing_cache.invalidate(todo_ids)
+    if deleted:
+        # Repositories only count the deleted todos, subscribers ignore ids they do not know
+        todo_feed.publish_deletes(todo_ids)
+    return deleted
+
+
+class TodoStreamFormat(str, Enum):
+    # One JSON object per line
+    NDJSON = 'ndjson'
+    # A regular JSON array, sent in chunks
+    JSON = 'json'
+
+
+async def iterate_todos(after_id: int = 0) -> AsyncIterator[List[Todo]]:
+    """ Yields all todos after 'after_id' in batches, only one batch is held in memory at a time """
+    if repository is None:
+        return
+    try:
+        async for batch in repository.iterate(after_id, TODO_STREAM_BATCH_SIZE):
+            yield batch
+    except PoolTimeoutError as e:
+        # The response already started, the client sees a truncated stream
+        logger.warning(str(e))
+
+
+async def _stream_ndjson(after_id: int) -> AsyncIterator[str]:
+    async for batch in iterate_todos(after_id):
+        yield ''.join(f'{json.dumps(todo)}\n' for todo in batch)
+
+
+async def _stream_json_array(after_id: int) -> AsyncIterator[str]:
+    separator = '['
+    async for batch in iterate_todos(after_id):
+        yield separator + ','.join(json.dumps(todo) for todo in batch)
+        separator = ','
+    yield ']' if separator == ',' else '[]'
 
 
 @todo_list_router.get('/api')
-async def show_all_todos() -> List[Dict[str, str]]:
-    todos = []
-    if db:
-        for row in db.execute('SELECT id, task FROM todos'):
-            todos.append({
-                'id': row[0],
-                'content': row[1],
-            })
-    return todos
+async def show_all_todos(
+    after_id: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    stream: Optional[TodoStreamFormat] = None,
+    if_none_match: Optional[str] = Header(None),
+):
+    """
+    Without parameters all todos are returned.
+    /api?after_id=<last id of previous page>&limit=<page size> returns one page, the 'X-Next-After-Id' header is set
+    if there may be more todos.
+    /api?stream=ndjson or /api?stream=json streams all todos without loading them into memory at once.
+    Listings carry an ETag, a request with a matching If-None-Match header gets an empty 304 response.
+    """
+    if stream == TodoStreamFormat.NDJSON:
+        return StreamingResponse(_stream_ndjson(after_id), media_type='application/x-ndjson')
+    if stream == TodoStreamFormat.JSON:
+        return StreamingResponse(_stream_json_array(after_id), media_type='application/json')
+    if not repository:
+        return []
+    page_size: Optional[int] = None
+    if limit is not None or after_id != 0:
+        page_size = min(limit or TODO_PAGE_SIZE_MAX, TODO_PAGE_SIZE_MAX)
+    key = (after_id, page_size)
+    listing = listing_cache.get(key)
+    if listing is None:
+        generation = listing_cache.generation
+        if page_size is None:
+            todos = await storage_call(repository.list_todos)
+        else:
+            todos = await storage_call(repository.list_page, after_id, page_size)
+        listing = listing_cache.put(key, todos, generation)
+    # Browsers have to revalidate, which is cheap thanks to the ETag
+    headers = {'ETag': listing.etag, 'Cache-Control': 'no-cache'}
+    if not listing.complete and listing.last_id is not None:
+        headers['X-Next-After-Id'] = str(listing.last_id)
+    if etag_matches(if_none_match, listing.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(listing.body, media_type='application/json', headers=headers)
+
+
+@todo_list_router.get('/api_search')
+async def search_todos(
+    q: str = Query(..., max_length=200),
+    limit: int = Query(TODO_SEARCH_LIMIT, ge=1),
+) -> List[Todo]:
+    """
+    Full text search, /api_search?q=buy mil returns the todos containing words starting with 'buy' and 'mil',
+    best matches first.
+    """
+    if not repository:
+        return []
+    try:
+        return await storage_call(repository.search, q, min(limit, TODO_SEARCH_LIMIT_MAX))
+    except NotImplementedError as e:
+        raise HTTPException(status_code=501, detail=f'Search is not supported by the {repository.name} backend') from e
 
 
 @todo_list_router.post('/api/{todo_description}')
 async def create_new_todo(todo_description: str):
     # https://fastapi.tiangolo.com/advanced/using-request-directly/
     if todo_description:
-        logger.info(f'Attempting to insert new todo: {todo_description}')
-        if db:
-            db.execute('INSERT INTO todos (task) VALUES (?)', [todo_description])
-            db.commit()
+        todo_insert_log.info('Attempting to insert new todo: {}', todo_description)
+        if repository:
+            await insert_todo(todo_description)
 
 
 # Alternative to above with request body:
@@ -72,10 +277,9 @@ async def create_new_todo2(request: Request):
     request_body = await request.json()
     todo_item = request_body.get('new_todo', None)
     if todo_item:
-        logger.info(f'Attempting to insert new todo: {todo_item}')
-        if db:
-            db.execute('INSERT INTO todos (task) VALUES (?)', [todo_item])
-            db.commit()
+        todo_insert_log.info('Attempting to insert new todo: {}', todo_item)
+        if repository:
+            await insert_todo(todo_item)
 
 
 @dataclass()
@@ -91,18 +295,72 @@ async def create_new_todo3(item: Item):
     Send a request with body {"todo_description": "<todo task description>"}
     """
     # https://fastapi.tiangolo.com/tutorial/body/#import-pydantics-basemodel
-    logger.info(f'Received item: {item}')
+    todo_insert_log.debug('Received item: {}', item)
     if item and item.todo_description:
-        logger.info(f'Attempting to insert new todo: {item.todo_description}')
-        if db:
-            db.execute('INSERT INTO todos (task) VALUES (?)', [item.todo_description])
-            db.commit()
+        todo_insert_log.info('Attempting to insert new todo: {}', item.todo_description)
+        if repository:
+            await insert_todo(item.todo_description)
 
 
 @todo_list_router.delete('/api/{todo_id}')
 async def remove_todo(todo_id: int):
     """ Example of using /api/itemid with DELETE request """
-    logger.info(f'Attempting to remove todo id: {todo_id}')
-    if db:
-        db.execute('DELETE FROM todos WHERE id==(?)', [todo_id])
-        db.commit()
+    todo_delete_log.info('Attempting to remove todo id: {}', todo_id)
+    if repository:
+        await delete_todo(todo_id)
+
+
+@dataclass()
+class BulkCreateTodos:
+    todos: List[str]
+
+
+@dataclass()
+class BulkDeleteTodos:
+    ids: List[int]
+
+
+@todo_list_router.post('/api_bulk')
+async def create_new_todos(bulk: BulkCreateTodos) -> Dict[str, List[int]]:
+    """
+    Inserts many todos in a single transaction.
+    Send a request with body {"todos": ["<todo task description>", ...]}, returns {"ids": [<new todo id>, ...]}
+    in the order of the request. Requests with an empty task are rejected as a whole.
+    """
+    empty = [index for index, task in enumerate(bulk.todos) if not task]
+    if empty:
+        raise HTTPException(status_code=422, detail=f'Empty todos at positions {empty}')
+    todo_insert_log.info('Attempting to insert {} new todos', len(bulk.todos))
+    if not repository or not bulk.todos:
+        return {'ids': []}
+    return {'ids': await insert_todos(bulk.todos)}
+
+
+@todo_list_router.delete('/api_bulk')
+async def remove_todos(bulk: BulkDeleteTodos) -> Dict[str, int]:
+    """
+    Deletes many todos in a single transaction.
+    Send a request with body {"ids": [<todo id>, ...]}, returns {"deleted": <number of deleted todos>}
+    """
+    todo_delete_log.info('Attempting to remove {} todos', len(bulk.ids))
+    if not repository or not bulk.ids:
+        return {'deleted': 0}
+    return {'deleted': await delete_todos(bulk.ids)}
+
+
+@todo_list_router.websocket('/todows')
+async def todo_feed_endpoint(websocket: WebSocket, epoch: Optional[str] = None, since: Optional[int] = None):
+    """
+    Live todo changes, see backend/todo/feed.py for the frames.
+    Reconnect with /todows?epoch=<epoch>&since=<last seen seq> to resume.
+    """
+    await websocket.accept()
+    todo_feed.subscribe(websocket, epoch, since)
+    try:
+        while 1:
+            # Clients do not send anything, this only waits for the disconnect
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+    finally:
+        todo_feed.unsubscribe(websocket)
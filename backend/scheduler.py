@@ -0,0 +1,221 @@
+"""
+Background jobs of the app: periodic and delayed jobs with jitter, limited concurrency and supervised retries.
+Jobs are async functions awaited on the event loop, or plain functions run in a thread or process pool so CPU heavy or
+blocking work does not delay request handling.
+The scheduler is started and stopped by the startup and shutdown hooks in backend/main.py.
+"""
+import asyncio
+import enum
+import os
+import random
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from loguru import logger
+
+from backend.metrics import JOB_BUCKETS, metrics_registry
+
+ENV = os.environ.copy()
+# Jobs that may run at the same time, further jobs wait until a running job finished
+SCHEDULER_MAX_CONCURRENCY: int = int(ENV.get('SCHEDULER_MAX_CONCURRENCY', '4'))
+# Threads for jobs that run in the thread pool
+SCHEDULER_THREAD_WORKERS: int = int(ENV.get('SCHEDULER_THREAD_WORKERS', '4'))
+# Processes for CPU heavy jobs that run in the process pool
+SCHEDULER_PROCESS_WORKERS: int = int(ENV.get('SCHEDULER_PROCESS_WORKERS', '2'))
+
+job_duration = metrics_registry.histogram(
+    'scheduler_job_duration_seconds',
+    'Duration of scheduled job runs',
+    ('job', ),
+    buckets=JOB_BUCKETS,
+)
+job_runs = metrics_registry.counter('scheduler_job_runs_total', 'Finished scheduled job runs', ('job', 'result'))
+
+
+class JobExecutor(enum.Enum):
+    # The function is a coroutine function awaited on the event loop
+    ASYNC = 'async'
+    # The function is a plain function run in the thread pool, for blocking IO
+    THREAD = 'thread'
+    # The function is a plain, picklable function run in the process pool, for CPU heavy work
+    PROCESS = 'process'
+
+
+@dataclass
+class Job:
+    name: str
+    function: Callable[..., Any]
+    # Seconds between the end of a run and the start of the next one, None runs the job once
+    interval: Optional[float] = None
+    # Seconds before the first run
+    delay: float = 0
+    # Up to this many seconds are added to every wait, so the jobs of several workers do not run at the same time
+    jitter: float = 0
+    executor: JobExecutor = JobExecutor.ASYNC
+    # A failed run is retried after this many seconds, doubled for every further failure, at most 'interval'
+    retry_delay: float = 1
+    # Jobs that run once give up after this many failed runs
+    max_attempts: int = 3
+    args: Tuple[Any, ...] = ()
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+    runs: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    # Seconds
+    last_duration: Optional[float] = None
+    running: bool = False
+
+
+class JobScheduler:
+    def __init__(
+        self,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        thread_workers: int = SCHEDULER_THREAD_WORKERS,
+        process_workers: int = SCHEDULER_PROCESS_WORKERS,
+    ):
+        self.max_concurrency = max_concurrency
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+        self.jobs: Dict[str, Job] = {}
+        # The supervising task of every job while the scheduler runs
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.running: bool = False
+        # Created on start, so they belong to the running event loop
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # Created on first use
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+
+    def add_job(self, job: Job) -> Job:
+        if job.name in self.jobs:
+            raise ValueError(f'A job named {job.name!r} is already scheduled')
+        self.jobs[job.name] = job
+        if self.running:
+            self._start_task(job)
+        return job
+
+    def add_periodic(
+        self,
+        name: str,
+        function: Callable[..., Any],
+        interval: float,
+        delay: Optional[float] = None,
+        **options: Any,
+    ) -> Job:
+        """ Runs the job every 'interval' seconds, the first run is after 'delay' seconds which defaults to 'interval' """
+        return self.add_job(Job(name, function, interval=interval, delay=interval if delay is None else delay, **options))
+
+    def add_delayed(self, name: str, function: Callable[..., Any], delay: float, **options: Any) -> Job:
+        """ Runs the job once after 'delay' seconds """
+        return self.add_job(Job(name, function, delay=delay, **options))
+
+    def remove_job(self, name: str):
+        self.jobs.pop(name)
+        task = self.tasks.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+    def start(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.running = True
+        for job in self.jobs.values():
+            self._start_task(job)
+
+    async def stop(self):
+        """ Cancels all jobs, runs in threads or processes can not be interrupted and finish in the background """
+        self.running = False
+        tasks = list(self.tasks.values())
+        self.tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for pool in (self._thread_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=False)
+        self._thread_pool = None
+        self._process_pool = None
+
+    def _start_task(self, job: Job):
+        task = asyncio.ensure_future(self._supervise(job))
+        self.tasks[job.name] = task
+        task.add_done_callback(lambda task: self._task_done(job, task))
+
+    def _task_done(self, job: Job, task: 'asyncio.Task[None]'):
+        if task.cancelled() or self.tasks.get(job.name) is not task:
+            return
+        self.tasks.pop(job.name)
+        exception = task.exception()
+        if exception is None or not self.running:
+            return
+        # Failed runs are handled in _supervise(), this is a bug in the scheduler itself
+        logger.opt(exception=exception).error(f'Supervisor of job {job.name} crashed, restarting it')
+        asyncio.get_event_loop().call_later(job.retry_delay, self._restart, job)
+
+    def _restart(self, job: Job):
+        if self.running and self.jobs.get(job.name) is job and job.name not in self.tasks:
+            self._start_task(job)
+
+    async def _supervise(self, job: Job):
+        wait = job.delay
+        while 1:
+            await asyncio.sleep(wait + random.uniform(0, job.jitter))
+            if await self.run_job(job):
+                if job.interval is None:
+                    return
+                wait = job.interval
+                continue
+            if job.interval is None and job.consecutive_failures >= job.max_attempts:
+                logger.error(f'Job {job.name} failed {job.consecutive_failures} times, giving up')
+                return
+            wait = job.retry_delay * 2**(job.consecutive_failures - 1)
+            if job.interval is not None:
+                wait = min(wait, job.interval)
+
+    def _executor(self, kind: JobExecutor) -> Executor:
+        if kind == JobExecutor.THREAD:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(self.thread_workers, thread_name_prefix='scheduler')
+            return self._thread_pool
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(self.process_workers)
+        return self._process_pool
+
+    async def run_job(self, job: Job) -> bool:
+        """ Runs the job once, returns whether it succeeded """
+        assert self._semaphore is not None, 'JobScheduler.start() was not called'
+        async with self._semaphore:
+            job.running = True
+            start = time.perf_counter()
+            try:
+                if job.executor == JobExecutor.ASYNC:
+                    await job.function(*job.args, **job.kwargs)
+                else:
+                    function = job.function
+                    if job.kwargs:
+                        # run_in_executor() does not pass keyword arguments
+                        function = partial(function, **job.kwargs)
+                    loop = asyncio.get_event_loop()
+                    await loop.run_in_executor(self._executor(job.executor), function, *job.args)
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=W0703
+                logger.exception(f'Job {job.name} failed')
+                job.failures += 1
+                job.consecutive_failures += 1
+                result = 'failure'
+            else:
+                job.consecutive_failures = 0
+                result = 'success'
+            finally:
+                job.running = False
+            job.last_duration = time.perf_counter() - start
+            job.runs += 1
+            job_duration.observe(job.last_duration, (job.name, ))
+            job_runs.inc(labels=(job.name, result))
+            return result == 'success'
+
+
+scheduler = JobScheduler()
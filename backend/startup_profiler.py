@@ -0,0 +1,129 @@
+"""
+Startup profiler for backend.main, run with:
+poetry run python -m backend.startup_profiler [--top 20]
+Reports the import time per package and module, measured with 'python -X importtime' in a fresh interpreter,
+and the duration of every startup and shutdown hook. The hooks run for real, e.g. the todo database is created.
+Set STARTUP_PROFILE=True to log the hook durations of a server started with uvicorn.
+"""
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from fastapi import FastAPI
+from loguru import logger
+
+ROOT_FOLDER = Path(__file__).parent.parent
+
+
+@dataclass
+class ImportTiming:
+    module: str
+    # Microseconds spent in the module body itself
+    self_us: int
+    # Microseconds including the modules it imported
+    cumulative_us: int
+
+
+def parse_importtime(output: str) -> List[ImportTiming]:
+    """ Parses the 'import time: self [us] | cumulative | imported package' lines of python -X importtime """
+    timings = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        timings.append(ImportTiming(module.strip(), int(self_us), int(cumulative_us)))
+    return timings
+
+
+def measure_imports(module: str = 'backend.main') -> List[ImportTiming]:
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT_FOLDER,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parse_importtime(result.stderr)
+
+
+def import_time_by_package(timings: List[ImportTiming]) -> Dict[str, int]:
+    """ Microseconds per top level package, sorted by the most expensive package """
+    packages: Dict[str, int] = {}
+    for timing in timings:
+        package = timing.module.split('.')[0]
+        packages[package] = packages.get(package, 0) + timing.self_us
+    return dict(sorted(packages.items(), key=lambda item: item[1], reverse=True))
+
+
+def _timed(name: str, hook: Callable, durations: Dict[str, float]) -> Callable:
+    if asyncio.iscoroutinefunction(hook):
+
+        @wraps(hook)
+        async def async_wrapper():
+            start = time.perf_counter()
+            try:
+                await hook()
+            finally:
+                durations[name] = time.perf_counter() - start
+                logger.info(f'Hook {name} took {durations[name] * 1000:.1f} ms')
+
+        return async_wrapper
+
+    @wraps(hook)
+    def wrapper():
+        start = time.perf_counter()
+        try:
+            hook()
+        finally:
+            durations[name] = time.perf_counter() - start
+            logger.info(f'Hook {name} took {durations[name] * 1000:.1f} ms')
+
+    return wrapper
+
+
+def profile_hooks(app: FastAPI) -> Dict[str, float]:
+    """ Times every startup and shutdown hook registered so far, the returned dict is filled when they run """
+    durations: Dict[str, float] = {}
+    router = app.router
+    router.on_startup = [_timed(f'startup:{hook.__name__}', hook, durations) for hook in router.on_startup]
+    router.on_shutdown = [_timed(f'shutdown:{hook.__name__}', hook, durations) for hook in router.on_shutdown]
+    return durations
+
+
+async def _run_hooks(app: FastAPI):
+    await app.router.startup()
+    await app.router.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='backend.main', help='Module that creates the app')
+    parser.add_argument('--top', type=int, default=20, help='Number of modules and packages to list')
+    args = parser.parse_args()
+
+    timings = measure_imports(args.module)
+    total_us = sum(timing.self_us for timing in timings)
+    print(f'Importing {args.module} took {total_us / 1000:.1f} ms ({len(timings)} modules)\n')
+    print(f'{"package":<40} {"ms":>8}')
+    for package, package_us in list(import_time_by_package(timings).items())[:args.top]:
+        print(f'{package:<40} {package_us / 1000:>8.1f}')
+    print(f'\n{"module":<60} {"self ms":>8} {"cumul ms":>9}')
+    for timing in sorted(timings, key=lambda timing: timing.self_us, reverse=True)[:args.top]:
+        print(f'{timing.module:<60} {timing.self_us / 1000:>8.1f} {timing.cumulative_us / 1000:>9.1f}')
+
+    module = __import__(args.module, fromlist=['app'])
+    durations = profile_hooks(module.app)
+    asyncio.run(_run_hooks(module.app))
+    print(f'\n{"hook":<60} {"ms":>8}')
+    for name, duration in durations.items():
+        print(f'{name:<60} {duration * 1000:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Encode and decode throughput of the chat codecs per message type, run with:
+poetry run pytest backend/test/test_benchmark_chat_codec.py --benchmark-group-by=func,param:frame_name
+"""
+from typing import Any, Dict, List
+
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+
+from backend.chat.binary_codec import BinaryCodec, encode_client_frame
+from backend.chat.codec import ChatCodec, Payload, StdlibCodec, available_codecs
+from backend.chat.history import HistoryRecord
+from backend.chat.protocol import HistoryPage
+
+CODECS: Dict[str, ChatCodec] = {**available_codecs(), BinaryCodec.name: BinaryCodec()}
+
+RECORDS: List[HistoryRecord] = [
+    HistoryRecord(i, 1_600_000_000.0 + i, f'author{i % 10}', f'some chat message number {i}') for i in range(100)
+]
+
+OUTBOUND_FRAMES: Dict[str, Any] = {
+    'newMessage': {'newMessage': RECORDS[0]},
+    'newMessageHistory': {'newMessageHistory': RECORDS},
+    'historyPage': {'historyPage': HistoryPage(messages=RECORDS, hasMore=True)},
+    'connectUser': {'connectUser': 'robot1'},
+}
+
+INBOUND_FRAMES: Dict[str, str] = {
+    'message': '{"message": "Hello from client!"}',
+    'tryToConnectUser': '{"tryToConnectUser": "robot1"}',
+    'sendChatMessage': '{"sendChatMessage": {"timestamp": 1600000000.0, "author": "robot1", "message": "bla blubb"}}',
+    'requestHistory': '{"requestHistory": {"beforeId": 1234, "limit": 50}}',
+}
+
+
+@pytest.mark.parametrize('codec_name', list(CODECS))
+@pytest.mark.parametrize('frame_name', list(OUTBOUND_FRAMES))
+def test_encode(benchmark: BenchmarkFixture, codec_name: str, frame_name: str):
+    codec = CODECS[codec_name]
+    frame = OUTBOUND_FRAMES[frame_name]
+    encoded = benchmark(codec.encode, frame)
+    if isinstance(encoded, str):
+        assert encoded.startswith(f'{{"{frame_name}":')
+
+
+@pytest.mark.parametrize('codec_name', list(CODECS))
+@pytest.mark.parametrize('frame_name', list(INBOUND_FRAMES))
+def test_decode(benchmark: BenchmarkFixture, codec_name: str, frame_name: str):
+    codec = CODECS[codec_name]
+    data: Payload = INBOUND_FRAMES[frame_name]
+    if isinstance(codec, BinaryCodec):
+        data = encode_client_frame(StdlibCodec().decode(data))
+    decoded = benchmark(codec.decode, data)
+    assert getattr(decoded, frame_name) is not None
@@ -0,0 +1,69 @@
+"""
+Join latency of the chat history replay, run with:
+poetry run pytest backend/test/test_benchmark_chat_history.py --benchmark-columns=min,mean,max
+"""
+import json
+from dataclasses import dataclass
+from functools import partial
+
+import pytest
+from dataclasses_json import DataClassJsonMixin
+from pytest_benchmark.fixture import BenchmarkFixture
+
+from backend.chat.codec import StdlibCodec
+from backend.chat.history import ChatHistory, HistorySnapshot
+
+HISTORY_SIZES = [1_000, 10_000, 100_000]
+
+
+@dataclass
+class LegacyChatMessage(DataClassJsonMixin):
+    """ How chat messages used to be serialized """
+    timestamp: float
+    author: str
+    message: str
+
+
+def create_history(amount: int) -> ChatHistory:
+    history = ChatHistory(max_size=amount)
+    for i in range(amount):
+        history.append(float(i), f'author{i % 100}', f'some chat message number {i}')
+    return history
+
+
+@pytest.mark.parametrize('amount', HISTORY_SIZES)
+def test_join_payload_to_dict(benchmark: BenchmarkFixture, amount: int):
+    """ Before: every join converted every message with dataclasses_json and serialized the result """
+    messages = [LegacyChatMessage(r.timestamp, r.author, r.message) for r in create_history(amount)]
+
+    def join():
+        return json.dumps({'newMessageHistory': [m.to_dict() for m in messages]})
+
+    payload = benchmark.pedantic(join, rounds=3)
+    assert len(json.loads(payload)['newMessageHistory']) == amount
+
+
+@pytest.mark.parametrize('amount', HISTORY_SIZES)
+def test_join_payload_snapshot(benchmark: BenchmarkFixture, amount: int):
+    """ After: joins reuse the cached snapshot """
+    codec = StdlibCodec()
+    snapshot = HistorySnapshot(amount, codec.encode_record, partial(codec.history_frame, room='general'))
+    snapshot.extend(create_history(amount))
+    payload = benchmark(lambda: snapshot.payload)
+    assert len(json.loads(payload)['newMessageHistory']) == amount
+
+
+@pytest.mark.parametrize('amount', HISTORY_SIZES)
+def test_join_payload_snapshot_after_new_message(benchmark: BenchmarkFixture, amount: int):
+    """ After: worst case, the first join after a new message has to rebuild the payload from the encoded fragments """
+    history = create_history(amount)
+    codec = StdlibCodec()
+    snapshot = HistorySnapshot(amount, codec.encode_record, partial(codec.history_frame, room='general'))
+    snapshot.extend(history)
+
+    def new_message_and_join():
+        snapshot.append(history.append(0, 'author', 'new message'))
+        return snapshot.payload
+
+    payload = benchmark.pedantic(new_message_and_join, rounds=3)
+    assert len(json.loads(payload)['newMessageHistory']) == amount
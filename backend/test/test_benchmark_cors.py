@@ -0,0 +1,64 @@
+"""
+CORS origin checks and preflight latency of the previous 65k entry origin list against CorsPolicy, run with:
+poetry run pytest backend/test/test_benchmark_cors.py --benchmark-group-by=func
+"""
+import subprocess
+import sys
+from pathlib import Path
+from typing import Callable
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from pytest_benchmark.fixture import BenchmarkFixture
+from starlette.middleware.cors import CORSMiddleware
+
+from backend.cors import CorsPolicy, CorsPolicyMiddleware
+
+LEGACY_ORIGINS = ['https://burnysc2.github.io'] + [f'http://localhost:{i}' for i in range(1, 2**16)]
+RULES = 'https://burnysc2.github.io,http://localhost:1-65535'
+ROOT_FOLDER = Path(__file__).parent.parent.parent
+
+
+def _legacy_app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(CORSMiddleware, allow_origins=LEGACY_ORIGINS, allow_credentials=True, allow_methods=['*'])
+    return app
+
+
+def _policy_app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(
+        CorsPolicyMiddleware,
+        policy=CorsPolicy.from_config(RULES),
+        allow_credentials=True,
+        allow_methods=['*'],
+    )
+    return app
+
+
+APPS = {'legacy_list': _legacy_app, 'policy': _policy_app}
+
+
+@pytest.mark.parametrize('app_name', list(APPS))
+def test_build_origins(benchmark: BenchmarkFixture, app_name: str):
+    if app_name == 'legacy_list':
+        benchmark(lambda: ['https://burnysc2.github.io'] + [f'http://localhost:{i}' for i in range(1, 2**16)])
+    else:
+        benchmark(CorsPolicy.from_config, RULES)
+
+
+@pytest.mark.parametrize('origin', ['https://burnysc2.github.io', 'http://localhost:65535', 'http://evil.com'])
+@pytest.mark.parametrize('app_name', list(APPS))
+def test_preflight(benchmark: BenchmarkFixture, app_name: str, origin: str):
+    create_app: Callable[[], FastAPI] = APPS[app_name]
+    client = TestClient(create_app())
+    headers = {'Origin': origin, 'Access-Control-Request-Method': 'POST'}
+    response = benchmark(client.options, '/', headers=headers)
+    assert response.status_code == (400 if 'evil' in origin else 200)
+
+
+def test_import_backend_main(benchmark: BenchmarkFixture):
+    # A fresh interpreter per round, so nothing is cached in sys.modules
+    command = [sys.executable, '-c', 'import backend.main']
+    benchmark.pedantic(subprocess.run, args=(command, ), kwargs={'cwd': ROOT_FOLDER, 'check': True}, rounds=3)
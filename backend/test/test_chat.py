@@ -0,0 +1,527 @@
+import asyncio
+import json
+import struct
+from typing import List
+
+import pytest
+from fastapi.testclient import TestClient
+
+from backend.chat.binary_codec import (
+    NEW_MESSAGE,
+    NEW_MESSAGE_HISTORY,
+    BinaryCodec,
+    decode_records,
+    encode_client_frame,
+)
+from backend.chat.broadcast import BroadcastEngine, SlowConsumerPolicy
+from backend.chat.codec import ChatCodec, FrameDecodeError, StdlibCodec, available_codecs
+from backend.chat.history import HistoryRecord
+from backend.chat.protocol import (
+    BINARY_SUBPROTOCOL,
+    JSON_SUBPROTOCOL,
+    HistoryPage,
+    InboundFrame,
+    RequestHistory,
+    SendChatMessage,
+)
+from backend.main import app
+from backend.routes.chat import WebsocketChatManager, websocket_chat_manager
+
+
+class FakeWebSocket:
+    """ Records sent frames, optionally blocks on send to simulate a slow client """
+    def __init__(self, block: bool = False):
+        self.sent: List[str] = []
+        self.closed_with: List[int] = []
+        self.unblock = asyncio.Event()
+        if not block:
+            self.unblock.set()
+
+    async def send_text(self, data: str):
+        await self.unblock.wait()
+        self.sent.append(data)
+
+    async def close(self, code: int = 1000):
+        self.closed_with.append(code)
+
+
+@pytest.mark.asyncio
+async def test_broadcast_reaches_all_connections():
+    engine = BroadcastEngine()
+    websockets = [FakeWebSocket() for _ in range(10)]
+    for ws in websockets:
+        engine.add(ws)
+    payload = json.dumps({'newMessage': 'hi'})
+    assert engine.broadcast(payload) == 10
+    await asyncio.sleep(0.01)
+    for ws in websockets:
+        assert ws.sent == [payload]
+    engine.close()
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_does_not_block_others():
+    engine = BroadcastEngine(max_queue_size=2, policy=SlowConsumerPolicy.DROP_OLDEST)
+    slow, fast = FakeWebSocket(block=True), FakeWebSocket()
+    engine.add(slow)
+    engine.add(fast)
+    for i in range(5):
+        engine.broadcast(str(i))
+        await asyncio.sleep(0)
+    await asyncio.sleep(0.01)
+    assert fast.sent == ['0', '1', '2', '3', '4']
+    assert slow.sent == []
+    # The slow client is still sending frame '0', only the newest 2 frames remain queued
+    slow.unblock.set()
+    await asyncio.sleep(0.01)
+    assert slow.sent == ['0', '3', '4']
+    assert engine.senders[id(slow)].dropped_frames == 2
+    engine.close()
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_disconnect_policy():
+    closed = []
+
+    async def on_close(websocket):
+        closed.append(websocket)
+
+    engine = BroadcastEngine(max_queue_size=1, policy=SlowConsumerPolicy.DISCONNECT, on_close=on_close)
+    slow = FakeWebSocket(block=True)
+    engine.add(slow)
+    for i in range(3):
+        engine.broadcast(str(i))
+        await asyncio.sleep(0)
+    slow.unblock.set()
+    await asyncio.sleep(0.01)
+    assert slow.closed_with == [1008]
+    assert closed == [slow]
+    assert slow not in engine
+
+
+@pytest.mark.asyncio
+async def test_send_error_closes_connection():
+    closed = []
+
+    async def on_close(websocket):
+        closed.append(websocket)
+
+    class ResetWebSocket(FakeWebSocket):
+        async def send_text(self, data: str):
+            raise ConnectionResetError()
+
+    engine = BroadcastEngine(on_close=on_close)
+    broken = ResetWebSocket()
+    engine.add(broken)
+    engine.broadcast('hi')
+    await asyncio.sleep(0.01)
+    assert closed == [broken]
+    assert broken not in engine
+
+
+def test_chat_websocket_endpoint():
+    client = TestClient(app)
+    with client.websocket_connect('/chatws') as ws1, client.websocket_connect('/chatws') as ws2:
+        ws1.send_text(json.dumps({'tryToConnectUser': 'robot1'}))
+        assert json.loads(ws1.receive_text()) == {'connectUser': 'robot1'}
+        assert 'newMessageHistory' in json.loads(ws1.receive_text())
+        ws2.send_text(json.dumps({'tryToConnectUser': 'robot1'}))
+        assert json.loads(ws2.receive_text()) == {'error': 'usernameTaken'}
+        ws2.send_text(json.dumps({'tryToConnectUser': 'robot2'}))
+        assert json.loads(ws2.receive_text()) == {'connectUser': 'robot2'}
+        assert json.loads(ws2.receive_text())['room'] == 'general'
+
+        ws1.send_text(json.dumps({'sendChatMessage': {'author': 'robot1', 'message': 'beep'}}))
+        for ws in (ws1, ws2):
+            new_message = json.loads(ws.receive_text())['newMessage']
+            assert new_message['author'] == 'robot1'
+            assert new_message['message'] == 'beep'
+
+
+def test_chat_history_pages():
+    client = TestClient(app)
+    with client.websocket_connect('/chatws') as ws:
+        ws.send_text(json.dumps({'tryToConnectUser': 'history_robot'}))
+        ws.receive_text()
+        ws.receive_text()
+        for i in range(3):
+            ws.send_text(json.dumps({'sendChatMessage': {'author': 'history_robot', 'message': f'm{i}'}}))
+            ws.receive_text()
+        ws.send_text(json.dumps({'requestHistory': {'since': 0, 'limit': 2}}))
+        page = json.loads(ws.receive_text())['historyPage']
+        assert len(page['messages']) == 2
+        last_id = page['messages'][-1]['id']
+        ws.send_text(json.dumps({'requestHistory': {'beforeId': last_id, 'limit': 1}}))
+        page = json.loads(ws.receive_text())['historyPage']
+        assert [m['id'] for m in page['messages']] == [last_id - 1]
+
+
+@pytest.mark.parametrize('codec', list(available_codecs().values()), ids=lambda codec: codec.name)
+def test_codec_roundtrip(codec: ChatCodec):
+    frame = codec.decode('{"sendChatMessage": {"timestamp": 1.5, "author": "robot1", "message": "beep"}}')
+    assert frame.sendChatMessage == SendChatMessage(author='robot1', message='beep')
+    assert frame.tryToConnectUser is None
+    frame = codec.decode('{"requestHistory": {"beforeId": 5}}')
+    assert frame.requestHistory == RequestHistory(beforeId=5)
+
+    record = HistoryRecord(1, 1.5, 'robot1', 'beep')
+    assert json.loads(codec.encode({'newMessage': record})) == {'newMessage': record.to_dict()}
+    page = HistoryPage(messages=[record], hasMore=False)
+    assert json.loads(codec.encode({'historyPage': page})) == {
+        'historyPage': {
+            'messages': [record.to_dict()],
+            'hasMore': False,
+            'room': 'general',
+        },
+    }
+
+
+@pytest.mark.parametrize('codec', list(available_codecs().values()), ids=lambda codec: codec.name)
+def test_codec_invalid_frames(codec: ChatCodec):
+    invalid_frames = [
+        'not json',
+        '[1, 2]',
+        '{"sendChatMessage": {"author": "robot1"}}',
+        # Fields of the wrong type
+        '{"joinRoom": ["general"]}',
+        '{"tryToConnectUser": {"name": "robot1"}}',
+        '{"sendChatMessage": {"author": "robot1", "message": 5}}',
+        '{"sendChatMessage": "beep"}',
+        '{"requestHistory": {"limit": "5"}}',
+        '{"requestHistory": {"since": "yesterday"}}',
+    ]
+    for data in invalid_frames:
+        with pytest.raises(FrameDecodeError):
+            codec.decode(data)
+
+
+def test_binary_codec_roundtrip():
+    codec = BinaryCodec()
+    frames = [
+        InboundFrame(message='Hello from client!'),
+        InboundFrame(tryToConnectUser='robot1'),
+        InboundFrame(sendChatMessage=SendChatMessage(author='robot1', message='beep ü')),
+        InboundFrame(requestHistory=RequestHistory(beforeId=5, limit=10)),
+        InboundFrame(requestHistory=RequestHistory(since=1.5)),
+        InboundFrame(pong=1600000000.5),
+    ]
+    for frame in frames:
+        assert codec.decode(encode_client_frame(frame)) == frame
+    assert codec.encode({'ping': 1.5}) == b'\x08' + struct.pack('<d', 1.5)
+    for data in [b'', b'\x13\xff\xff\xff\xff', b'\x13\x05ab', b'\x7f', 'text']:
+        with pytest.raises(FrameDecodeError):
+            codec.decode(data)
+
+    records = [HistoryRecord(1, 1.5, 'robot1', 'beep'), HistoryRecord(2, 2.5, 'robot2', 'boop')]
+    encoded = codec.history_frame([codec.encode_record(r) for r in records], 'general')
+    assert encoded[0] == NEW_MESSAGE_HISTORY
+    assert decode_records(encoded, 10, count=2) == (records, len(encoded))
+    # The binary form is a lot smaller than JSON
+    json_codec = StdlibCodec()
+    assert len(encoded) < len(json_codec.history_frame([json_codec.encode_record(r) for r in records], 'general')) / 2
+
+
+def test_chat_websocket_binary_subprotocol():
+    client = TestClient(app)
+    with client.websocket_connect('/chatws', subprotocols=[BINARY_SUBPROTOCOL]) as binary_ws, \
+            client.websocket_connect('/chatws') as json_ws:
+        assert binary_ws.accepted_subprotocol == BINARY_SUBPROTOCOL
+        json_ws.send_text(json.dumps({'tryToConnectUser': 'json_robot'}))
+        json_ws.receive_text()
+        json_ws.receive_text()
+        binary_ws.send_bytes(encode_client_frame(InboundFrame(tryToConnectUser='binary_robot')))
+        assert binary_ws.receive_bytes() == b'\x04\x0cbinary_robot'
+        assert binary_ws.receive_bytes()[0] == NEW_MESSAGE_HISTORY
+        binary_ws.send_bytes(
+            encode_client_frame(InboundFrame(sendChatMessage=SendChatMessage(author='binary_robot', message='beep'))),
+        )
+        new_message = binary_ws.receive_bytes()
+        assert new_message[0] == NEW_MESSAGE
+        assert new_message[1:9] == b'\x07general'
+        (record, ), _ = decode_records(new_message, 9, count=1)
+        assert record.message == 'beep'
+        # Clients without subprotocol still receive JSON
+        assert json.loads(json_ws.receive_text())['newMessage']['message'] == 'beep'
+
+
+def test_chat_rooms():
+    client = TestClient(app)
+    with client.websocket_connect('/chatws') as ws1, client.websocket_connect('/chatws') as ws2:
+        ws1.send_text(json.dumps({'joinRoom': 'dev'}))
+        assert json.loads(ws1.receive_text()) == {'error': 'notConnected'}
+        for ws, name in ((ws1, 'room_robot1'), (ws2, 'room_robot2')):
+            ws.send_text(json.dumps({'tryToConnectUser': name}))
+            ws.receive_text()
+            ws.receive_text()
+
+        ws1.send_text(json.dumps({'joinRoom': 'dev'}))
+        assert json.loads(ws1.receive_text()) == {'newMessageHistory': [], 'room': 'dev'}
+        ws2.send_text(json.dumps({'sendChatMessage': {'author': 'room_robot2', 'message': 'hi', 'room': 'dev'}}))
+        assert json.loads(ws2.receive_text()) == {'error': 'notInRoom'}
+
+        ws1.send_text(json.dumps({'sendChatMessage': {'author': 'room_robot1', 'message': 'dev only', 'room': 'dev'}}))
+        frame = json.loads(ws1.receive_text())
+        assert frame['room'] == 'dev' and frame['newMessage']['message'] == 'dev only'
+        # ws2 is not in the room: the next frame it receives is the message in the default room
+        ws1.send_text(json.dumps({'sendChatMessage': {'author': 'room_robot1', 'message': 'everyone'}}))
+        for ws in (ws1, ws2):
+            frame = json.loads(ws.receive_text())
+            assert frame['room'] == 'general' and frame['newMessage']['message'] == 'everyone'
+
+        ws1.send_text(json.dumps({'leaveRoom': 'dev'}))
+        assert json.loads(ws1.receive_text()) == {'leftRoom': 'dev'}
+        assert 'dev' not in websocket_chat_manager.rooms
+    assert 'room_robot1' not in websocket_chat_manager.usernames
+
+
+@pytest.mark.asyncio
+async def test_socket_backplane_between_workers(tmp_path):
+    from backend.chat.backplane import SocketBackplane
+    from backend.chat.protocol import ChatMessage
+
+    path = str(tmp_path / 'backplane.sock')
+    delivered = {'worker1': [], 'worker2': []}
+    workers = {name: SocketBackplane(path, history_size=2) for name in delivered}
+    for name, backplane in workers.items():
+
+        async def deliver(room: str, message: ChatMessage, message_id: int, name=name):
+            delivered[name].append((room, message.message, message_id))
+
+        backplane.attach(deliver)
+        await backplane.start()
+    worker1, worker2 = workers['worker1'], workers['worker2']
+    # Exactly one worker runs the hub
+    assert worker1.hub is not None and worker2.hub is None
+
+    assert await worker1.reserve_username('robot1')
+    assert not await worker2.reserve_username('robot1')
+    await worker1.release_username('robot1')
+    assert await worker2.reserve_username('robot1')
+
+    for i in range(3):
+        await worker2.publish('general', ChatMessage(1600000000.0 + i, 'robot1', f'hello {i}'))
+    await asyncio.sleep(0.05)
+    expected = [('general', f'hello {i}', i + 1) for i in range(3)]
+    assert delivered['worker1'] == expected
+    assert delivered['worker2'] == expected
+
+    history = await worker1.fetch_history('general')
+    assert [record.id for record in history] == [2, 3]
+    assert await worker2.fetch_history('other') == []
+
+    await worker2.stop()
+    await worker1.stop()
+
+
+@pytest.mark.asyncio
+async def test_socket_backplane_hub_failover(tmp_path):
+    from backend.chat.backplane import SocketBackplane
+    from backend.chat.protocol import DEFAULT_ROOM, ChatMessage
+
+    path = str(tmp_path / 'backplane.sock')
+    managers = [
+        WebsocketChatManager(backplane=SocketBackplane(path, history_size=10), idle_timeout=0, coalesce_window=0)
+        for _ in range(3)
+    ]
+    for manager in managers:
+        await manager.start()
+    hub_worker, worker2, worker3 = managers
+    assert hub_worker.backplane.hub is not None
+    for i in range(3):
+        await worker2.broadcast_new_message(ChatMessage(1600000000.0 + i, 'robot', f'hello {i}'))
+    await asyncio.sleep(0.05)
+    assert [record.id for record in worker3.rooms[DEFAULT_ROOM].history] == [1, 2, 3]
+
+    # The worker running the hub dies, one of the others starts a new hub
+    await hub_worker.stop()
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if worker2.backplane.hub is not None or worker3.backplane.hub is not None:
+            break
+    await asyncio.sleep(0.05)
+    await worker3.broadcast_new_message(ChatMessage(1600000010.0, 'robot', 'after failover'))
+    await asyncio.sleep(0.05)
+    # The new hub continues the ids, so the message is not dropped as a duplicate
+    for manager in (worker2, worker3):
+        history = manager.rooms[DEFAULT_ROOM].history
+        assert [(record.id, record.message) for record in history][-2:] == [(3, 'hello 2'), (4, 'after failover')]
+    await worker3.stop()
+    await worker2.stop()
+
+
+@pytest.mark.asyncio
+async def test_socket_backplane_survives_bad_messages(tmp_path):
+    from backend.chat.backplane import SocketBackplane
+    from backend.chat.protocol import ChatMessage
+
+    delivered = []
+
+    async def deliver(room: str, message: ChatMessage, message_id: int):
+        if message.message == 'boom':
+            raise ValueError('Delivery failed')
+        delivered.append(message.message)
+
+    backplane = SocketBackplane(str(tmp_path / 'backplane.sock'))
+    backplane.attach(deliver)
+    await backplane.start()
+    assert backplane.hub is not None
+    for writer in backplane.hub.workers:
+        writer.write(b'not json\n{"op": "unknown"}\n')
+    await backplane.publish('general', ChatMessage(1600000000.0, 'robot', 'boom'))
+    await backplane.publish('general', ChatMessage(1600000001.0, 'robot', 'still delivered'))
+    await asyncio.sleep(0.05)
+    assert delivered == ['still delivered']
+    assert not backplane._reader_task.done()
+    assert await backplane.reserve_username('robot')
+    await backplane.stop()
+
+
+@pytest.mark.asyncio
+async def test_socket_backplane_username_lost_on_reconnect(tmp_path):
+    from backend.chat.backplane import SocketBackplane
+
+    lost = []
+
+    async def deliver(*args):
+        pass
+
+    async def username_lost(name: str):
+        lost.append(name)
+
+    backplane = SocketBackplane(str(tmp_path / 'backplane.sock'))
+    backplane.attach(deliver, username_lost=username_lost)
+    await backplane.start()
+    assert await backplane.reserve_username('robot1')
+    assert await backplane.reserve_username('robot2')
+    hub = backplane.hub
+    # Another worker reserves the name on the hub before this worker reconnected
+    hub.usernames['robot1'] = object()
+    for writer in list(hub.workers):
+        writer.close()
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if lost:
+            break
+    assert lost == ['robot1']
+    assert backplane._local_usernames == {'robot2'}
+    assert not await backplane.reserve_username('robot1')
+    await backplane.stop()
+
+
+@pytest.mark.asyncio
+async def test_backplane_hub_disconnects_stalled_worker(tmp_path):
+    from backend.chat.backplane import SocketBackplane
+    from backend.chat.protocol import ChatMessage
+
+    delivered = []
+
+    async def deliver(room: str, message: ChatMessage, message_id: int):
+        delivered.append(message_id)
+
+    path = str(tmp_path / 'backplane.sock')
+    backplane = SocketBackplane(path, hub_write_buffer=2**16)
+    backplane.attach(deliver)
+    await backplane.start()
+    # A worker that announces itself but never reads
+    _, stalled = await asyncio.open_unix_connection(path)
+    stalled.write(b'{"op":"hello","next_ids":{}}\n')
+    await asyncio.sleep(0.01)
+    assert len(backplane.hub.workers) == 2
+    for i in range(200):
+        await backplane.publish('general', ChatMessage(1600000000.0, 'robot', 'x' * 10_000))
+        await asyncio.sleep(0)
+    await asyncio.sleep(0.1)
+    assert len(backplane.hub.workers) == 1
+    assert delivered == list(range(1, 201))
+    stalled.close()
+    await backplane.stop()
+
+
+@pytest.mark.asyncio
+async def test_chat_manager_disconnects_lost_username():
+    from backend.routes.chat import USERNAME_LOST_CLOSE_CODE
+
+    manager = WebsocketChatManager()
+    websocket = FakeWebSocket()
+    manager.active_connections[id(websocket)] = websocket
+    manager.usernames['robot'] = websocket
+    manager.websocket_usernames[id(websocket)] = 'robot'
+    await manager.username_lost('robot')
+    assert manager.username_of(websocket) is None
+    assert id(websocket) not in manager.active_connections
+    assert websocket.closed_with == [USERNAME_LOST_CLOSE_CODE]
+
+
+def test_chat_with_in_process_backplane():
+    from backend.chat.backplane import InProcessBackplane
+
+    assert isinstance(websocket_chat_manager.backplane, InProcessBackplane)
+    with TestClient(app) as client:
+        with client.websocket_connect('/chatws') as websocket:
+            websocket.send_json({'tryToConnectUser': 'backplane_user'})
+            assert websocket.receive_json() == {'connectUser': 'backplane_user'}
+            assert 'backplane_user' in websocket_chat_manager.backplane.usernames
+        assert 'backplane_user' not in websocket_chat_manager.backplane.usernames
+
+
+@pytest.mark.asyncio
+async def test_chat_room_limits():
+    manager = WebsocketChatManager(max_rooms_per_connection=2, max_room_name_length=8)
+    websocket = FakeWebSocket()
+    assert manager.join_error('', websocket) == 'invalidRoomName'
+    assert manager.join_error('x' * 9, websocket) == 'invalidRoomName'
+    await manager.join_room('room1', websocket)
+    await manager.join_room('room2', websocket)
+    assert manager.join_error('room3', websocket) == 'tooManyRooms'
+    # Joining a room again does not count
+    assert manager.join_error('room2', websocket) is None
+    await manager.leave_room('room1', websocket)
+    assert manager.join_error('room3', websocket) is None
+
+
+def test_chat_invalid_frame_keeps_connection():
+    with TestClient(app) as client:
+        with client.websocket_connect('/chatws') as websocket:
+            websocket.send_json({'tryToConnectUser': 'typed_robot'})
+            assert websocket.receive_json() == {'connectUser': 'typed_robot'}
+            websocket.receive_json()
+            # Dropped as invalid frame instead of failing in the handler
+            websocket.send_json({'joinRoom': ['general']})
+            websocket.send_json({'tryToConnectUser': 'typed_robot'})
+            assert websocket.receive_json() == {'error': 'alreadyConnected'}
+        assert 'typed_robot' not in websocket_chat_manager.usernames
+        assert not websocket_chat_manager.active_connections
+
+
+@pytest.mark.asyncio
+async def test_idle_connections_are_pinged_and_reaped():
+    manager = WebsocketChatManager(idle_timeout=10, pong_timeout=5)
+    alive, dead = FakeWebSocket(), FakeWebSocket()
+    for name, websocket in (('alive_robot', alive), ('dead_robot', dead)):
+        manager.active_connections[id(websocket)] = websocket
+        manager.liveness.add(id(websocket), 0)
+        manager.broadcast_engine.add(websocket, protocol=JSON_SUBPROTOCOL)
+        manager.usernames[name] = websocket
+        manager.websocket_usernames[id(websocket)] = name
+
+    await manager.reap_idle_connections(now=5)
+    await manager.reap_idle_connections(now=10)
+    await asyncio.sleep(0.01)
+    assert [list(json.loads(websocket.sent[-1])) for websocket in (alive, dead)] == [['ping'], ['ping']]
+    # Any frame answers the ping
+    manager.liveness.seen(id(alive), 12)
+    await manager.reap_idle_connections(now=15)
+
+    assert dead.closed_with == [1001]
+    assert id(dead) not in manager.active_connections and 'dead_robot' not in manager.usernames
+    assert id(alive) in manager.active_connections and 'alive_robot' in manager.usernames
+    assert (manager.liveness.pings_sent, manager.liveness.reaped) == (2, 1)
+    manager.broadcast_engine.close()
+
+
+def test_chat_ping_pong():
+    client = TestClient(app)
+    with client.websocket_connect('/chatws') as ws:
+        ws.send_text(json.dumps({'pong': 1.5}))
+        ws.send_text(json.dumps({'tryToConnectUser': 'pong_robot'}))
+        assert json.loads(ws.receive_text()) == {'connectUser': 'pong_robot'}
@@ -0,0 +1,77 @@
+import json
+
+from fastapi.testclient import TestClient
+
+from backend.chat.admission import FRAME_TOO_LARGE, RATE_LIMITED, AdmissionControl, TokenBucket
+from backend.main import app
+from backend.routes.chat import websocket_chat_manager
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=3, now=0)
+    assert [bucket.take(0) for _ in range(4)] == [True, True, True, False]
+    # One token every 0.1 seconds
+    assert bucket.take(0.1)
+    assert not bucket.take(0.1)
+    assert bucket.is_full(10)
+    assert bucket.tokens == 3
+
+
+def test_admission_control_frames():
+    admission = AdmissionControl(frame_rate=1, frame_burst=2, max_frame_size=10)
+    admission.add(1, now=0)
+    admission.add(2, now=0)
+    assert admission.admit_frame(1, 5, now=0) is None
+    assert admission.admit_frame(1, 50, now=0) == FRAME_TOO_LARGE
+    assert admission.admit_frame(1, 5, now=0) == RATE_LIMITED
+    assert admission.is_throttled(1)
+    # Other connections are not affected
+    assert admission.admit_frame(2, 5, now=0) is None
+    assert admission.admit_frame(1, 5, now=1) is None
+    assert not admission.is_throttled(1)
+    assert (admission.dropped_frames, admission.oversized_frames) == (1, 1)
+    admission.remove(1)
+    assert 1 not in admission.connection_buckets
+
+
+def test_admission_control_messages():
+    admission = AdmissionControl(message_rate=1, message_burst=2)
+    assert [admission.admit_message('robot', now=0) for _ in range(3)] == [True, True, False]
+    assert admission.dropped_messages == 1
+    # Reconnecting does not reset the limit
+    admission.release_user('robot', now=0)
+    assert not admission.admit_message('robot', now=0)
+    # The bucket is forgotten once it is full again
+    admission.release_user('robot', now=0)
+    admission.release_user('somebody_else', now=10)
+    assert 'robot' not in admission.user_buckets
+    assert AdmissionControl(message_rate=0).admit_message('robot', now=0)
+
+
+def test_admission_control_forgets_released_users_in_order():
+    admission = AdmissionControl(message_rate=1, message_burst=2)
+    for name, messages in (('robot1', 1), ('robot2', 2), ('robot3', 2)):
+        for _ in range(messages):
+            admission.admit_message(name, now=0)
+        admission.release_user(name, now=0)
+    # robot3 came back, its bucket must survive the stale release
+    admission.admit_message('robot3', now=0.5)
+    admission.release_user('somebody_else', now=1)
+    assert set(admission.user_buckets) == {'robot2', 'robot3'}
+    admission.release_user('somebody_else', now=2)
+    assert set(admission.user_buckets) == {'robot3'}
+    admission.release_user('robot3', now=2)
+    admission.release_user('somebody_else', now=10)
+    assert not admission.user_buckets and not admission.released_users
+
+
+def test_chat_drops_oversized_frames():
+    client = TestClient(app)
+    with client.websocket_connect('/chatws') as ws:
+        oversized = websocket_chat_manager.admission.oversized_frames
+        ws.send_text('x' * (websocket_chat_manager.admission.max_frame_size + 1))
+        assert json.loads(ws.receive_text()) == {'error': FRAME_TOO_LARGE}
+        assert websocket_chat_manager.admission.oversized_frames == oversized + 1
+        # The connection stays usable
+        ws.send_text(json.dumps({'tryToConnectUser': 'admission_robot'}))
+        assert json.loads(ws.receive_text()) == {'connectUser': 'admission_robot'}
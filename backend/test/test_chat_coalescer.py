@@ -0,0 +1,86 @@
+import asyncio
+import json
+from typing import Dict, List
+
+import pytest
+
+from backend.chat.binary_codec import NEW_MESSAGES, BinaryCodec, decode_records
+from backend.chat.codec import Payload, StdlibCodec
+from backend.chat.coalescer import MessageCoalescer, parse_room_windows
+from backend.chat.history import HistoryRecord
+from backend.chat.protocol import BINARY_SUBPROTOCOL, DEFAULT_ROOM, JSON_SUBPROTOCOL, ChatMessage
+from backend.routes.chat import WebsocketChatManager
+
+
+def test_parse_room_windows():
+    assert parse_room_windows('general=0.05, dev=0') == {'general': 0.05, 'dev': 0.0}
+    assert parse_room_windows('') == {}
+
+
+@pytest.mark.asyncio
+async def test_coalescer_batches_within_window():
+    codecs = {JSON_SUBPROTOCOL: StdlibCodec(), BINARY_SUBPROTOCOL: BinaryCodec()}
+    sent: List[Dict[str, Payload]] = []
+    coalescer = MessageCoalescer('general', codecs, sent.append, window=0.02, max_messages=3)
+    records = [HistoryRecord(i, 1.5, 'robot', f'beep {i}') for i in range(1, 6)]
+
+    def add(record: HistoryRecord):
+        coalescer.add({protocol: codec.encode_record(record) for protocol, codec in codecs.items()})
+
+    # Full batches are sent right away
+    for record in records[:3]:
+        add(record)
+    assert len(sent) == 1 and len(coalescer) == 0
+    assert [m['id'] for m in json.loads(sent[0][JSON_SUBPROTOCOL])['newMessages']] == [1, 2, 3]
+    binary = sent[0][BINARY_SUBPROTOCOL]
+    assert binary[0] == NEW_MESSAGES
+    assert decode_records(binary, 10, count=3)[0] == records[:3]
+
+    # The rest is sent when the window ends
+    add(records[3])
+    add(records[4])
+    assert len(sent) == 1
+    await asyncio.sleep(0.05)
+    assert len(sent) == 2
+    assert [m['id'] for m in json.loads(sent[1][JSON_SUBPROTOCOL])['newMessages']] == [4, 5]
+
+    # A single message is sent as a normal 'newMessage' frame
+    add(HistoryRecord(6, 1.5, 'robot', 'beep 6'))
+    coalescer.flush()
+    assert json.loads(sent[2][JSON_SUBPROTOCOL])['newMessage']['id'] == 6
+    coalescer.close()
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent: List[str] = []
+
+    async def send_text(self, data: str):
+        self.sent.append(data)
+
+
+@pytest.mark.asyncio
+async def test_chat_manager_coalesces_room_messages():
+    manager = WebsocketChatManager(coalesce_window=0.02, room_coalesce_windows={'dev': 0})
+    websocket = FakeWebSocket()
+    manager.broadcast_engine.add(websocket, protocol=JSON_SUBPROTOCOL)
+    manager.rooms[DEFAULT_ROOM].add(websocket)
+    manager.get_or_create_room('dev').add(websocket)
+    assert manager.rooms['dev'].coalescer is None
+
+    for i in range(10):
+        await manager.broadcast_new_message(ChatMessage(1600000000.0 + i, 'robot', f'beep {i}'))
+    await manager.broadcast_new_message(ChatMessage(1600000000.0, 'robot', 'not batched'), 'dev')
+    await asyncio.sleep(0.05)
+    frames = [json.loads(frame) for frame in websocket.sent]
+    assert frames[0]['newMessage']['message'] == 'not batched'
+    assert [m['message'] for m in frames[1]['newMessages']] == [f'beep {i}' for i in range(10)]
+    assert len(frames) == 2
+    # Messages are stored right away, only the broadcast is delayed
+    assert len(manager.rooms[DEFAULT_ROOM].history) == 10
+
+    manager.set_coalescing(DEFAULT_ROOM, 0)
+    await manager.broadcast_new_message(ChatMessage(1600000020.0, 'robot', 'right away'))
+    await asyncio.sleep(0)
+    assert json.loads(websocket.sent[-1])['newMessage']['message'] == 'right away'
+    await manager.stop()
@@ -0,0 +1,72 @@
+from backend.chat.history import ChatHistory
+
+
+def fill_history(history: ChatHistory, amount: int):
+    for i in range(amount):
+        history.append(float(i), f'author{i % 3}', f'message{i}')
+
+
+def test_history_is_bounded():
+    history = ChatHistory(max_size=5)
+    fill_history(history, 12)
+    assert len(history) == 5
+    assert [r.message for r in history] == [f'message{i}' for i in range(7, 12)]
+    assert history.first_id == 8
+    assert history.get(7) is None
+    record = history.get(8)
+    assert record is not None and record.message == 'message7'
+
+
+def test_history_grows_on_demand():
+    history = ChatHistory(max_size=1000)
+    assert len(history._records) == ChatHistory.initial_capacity
+    fill_history(history, 300)
+    assert len(history._records) == 512
+    fill_history(history, 1000)
+    assert len(history._records) == 1000
+    assert history.first_id == 301
+    records, _ = history.since(499.5, limit=2)
+    assert [r.message for r in records] == ['message500', 'message501']
+    history.clear()
+    assert len(history._records) == ChatHistory.initial_capacity
+
+
+def test_history_last():
+    history = ChatHistory(max_size=10)
+    fill_history(history, 4)
+    assert [r.id for r in history.last(2)] == [3, 4]
+    assert [r.id for r in history.last(100)] == [1, 2, 3, 4]
+
+
+def test_history_since():
+    history = ChatHistory(max_size=100)
+    fill_history(history, 150)
+    # Timestamps 50 to 149 are stored
+    records, has_more = history.since(100.0, limit=10)
+    assert [r.timestamp for r in records] == [float(i) for i in range(101, 111)]
+    assert has_more
+    records, has_more = history.since(140.0, limit=10)
+    assert [r.timestamp for r in records] == [float(i) for i in range(141, 150)]
+    assert not has_more
+    records, _ = history.since(0, limit=1)
+    assert records[0].timestamp == 50.0
+
+
+def test_history_before():
+    history = ChatHistory(max_size=100)
+    fill_history(history, 150)
+    records, has_more = history.before(60, limit=5)
+    assert [r.id for r in records] == [55, 56, 57, 58, 59]
+    assert has_more
+    records, has_more = history.before(53, limit=5)
+    assert [r.id for r in records] == [51, 52]
+    assert not has_more
+
+
+def test_history_timestamps_stay_sorted():
+    history = ChatHistory(max_size=10)
+    history.append(10.0, 'a', 'first')
+    # Clock went backwards
+    history.append(5.0, 'a', 'second')
+    records, _ = history.since(9.0, limit=10)
+    assert [r.message for r in records] == ['first', 'second']
@@ -0,0 +1,174 @@
+import time
+
+import pytest
+
+from backend.chat.backplane import SocketBackplane
+from backend.chat.history import HistoryRecord
+from backend.chat.message_log import SEGMENT_SUFFIX, MessageLog, encode_entry
+from backend.chat.protocol import DEFAULT_ROOM, ChatMessage
+from backend.routes.chat import WebsocketChatManager
+
+
+def record(message_id: int, timestamp: float = 1600000000.0) -> HistoryRecord:
+    return HistoryRecord(message_id, timestamp + message_id, 'robot', f'hello ünïcode {message_id}')
+
+
+@pytest.mark.asyncio
+async def test_message_log_restores_rooms(tmp_path):
+    log = MessageLog(tmp_path, history_size=3)
+    assert await log.open() == {}
+    for i in range(1, 6):
+        log.append(DEFAULT_ROOM, record(i))
+    log.append('other', record(1))
+    await log.close()
+
+    log = MessageLog(tmp_path, history_size=3)
+    recovered = await log.open()
+    assert recovered == {DEFAULT_ROOM: [record(3), record(4), record(5)], 'other': [record(1)]}
+    await log.close()
+
+
+@pytest.mark.asyncio
+async def test_message_log_writes_batches_after_flush_interval(tmp_path):
+    log = MessageLog(tmp_path, history_size=10, flush_interval=0.05)
+    await log.open()
+    log.append(DEFAULT_ROOM, record(1))
+    log.append(DEFAULT_ROOM, record(2))
+    segment = log.segments[-1]
+    assert segment.stat().st_size == 0
+    await log.flush()
+    assert segment.stat().st_size == 2 * len(encode_entry(DEFAULT_ROOM, record(1)))
+    await log.close()
+
+
+@pytest.mark.asyncio
+async def test_message_log_segments_and_compaction(tmp_path):
+    record_size = len(encode_entry(DEFAULT_ROOM, record(1)))
+    log = MessageLog(tmp_path, history_size=5, segment_size=4 * record_size, compact_segments=2)
+    await log.open()
+    for i in range(1, 101):
+        log.append(DEFAULT_ROOM, record(i))
+        # Every record in its own batch, so segments roll over every 4 records
+        await log.flush()
+    # Closed segments are compacted into one, the active segment is kept
+    assert 2 <= len(log.segments) <= 1 + 2
+    assert sorted(tmp_path.glob(f'*{SEGMENT_SUFFIX}')) == log.segments
+    await log.close()
+
+    log = MessageLog(tmp_path, history_size=5)
+    recovered = await log.open()
+    assert [r.id for r in recovered[DEFAULT_ROOM]] == [96, 97, 98, 99, 100]
+    await log.close()
+
+
+@pytest.mark.asyncio
+async def test_message_log_compaction_retention(tmp_path):
+    log = MessageLog(tmp_path, history_size=100, segment_size=1, retention=3600)
+    await log.open()
+    log.append(DEFAULT_ROOM, record(1, timestamp=time.time() - 7200))
+    await log.flush()
+    log.append(DEFAULT_ROOM, record(2, timestamp=time.time()))
+    await log.flush()
+    await log.close()
+    log = MessageLog(tmp_path, history_size=100, segment_size=1, retention=3600)
+    await log.open()
+    await log.close()
+    log.compact()
+    log = MessageLog(tmp_path, history_size=100)
+    recovered = await log.open()
+    assert [r.id for r in recovered[DEFAULT_ROOM]] == [2]
+    await log.close()
+
+
+@pytest.mark.asyncio
+async def test_message_log_repairs_incomplete_write(tmp_path):
+    log = MessageLog(tmp_path, history_size=10)
+    await log.open()
+    for i in range(1, 4):
+        log.append(DEFAULT_ROOM, record(i))
+    await log.close()
+    segment = log.segments[-1]
+    # Crash in the middle of writing the 4th record
+    segment.write_bytes(segment.read_bytes() + encode_entry(DEFAULT_ROOM, record(4))[:-7])
+
+    log = MessageLog(tmp_path, history_size=10)
+    assert [r.id for r in (await log.open())[DEFAULT_ROOM]] == [1, 2, 3]
+    log.append(DEFAULT_ROOM, record(4))
+    await log.close()
+    log = MessageLog(tmp_path, history_size=10)
+    assert [r.id for r in (await log.open())[DEFAULT_ROOM]] == [1, 2, 3, 4]
+    await log.close()
+
+
+@pytest.mark.asyncio
+async def test_message_log_reads_corrupt_closed_segment(tmp_path):
+    record_size = len(encode_entry(DEFAULT_ROOM, record(1)))
+    log = MessageLog(tmp_path, history_size=100, segment_size=4 * record_size)
+    await log.open()
+    for i in range(1, 11):
+        log.append(DEFAULT_ROOM, record(i))
+        await log.flush()
+    await log.close()
+    first = log.segments[0]
+    # Damage the length after the body of the 2nd record, so it can not be found backwards from the 3rd
+    data = bytearray(first.read_bytes())
+    data[2 * record_size - 4:2 * record_size] = b'\xff\xff\xff\xff'
+    first.write_bytes(bytes(data))
+
+    log = MessageLog(tmp_path, history_size=100, segment_size=4 * record_size)
+    assert [r.id for r in (await log.open())[DEFAULT_ROOM]] == list(range(1, 11))
+    # Compaction reads the segment the same way
+    await log.compact_in_background()
+    await log.close()
+    log = MessageLog(tmp_path, history_size=100)
+    assert [r.id for r in (await log.open())[DEFAULT_ROOM]] == list(range(1, 11))
+    await log.close()
+
+
+@pytest.mark.asyncio
+async def test_chat_manager_restores_history_from_log(tmp_path):
+    manager = WebsocketChatManager(history_size=50, message_log=MessageLog(tmp_path, history_size=50))
+    await manager.start()
+    for i in range(3):
+        await manager.broadcast_new_message(ChatMessage(1600000000.0 + i, 'robot', f'hello {i}'))
+    # Messages are only stored by rooms with members on this worker
+    manager.get_or_create_room('room1')
+    await manager.broadcast_new_message(ChatMessage(1600000010.0, 'robot', 'in a room'), 'room1')
+    await manager.stop()
+
+    manager = WebsocketChatManager(history_size=50, message_log=MessageLog(tmp_path, history_size=50))
+    await manager.start()
+    history = manager.rooms[DEFAULT_ROOM].history
+    assert [r.message for r in history] == ['hello 0', 'hello 1', 'hello 2']
+    # Ids continue where they stopped before the restart
+    await manager.broadcast_new_message(ChatMessage(1600000020.0, 'robot', 'after restart'))
+    assert [r.id for r in history] == [1, 2, 3, 4]
+    # Other rooms are restored when they are created again
+    assert 'room1' not in manager.rooms
+    assert [r.message for r in manager.get_or_create_room('room1').history] == ['in a room']
+    await manager.stop()
+
+
+def test_chat_message_log_requires_memory_backplane(tmp_path):
+    with pytest.raises(ValueError):
+        WebsocketChatManager(
+            backplane=SocketBackplane(str(tmp_path / 'backplane.sock'), history_size=10),
+            message_log=MessageLog(tmp_path, history_size=10),
+        )
+
+
+@pytest.mark.asyncio
+async def test_message_log_compaction_job(tmp_path):
+    log = MessageLog(tmp_path, history_size=2, segment_size=1)
+    await log.open()
+    for i in range(1, 6):
+        log.append(DEFAULT_ROOM, record(i))
+        await log.flush()
+    assert len(log.segments) == 6
+    # Run by the job scheduler in the writer thread of the log
+    await log.compact_in_background()
+    assert len(log.segments) == 2
+    await log.close()
+    log = MessageLog(tmp_path, history_size=2)
+    assert [r.id for r in (await log.open())[DEFAULT_ROOM]] == [4, 5]
+    await log.close()
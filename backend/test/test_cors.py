@@ -0,0 +1,41 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from backend.cors import CorsPolicy
+from backend.main import app
+
+
+def test_cors_policy():
+    policy = CorsPolicy.from_config(
+        'https://burnysc2.github.io, http://localhost:1-65535,https://*.example.com,re:https://pr-\\d+\\.test\\.org'
+    )
+    assert policy.is_allowed('https://burnysc2.github.io')
+    assert policy.is_allowed('http://localhost:1')
+    assert policy.is_allowed('http://localhost:65535')
+    assert policy.is_allowed('https://app.example.com')
+    assert policy.is_allowed('https://pr-42.test.org')
+
+    assert not policy.is_allowed('http://localhost')
+    assert not policy.is_allowed('http://localhost:0')
+    assert not policy.is_allowed('http://localhost:65536')
+    assert not policy.is_allowed('http://localhost:03000')
+    assert not policy.is_allowed('https://localhost:3000')
+    assert not policy.is_allowed('http://evil.com:3000')
+    assert not policy.is_allowed('https://example.com')
+    assert not policy.is_allowed('https://a.b.example.com')
+    assert not policy.is_allowed('https://app.example.com.evil.com')
+    assert not policy.is_allowed('https://pr-x.test.org')
+    with pytest.raises(ValueError):
+        CorsPolicy(['http://localhost:0-10'])
+
+
+def test_cors_preflight():
+    client = TestClient(app)
+    headers = {'Origin': 'http://localhost:3000', 'Access-Control-Request-Method': 'POST'}
+    response = client.options('/api', headers=headers)
+    assert response.status_code == 200
+    assert response.headers['access-control-allow-origin'] == 'http://localhost:3000'
+
+    response = client.options('/api', headers={**headers, 'Origin': 'http://evil.com'})
+    assert response.status_code == 400
+    assert 'access-control-allow-origin' not in response.headers
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from backend.loadtest.report import compare, latest_results, percentile, save_results
+from backend.loadtest.run import run_load_test
+from backend.loadtest.scenarios import ChatLoad, TodoLoad, parse_mix
+from backend.loadtest.transport import AsgiTransport
+from backend.main import app
+from backend.routes import todolist
+
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile(values, 1) == 100
+    assert percentile([3.0], 0.99) == 3
+    assert percentile([], 0.5) == 0
+
+
+def test_parse_mix():
+    assert parse_mix('list=2,create=1') == {'list': 2, 'create': 1}
+    with pytest.raises(ValueError):
+        parse_mix('list=1,update=1')
+
+
+@pytest.mark.asyncio
+async def test_in_process_load_test(tmp_path, monkeypatch):
+    monkeypatch.setattr(todolist, 'SQLITE_FILENAME', str(tmp_path / 'todos.db'))
+    results = await run_load_test(
+        AsgiTransport(app),
+        {'chat', 'todo'},
+        ChatLoad(clients=5, messages_per_client=3, interval=0),
+        TodoLoad(workers=3, requests_per_worker=20),
+    )
+    chat = results['chat']
+    assert chat['messages_sent'] == 15
+    # Every client receives every message
+    assert chat['messages_delivered'] == chat['messages_expected'] == 75
+    assert chat['latency_ms']['count'] == 15
+    assert chat['connect_ms']['count'] == 5
+    todo = results['todo']
+    assert todo['requests'] == 60
+    assert todo['errors'] == 0
+    assert sum(operation['count'] for operation in todo['operations'].values()) == 60
+
+
+def test_save_and_compare(tmp_path):
+    before = {
+        'meta': {'commit': 'aaaaaaa', 'todo_load': {'workers': 1}},
+        'todo': {'throughput_per_s': 100.0, 'latency_ms': {'p50': 1.0, 'p99': 2.0}},
+    }
+    after = {
+        'meta': {'commit': 'bbbbbbb', 'todo_load': {'workers': 1}},
+        'todo': {'throughput_per_s': 80.0, 'latency_ms': {'p50': 1.0, 'p99': 1.0}},
+    }
+    path = save_results(before, tmp_path)
+    assert latest_results(tmp_path) == path
+    assert json.loads(path.read_text()) == before
+    lines = compare(before, after).splitlines()
+    assert 'aaaaaaa' in lines[0] and 'bbbbbbb' in lines[0]
+    assert lines[1].split() == ['todo.throughput_per_s', '100.0', '80.0', '-20.0%', '!']
+    assert lines[2].split() == ['todo.latency_ms.p50', '1.0', '1.0', '+0.0%']
+    assert lines[3].split() == ['todo.latency_ms.p99', '2.0', '1.0', '-50.0%']
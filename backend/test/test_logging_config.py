@@ -0,0 +1,94 @@
+import io
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+from loguru import logger
+
+from backend.logging_config import SampledEvent, configure_logging, parse_levels, parse_sample_rates
+
+
+@pytest.fixture
+def log_stream():
+    stream = io.StringIO()
+    yield stream
+    configure_logging()
+
+
+def records(stream: io.StringIO):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_parse_config():
+    assert parse_levels('backend.todo=debug, backend.chat=WARNING') == {
+        'backend.todo': 'DEBUG',
+        'backend.chat': 'WARNING',
+    }
+    assert parse_sample_rates('chat_message=0.01,todo_insert=0') == {'chat_message': 0.01, 'todo_insert': 0}
+    assert parse_levels('') == {}
+
+
+@pytest.mark.asyncio
+async def test_json_records_from_background_thread(log_stream):
+    configure_logging(log_format='json', background=True, sink=log_stream)
+    logger.bind(room='general').info('Hello {}', 'world')
+    # Waits until the writer thread wrote the record
+    await logger.complete()
+    [record] = records(log_stream)
+    assert record['message'] == 'Hello world'
+    assert record['level'] == 'INFO'
+    assert record['module'] == __name__
+    assert record['function'] == 'test_json_records_from_background_thread'
+    assert record['room'] == 'general'
+
+
+def test_json_exception(log_stream):
+    configure_logging(log_format='json', background=False, sink=log_stream)
+    try:
+        raise ValueError('broken')
+    except ValueError:
+        logger.exception('Failed')
+    [record] = records(log_stream)
+    assert record['message'] == 'Failed'
+    assert 'ValueError: broken' in record['exception']
+
+
+def test_level_per_module(log_stream):
+    configure_logging(level='WARNING', levels=f'{__name__}=DEBUG', log_format='json', background=False, sink=log_stream)
+    logger.debug('Shown')
+    logger.patch(lambda record: record.update(name='backend.other')).info('Hidden')
+    assert [record['message'] for record in records(log_stream)] == ['Shown']
+
+
+def test_sampled_event(log_stream):
+    configure_logging(log_format='json', background=False, sink=log_stream)
+    event = SampledEvent('chat_message', rate=0.25)
+    for i in range(10):
+        event.info('Message {}', i)
+    logged = records(log_stream)
+    assert [record['message'] for record in logged] == ['Message 3', 'Message 7']
+    # The record points to the call site, not to SampledEvent
+    assert logged[0]['function'] == 'test_sampled_event'
+    assert logged[0]['event'] == 'chat_message'
+
+
+def test_sampled_event_turned_off(log_stream):
+    configure_logging(log_format='json', background=False, sink=log_stream)
+    event = SampledEvent('chat_message', rate=0)
+    event.info('Message {}', 1)
+    assert records(log_stream) == []
+
+
+def test_importing_app_keeps_log_handlers():
+    # The app configures logging on startup, so importers like the load test keep their own handlers
+    code = 'import sys; from loguru import logger; logger.add(sys.stdout); import backend.main; logger.info("kept")'
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=Path(__file__).parent.parent.parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert 'kept' in result.stdout
@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from backend.chat.broadcast import BroadcastEngine
+from backend.main import app
+from backend.metrics import HttpMetrics, MetricsMiddleware, MetricsRegistry
+from backend.routes.chat import frames_received, websocket_chat_manager
+from backend.test.test_chat import FakeWebSocket
+
+
+def test_render_counter_gauge_histogram():
+    registry = MetricsRegistry()
+    requests = registry.counter('requests_total', 'Requests', ('route', ))
+    requests.inc(labels=('/api', ))
+    requests.inc(2, labels=('/api', ))
+    registry.gauge('connections', 'Connections', function=lambda: 7)
+    latency = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+    latency.observe(0.1)
+    latency.observe(0.5)
+    latency.observe(5)
+    assert registry.render() == '\n'.join([
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{route="/api"} 3',
+        '# HELP connections Connections',
+        '# TYPE connections gauge',
+        'connections 7',
+        '# HELP latency_seconds Latency',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        'latency_seconds_sum 5.6',
+        'latency_seconds_count 3',
+        '',
+    ])
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.counter('errors_total', 'Errors', ('message', )).inc(labels=('say "hi"\n', ))
+    assert 'errors_total{message="say \\"hi\\"\\n"} 1' in registry.render()
+
+
+def test_duplicate_metric_name():
+    registry = MetricsRegistry()
+    registry.counter('requests_total', 'Requests')
+    with pytest.raises(ValueError):
+        registry.gauge('requests_total', 'Requests')
+
+
+def test_middleware_labels_by_route_template():
+    test_app = FastAPI()
+    metrics = HttpMetrics(MetricsRegistry())
+    test_app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+    @test_app.get('/items/{item_id}')
+    def get_item(item_id: int):
+        return {'id': item_id}
+
+    @test_app.get('/fail')
+    def fail():
+        raise ValueError()
+
+    with TestClient(test_app, raise_server_exceptions=False) as client:
+        for item_id in range(3):
+            assert client.get(f'/items/{item_id}').status_code == 200
+        assert client.get('/fail').status_code == 500
+        assert client.get('/missing').status_code == 404
+    assert metrics.requests.get(('GET', '/items/{item_id}', '200')) == 3
+    assert metrics.requests.get(('GET', '/fail', '500')) == 1
+    assert metrics.requests.get(('GET', 'unmatched', '404')) == 1
+    assert metrics.latency.count(('GET', '/items/{item_id}')) == 3
+    assert metrics.response_size.sums[('GET', '/items/{item_id}')] == 3 * len('{"id":0}')
+    assert metrics.in_flight.get() == 0
+
+
+@pytest.mark.asyncio
+async def test_broadcast_engine_counts_sent_frames():
+    engine = BroadcastEngine()
+    websockets = [FakeWebSocket() for _ in range(3)]
+    for ws in websockets:
+        engine.add(ws)
+    engine.broadcast('hi')
+    await asyncio.sleep(0.01)
+    assert engine.sent_frames == 3
+    # Frames of removed connections are still counted
+    engine.remove(websockets[0])
+    assert engine.sent_frames == 3
+    engine.close()
+
+
+def test_metrics_endpoint():
+    with TestClient(app) as client:
+        received = frames_received.get()
+        with client.websocket_connect('/chatws') as websocket:
+            websocket.send_text(json.dumps({'tryToConnectUser': 'metrics_user'}))
+            assert json.loads(websocket.receive_text()) == {'connectUser': 'metrics_user'}
+            websocket.receive_text()
+            assert len(websocket_chat_manager.active_connections) == 1
+            text = client.get('/metrics').text
+            assert 'chat_connections 1' in text
+        assert frames_received.get() == received + 1
+        response = client.get('/metrics')
+    assert response.headers['content-type'] == 'text/plain; version=0.0.4; charset=utf-8'
+    assert 'http_requests_total{method="GET",route="/metrics",status="200"}' in response.text
+    assert 'chat_frames_sent_total' in response.text
+    assert 'todo_feed_connections 0' in response.text
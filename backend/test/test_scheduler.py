@@ -0,0 +1,109 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from backend.scheduler import Job, JobExecutor, JobScheduler, job_duration, job_runs
+
+
+@pytest.mark.asyncio
+async def test_periodic_and_delayed_jobs():
+    scheduler = JobScheduler()
+    calls: List[str] = []
+
+    async def record(name: str):
+        calls.append(name)
+
+    scheduler.add_periodic('periodic', record, interval=0.02, delay=0, args=('periodic', ))
+    scheduler.add_delayed('delayed', record, delay=0.03, kwargs={'name': 'delayed'})
+    with pytest.raises(ValueError):
+        scheduler.add_delayed('delayed', record, delay=0)
+    scheduler.start()
+    await asyncio.sleep(0.1)
+    await scheduler.stop()
+    assert calls.count('delayed') == 1
+    assert calls.count('periodic') >= 3
+    assert scheduler.tasks == {}
+    assert scheduler.jobs['periodic'].runs == calls.count('periodic')
+    assert job_runs.get(('periodic', 'success')) >= 3
+    assert job_duration.count(('delayed', )) >= 1
+
+
+@pytest.mark.asyncio
+async def test_failed_jobs_are_retried():
+    scheduler = JobScheduler()
+    attempts: List[int] = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ValueError('Not yet')
+
+    async def broken():
+        raise ValueError('Never works')
+
+    flaky_job = scheduler.add_delayed('flaky', flaky, delay=0, retry_delay=0.01)
+    broken_job = scheduler.add_delayed('broken', broken, delay=0, retry_delay=0.01, max_attempts=2)
+    scheduler.start()
+    await asyncio.sleep(0.15)
+    assert (flaky_job.runs, flaky_job.failures, flaky_job.consecutive_failures) == (3, 2, 0)
+    # Gives up after max_attempts
+    assert (broken_job.runs, broken_job.failures) == (2, 2)
+    assert scheduler.tasks == {}
+    await scheduler.stop()
+
+
+@pytest.mark.asyncio
+async def test_max_concurrency():
+    scheduler = JobScheduler(max_concurrency=2)
+    running: List[int] = []
+    peak = 0
+
+    async def slow():
+        nonlocal peak
+        running.append(1)
+        peak = max(peak, len(running))
+        await asyncio.sleep(0.02)
+        running.pop()
+
+    for i in range(5):
+        scheduler.add_delayed(f'slow{i}', slow, delay=0)
+    scheduler.start()
+    await asyncio.sleep(0.15)
+    await scheduler.stop()
+    assert peak == 2
+    assert all(job.runs == 1 for job in scheduler.jobs.values())
+
+
+@pytest.mark.asyncio
+async def test_thread_and_process_jobs():
+    scheduler = JobScheduler()
+    scheduler.start()
+    thread_job = scheduler.add_job(Job('thread', sorted, executor=JobExecutor.THREAD, args=([3, 1, 2], )))
+    process_job = scheduler.add_job(Job('process', pow, executor=JobExecutor.PROCESS, args=(2, 100)))
+    await asyncio.sleep(0)
+    assert await scheduler.run_job(thread_job)
+    assert await scheduler.run_job(process_job)
+    await scheduler.stop()
+    assert thread_job.runs >= 1 and process_job.runs >= 1
+    assert thread_job.failures == process_job.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_stop_cancels_running_jobs():
+    scheduler = JobScheduler()
+    cancelled = asyncio.Event()
+
+    async def forever():
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    job = scheduler.add_delayed('forever', forever, delay=0)
+    scheduler.start()
+    await asyncio.sleep(0.01)
+    assert job.running
+    await scheduler.stop()
+    assert cancelled.is_set() and not job.running
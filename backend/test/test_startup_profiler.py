@@ -0,0 +1,64 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from backend.startup_profiler import import_time_by_package, parse_importtime, profile_hooks
+
+ROOT_FOLDER = Path(__file__).parent.parent.parent
+
+IMPORTTIME_OUTPUT = '''import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _json
+import time:       900 |       1020 | json
+import time:      3000 |       3000 |     fastapi.openapi
+import time:      2000 |       5000 |   fastapi
+'''
+
+
+def test_parse_importtime():
+    timings = parse_importtime(IMPORTTIME_OUTPUT)
+    assert [timing.module for timing in timings] == ['_json', 'json', 'fastapi.openapi', 'fastapi']
+    assert timings[1].self_us == 900
+    assert timings[1].cumulative_us == 1020
+    assert import_time_by_package(timings) == {'fastapi': 5000, 'json': 900, '_json': 120}
+
+
+def test_profile_hooks():
+    app = FastAPI()
+    calls = []
+
+    @app.on_event('startup')
+    async def start_async():
+        calls.append('async')
+
+    @app.on_event('startup')
+    def start_sync():
+        calls.append('sync')
+
+    @app.on_event('shutdown')
+    async def stop():
+        calls.append('stop')
+
+    durations = profile_hooks(app)
+    with TestClient(app):
+        assert calls == ['async', 'sync']
+    assert calls == ['async', 'sync', 'stop']
+    assert list(durations) == ['startup:start_async', 'startup:start_sync', 'shutdown:stop']
+    assert all(duration >= 0 for duration in durations.values())
+
+
+def test_main_does_not_import_optional_modules():
+    # uvicorn is only needed when backend/main.py is run directly, the database drivers and msgspec only when enabled
+    modules = ['uvicorn', 'psycopg2', 'pymongo', 'msgspec']
+    result = subprocess.run(
+        [sys.executable, '-c', f'import sys, backend.main; print([m for m in {modules} if m in sys.modules])'],
+        cwd=ROOT_FOLDER,
+        env={**os.environ, 'CHAT_CODEC': 'json'},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == '[]'
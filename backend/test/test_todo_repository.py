@@ -0,0 +1,81 @@
+"""
+Runs the same tests against every todo backend.
+Postgres and mongodb are only tested if TEST_POSTGRES_DSN / TEST_MONGO_URL point to a server, e.g. the containers
+started by test/tester_helper.py, and the tests delete all their todos.
+"""
+import os
+from typing import AsyncIterator
+
+import pytest
+
+from backend.todo.repository import TodoRepository
+from backend.todo.sqlite_repository import SQLiteTodoRepository
+
+ENV = os.environ.copy()
+
+
+@pytest.fixture(params=['sqlite', 'postgres', 'mongo'])
+async def repository(request, tmp_path) -> AsyncIterator[TodoRepository]:
+    if request.param == 'sqlite':
+        repository: TodoRepository = SQLiteTodoRepository(tmp_path / 'todos.db', pool_size=2)
+    elif request.param == 'postgres':
+        if 'TEST_POSTGRES_DSN' not in ENV:
+            pytest.skip('TEST_POSTGRES_DSN not set')
+        from backend.todo.postgres_repository import PostgresTodoRepository
+        repository = PostgresTodoRepository(ENV['TEST_POSTGRES_DSN'], pool_size=2)
+    else:
+        if 'TEST_MONGO_URL' not in ENV:
+            pytest.skip('TEST_MONGO_URL not set')
+        from backend.todo.mongo_repository import MongoTodoRepository
+        repository = MongoTodoRepository(ENV['TEST_MONGO_URL'], database='todos_test', pool_size=2)
+    await repository.open()
+    await repository.delete_many([todo['id'] for todo in await repository.list_todos()])
+    yield repository
+    await repository.close()
+
+
+@pytest.mark.asyncio
+async def test_repository_insert_and_delete(repository: TodoRepository):
+    first = await repository.insert('first')
+    ids = await repository.insert_many(['a', 'b', 'c'])
+    assert len(set(ids)) == 3 and min(ids) > first
+    todos = await repository.list_todos()
+    assert [todo['content'] for todo in todos] == ['first', 'a', 'b', 'c']
+    assert [todo['id'] for todo in todos] == [first] + ids
+
+    assert await repository.delete(first) == 1
+    assert await repository.delete(first) == 0
+    assert await repository.delete_many(ids[:2] + [first]) == 2
+    assert await repository.list_todos() == [{'id': ids[2], 'content': 'c'}]
+
+
+@pytest.mark.asyncio
+async def test_repository_pagination(repository: TodoRepository):
+    ids = await repository.insert_many([f'todo{i}' for i in range(7)])
+    assert [todo['id'] for todo in await repository.list_page(0, 3)] == ids[:3]
+    assert [todo['id'] for todo in await repository.list_page(ids[2], 3)] == ids[3:6]
+    assert [todo['id'] for todo in await repository.list_page(ids[-1], 3)] == []
+    batches = [batch async for batch in repository.iterate(ids[0], 2)]
+    assert [len(batch) for batch in batches] == [2, 2, 2]
+    assert [todo['id'] for batch in batches for todo in batch] == ids[1:]
+
+
+@pytest.mark.asyncio
+async def test_mongo_wait_queue_timeout_is_pool_timeout():
+    from pymongo.errors import ConnectionFailure
+
+    from backend.todo.database import PoolTimeoutError
+    from backend.todo.mongo_repository import MongoTodoRepository
+
+    def wait_queue_timeout():
+        raise ConnectionFailure('Timed out while checking out a connection from connection pool. maxPoolSize: 2')
+
+    def connection_refused():
+        raise ConnectionFailure('Connection refused')
+
+    repository = MongoTodoRepository('mongodb://localhost', pool_size=2)
+    with pytest.raises(PoolTimeoutError):
+        await repository._run(wait_queue_timeout)
+    with pytest.raises(ConnectionFailure):
+        await repository._run(connection_refused)
+    await repository.close()
@@ -0,0 +1,284 @@
+import asyncio
+import json
+import sqlite3
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from backend.main import app
+from backend.routes import todolist
+from backend.todo import search
+from backend.todo.cache import ListingCache
+from backend.todo.coalescer import WriteCoalescer
+from backend.todo.database import SQLITE_PROFILES, PoolTimeoutError, SQLitePool, ThreadedConnectionPool
+from backend.todo.migrations import MIGRATIONS, migrate, schema_version
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(todolist, 'SQLITE_FILENAME', str(tmp_path / 'todos.db'))
+    with TestClient(app) as client:
+        yield client
+
+
+def test_todo_routes(client: TestClient):
+    assert client.get('/api').json() == []
+    client.post('/api/first')
+    client.post('/api_body', json={'new_todo': 'second'})
+    client.post('/api_model', json={'todo_description': 'third'})
+    todos = client.get('/api').json()
+    assert [todo['content'] for todo in todos] == ['first', 'second', 'third']
+    client.delete(f'/api/{todos[1]["id"]}')
+    assert [todo['content'] for todo in client.get('/api').json()] == ['first', 'third']
+
+
+def _sleep(_connection: sqlite3.Connection, seconds: float) -> float:
+    time.sleep(seconds)
+    return seconds
+
+
+@pytest.mark.asyncio
+async def test_pool_does_not_block_event_loop(tmp_path):
+    pool = SQLitePool(tmp_path / 'todos.db', pool_size=2)
+    await pool.open()
+    queries = asyncio.gather(pool.run(_sleep, 0.2), pool.run(_sleep, 0.2))
+    # The event loop keeps running while both connections are busy
+    start = time.perf_counter()
+    await asyncio.sleep(0.01)
+    assert time.perf_counter() - start < 0.1
+    assert await queries == [0.2, 0.2]
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_pool_acquire_timeout(tmp_path):
+    pool = SQLitePool(tmp_path / 'todos.db', pool_size=1, acquire_timeout=0.05)
+    await pool.open()
+    busy = asyncio.ensure_future(pool.run(_sleep, 0.2))
+    await asyncio.sleep(0.01)
+    with pytest.raises(PoolTimeoutError):
+        await pool.run(_sleep, 0)
+    # A cancelled query still returns its connection once the thread is done
+    busy.cancel()
+    await asyncio.sleep(0.3)
+    assert await pool.run(_sleep, 0) == 0
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_pool_replaces_broken_connections():
+    broken = set()
+    pool = ThreadedConnectionPool(
+        lambda: sqlite3.connect(':memory:', check_same_thread=False),
+        pool_size=1,
+        is_broken=lambda connection: connection in broken,
+    )
+    await pool.open()
+    connection = await pool.run(lambda connection: connection)
+    # E.g. the database server restarted
+    connection.close()
+    broken.add(connection)
+    assert await pool.run(lambda connection: connection.execute('SELECT 1').fetchone()) == (1, )
+    assert await pool.run(lambda connection: connection) is not connection
+    await pool.close()
+
+
+def test_todo_pagination_and_streaming(client: TestClient, monkeypatch):
+    monkeypatch.setattr(todolist, 'TODO_STREAM_BATCH_SIZE', 2)
+    for i in range(5):
+        client.post(f'/api/todo{i}')
+
+    response = client.get('/api', params={'limit': 2})
+    assert [todo['content'] for todo in response.json()] == ['todo0', 'todo1']
+    after_id = response.headers['X-Next-After-Id']
+    response = client.get('/api', params={'after_id': after_id, 'limit': 2})
+    assert [todo['content'] for todo in response.json()] == ['todo2', 'todo3']
+    response = client.get('/api', params={'after_id': response.headers['X-Next-After-Id'], 'limit': 2})
+    assert [todo['content'] for todo in response.json()] == ['todo4']
+    assert 'X-Next-After-Id' not in response.headers
+
+    response = client.get('/api', params={'stream': 'ndjson'})
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    lines = response.text.splitlines()
+    assert [json.loads(line)['content'] for line in lines] == [f'todo{i}' for i in range(5)]
+
+    response = client.get('/api', params={'stream': 'json', 'after_id': after_id})
+    assert [todo['content'] for todo in response.json()] == ['todo2', 'todo3', 'todo4']
+    response = client.get('/api', params={'stream': 'json', 'after_id': 1000})
+    assert response.json() == []
+    assert client.get('/api', params={'stream': 'xml'}).status_code == 422
+
+
+def test_todo_bulk_routes(client: TestClient):
+    response = client.post('/api_bulk', json={'todos': ['a', '', 'b', 'c']})
+    # Ids could not be matched to the request if empty tasks were skipped
+    assert response.status_code == 422
+    assert client.get('/api').json() == []
+    response = client.post('/api_bulk', json={'todos': ['a', 'b', 'c']})
+    ids = response.json()['ids']
+    assert len(ids) == 3
+    assert [todo['id'] for todo in client.get('/api').json()] == ids
+    response = client.request('DELETE', '/api_bulk', json={'ids': ids[:2] + [12345]})
+    assert response.json() == {'deleted': 2}
+    assert [todo['content'] for todo in client.get('/api').json()] == ['c']
+
+
+@pytest.mark.asyncio
+async def test_write_coalescer_commits_once(tmp_path):
+    pool = SQLitePool(tmp_path / 'todos.db', pool_size=2)
+    await pool.open()
+    await pool.execute('CREATE TABLE todos (id INTEGER PRIMARY KEY AUTOINCREMENT, task TEXT)')
+    commits = []
+
+    def trace_commits(connection: sqlite3.Connection):
+        connection.set_trace_callback(lambda sql: sql == 'COMMIT' and commits.append(sql))
+
+    await pool.run_write(trace_commits)
+    coalescer = WriteCoalescer(pool, window=0.01, max_batch_size=100)
+    results = await asyncio.gather(
+        *(coalescer.execute('INSERT INTO todos (task) VALUES (?)', [f'todo{i}']) for i in range(50))
+    )
+    assert [result.last_row_id for result in results] == list(range(1, 51))
+    assert len(commits) == 1
+    await coalescer.close()
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_profile_and_migrations(tmp_path):
+    path = tmp_path / 'todos.db'
+    # A database created before schema versioning
+    legacy = sqlite3.connect(path)
+    legacy.execute('CREATE TABLE todos (id INTEGER PRIMARY KEY AUTOINCREMENT, task TEXT)')
+    legacy.execute("INSERT INTO todos (task) VALUES ('old')")
+    legacy.commit()
+    legacy.close()
+
+    pool = SQLitePool(path, pool_size=2, profile=SQLITE_PROFILES['fast'])
+    await pool.open()
+    assert await pool.run_write(migrate) == len(MIGRATIONS)
+    assert await pool.run(schema_version) == len(MIGRATIONS)
+    assert await pool.run(lambda connection: connection.execute('PRAGMA journal_mode').fetchone()[0]) == 'wal'
+    assert await pool.run(lambda connection: connection.execute('SELECT task FROM todos').fetchall()) == [('old', )]
+    with pytest.raises(sqlite3.OperationalError):
+        await pool.run(lambda connection: connection.execute("INSERT INTO todos (task) VALUES ('new')"))
+
+    # Readers are not blocked by an open write transaction
+    await pool.run_write(lambda connection: connection.execute("INSERT INTO todos (task) VALUES ('uncommitted')"))
+    assert await pool.run(lambda connection: connection.execute('SELECT COUNT(*) FROM todos').fetchone()[0]) == 1
+    await pool.run_write(lambda connection: connection.commit())
+    assert await pool.run(lambda connection: connection.execute('SELECT COUNT(*) FROM todos').fetchone()[0]) == 2
+    await pool.close()
+
+
+def test_todo_listing_etag(client: TestClient):
+    client.post('/api_bulk', json={'todos': ['a', 'b', 'c']})
+    response = client.get('/api')
+    etag = response.headers['ETag']
+    not_modified = client.get('/api', headers={'If-None-Match': etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b''
+    assert client.get('/api', headers={'If-None-Match': f'"other", W/{etag}'}).status_code == 304
+
+    # Writes invalidate the cached listing
+    client.post('/api/d')
+    response = client.get('/api', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert [todo['content'] for todo in response.json()] == ['a', 'b', 'c', 'd']
+    assert response.headers['ETag'] != etag
+
+
+def test_listing_cache():
+    now = [0.0]
+    cache = ListingCache(max_entries=2, ttl=10, clock=lambda: now[0])
+    todos = [{'id': i, 'content': f'todo{i}'} for i in range(1, 6)]
+    cache.put((0, None), todos, cache.generation)
+    cache.put((0, 2), todos[:2], cache.generation)
+    assert cache.get((0, None)) is not None
+    # The least recently used entry is evicted
+    cache.put((2, 2), todos[2:4], cache.generation)
+    assert cache.get((0, 2)) is None
+    assert len(cache) == 2
+
+    # Only listings that can contain the id are invalidated
+    cache.invalidate([5])
+    assert cache.get((2, 2)) is not None
+    assert cache.get((0, None)) is None
+    cache.invalidate([3])
+    assert cache.get((2, 2)) is None
+
+    # A listing read before a write is not stored
+    generation = cache.generation
+    cache.invalidate([1])
+    cache.put((0, None), todos, generation)
+    assert cache.get((0, None)) is None
+
+    cache.put((0, None), todos, cache.generation)
+    now[0] = 10
+    assert cache.get((0, None)) is None
+
+
+def test_todo_search(client: TestClient):
+    tasks = ['Buy milk', 'buy bread and milk', 'Call mom', 'Café tomorrow']
+    response = client.post('/api_bulk', json={'todos': tasks})
+    ids = response.json()['ids']
+    assert [todo['content'] for todo in client.get('/api_search', params={'q': 'mil'}).json()] == [
+        'Buy milk',
+        'buy bread and milk',
+    ]
+    response = client.get('/api_search', params={'q': 'buy mil', 'limit': 1})
+    assert response.json() == [{'id': ids[0], 'content': 'Buy milk'}]
+    assert [todo['id'] for todo in client.get('/api_search', params={'q': 'cafe'}).json()] == [ids[3]]
+    # FTS5 syntax in the input is treated as text
+    assert client.get('/api_search', params={'q': 'mom OR "'}).json() == []
+    assert client.get('/api_search', params={'q': '+-'}).json() == []
+    # The index follows deletes
+    client.delete(f'/api/{ids[0]}')
+    assert [todo['id'] for todo in client.get('/api_search', params={'q': 'milk'}).json()] == [ids[1]]
+
+
+def test_rebuild_search_index(tmp_path):
+    database = sqlite3.connect(tmp_path / 'todos.db')
+    migrate(database, MIGRATIONS[:1])
+    database.execute("INSERT INTO todos (task) VALUES ('written before the index existed')")
+    database.commit()
+    # The migration indexes existing todos
+    migrate(database)
+    assert search.search_todos(database, 'exist', 10) == [{'id': 1, 'content': 'written before the index existed'}]
+    database.execute("DELETE FROM todos_fts")
+    database.commit()
+    assert search.search_todos(database, 'exist', 10) == []
+    search.rebuild_search_index(database)
+    assert len(search.search_todos(database, 'written index', 10)) == 1
+    database.close()
+
+
+def test_todo_change_feed(client: TestClient):
+    with client.websocket_connect('/todows') as websocket:
+        hello = websocket.receive_json()['hello']
+        assert hello['resumed'] is False
+        client.post('/api/first')
+        changes = websocket.receive_json()['changes']
+        assert [change['op'] for change in changes] == ['insert']
+        assert changes[0]['todo']['content'] == 'first'
+        assert changes[0]['seq'] == hello['seq'] + 1
+        last_seq = changes[0]['seq']
+
+    # Changes while disconnected are replayed on resume
+    ids = client.post('/api_bulk', json={'todos': ['a', 'b']}).json()['ids']
+    client.delete(f'/api/{ids[0]}')
+    client.delete('/api/123456')
+    with client.websocket_connect(f'/todows?epoch={hello["epoch"]}&since={last_seq}') as websocket:
+        assert websocket.receive_json()['hello'] == {'epoch': hello['epoch'], 'seq': last_seq + 3, 'resumed': True}
+        changes = websocket.receive_json()['changes']
+        assert [(change['seq'], change['op']) for change in changes] == [
+            (last_seq + 1, 'insert'),
+            (last_seq + 2, 'insert'),
+            (last_seq + 3, 'delete'),
+        ]
+        assert changes[2]['id'] == ids[0]
+
+    # Sequence numbers of another process can not be resumed
+    with client.websocket_connect(f'/todows?epoch=other&since={last_seq}') as websocket:
+        assert websocket.receive_json()['hello']['resumed'] is False
@@ -0,0 +1,105 @@
+"""
+In-process read-through cache of the encoded todo listings returned by GET /api.
+Entries expire after a TTL and the least recently used entry is evicted when the cache is full.
+Writes invalidate only the listings that can contain the changed ids.
+"""
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from backend.todo.repository import Todo
+
+# (after_id, limit), limit None is the listing of all todos after 'after_id'
+ListingKey = Tuple[int, Optional[int]]
+
+
+@dataclass
+class CachedListing:
+    # JSON encoded response body
+    body: bytes
+    etag: str
+    after_id: int
+    # Id of the last todo in the listing, None if it is empty
+    last_id: Optional[int]
+    # False if the listing was cut off by its limit, todos after 'last_id' are then not part of it
+    complete: bool
+    expires: float
+
+    def contains(self, todo_id: int) -> bool:
+        """ If a todo with this id was added or removed, would it be part of this listing """
+        if todo_id <= self.after_id:
+            return False
+        return self.complete or (self.last_id is not None and todo_id <= self.last_id)
+
+
+def encode_listing(todos: List[Todo]) -> bytes:
+    # Same encoding as the default JSONResponse
+    return json.dumps(todos, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+class ListingCache:
+    def __init__(self, max_entries: int = 128, ttl: float = 5, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: 'OrderedDict[ListingKey, CachedListing]' = OrderedDict()
+        # Incremented by every write, listings read while a write happened are not stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: ListingKey) -> Optional[CachedListing]:
+        listing = self._entries.get(key)
+        if listing is None or listing.expires <= self.clock():
+            if listing is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return listing
+
+    def put(self, key: ListingKey, todos: List[Todo], generation: int) -> CachedListing:
+        """ Encodes the listing, it is only cached if no write happened since 'generation' was read """
+        body = encode_listing(todos)
+        after_id, limit = key
+        listing = CachedListing(
+            body=body,
+            etag=f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"',
+            after_id=after_id,
+            last_id=todos[-1]['id'] if todos else None,
+            complete=limit is None or len(todos) < limit,
+            expires=self.clock() + self.ttl,
+        )
+        if generation == self.generation and self.max_entries > 0:
+            self._entries[key] = listing
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return listing
+
+    def invalidate(self, todo_ids: Iterable[int]):
+        """ Drops the listings that may contain any of the added or removed ids """
+        self.generation += 1
+        todo_ids = list(todo_ids)
+        stale = [key for key, listing in self._entries.items() if any(listing.contains(i) for i in todo_ids)]
+        for key in stale:
+            del self._entries[key]
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """ Checks an If-None-Match header, which may list several (weak) etags or be '*' """
+    if not if_none_match:
+        return False
+    candidates = {candidate.strip() for candidate in if_none_match.split(',')}
+    return '*' in candidates or etag in candidates or f'W/{etag}' in candidates
@@ -0,0 +1,68 @@
+"""
+Groups single statement writes that arrive within a short window into one transaction,
+so many concurrent single item requests share one commit instead of paying one fsync each.
+"""
+import asyncio
+import sqlite3
+from typing import Any, List, Optional, Sequence, Set, Tuple
+
+from backend.todo.database import SQLitePool, WriteResult, execute_write
+
+Statement = Tuple[str, Sequence[Any]]
+
+
+class WriteCoalescer:
+    def __init__(self, pool: SQLitePool, window: float = 0.002, max_batch_size: int = 500):
+        self.pool = pool
+        # Seconds to wait for more writes after the first write of a batch arrived
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: List[Tuple[Statement, 'asyncio.Future[WriteResult]']] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._writes: Set['asyncio.Task[None]'] = set()
+
+    async def execute(self, sql: str, parameters: Sequence[Any] = ()) -> WriteResult:
+        """ Queues the statement for the next batch, returns once the batch is committed """
+        loop = asyncio.get_event_loop()
+        future: 'asyncio.Future[WriteResult]' = loop.create_future()
+        self._pending.append(((sql, parameters), future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._write(batch))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    async def _write(self, batch: List[Tuple[Statement, 'asyncio.Future[WriteResult]']]):
+        try:
+            results = await self.pool.run_write(_execute_batch, [statement for statement, _ in batch])
+        except Exception as e:  # pylint: disable=W0703
+            # The whole transaction was rolled back, every caller gets the error
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        """ Writes the pending batch and waits for all batches to be committed """
+        self._flush()
+        if self._writes:
+            await asyncio.wait(self._writes)
+
+
+def _execute_batch(connection: sqlite3.Connection, statements: List[Statement]) -> List[WriteResult]:
+    with connection:
+        return [execute_write(connection, sql, parameters) for sql, parameters in statements]
@@ -0,0 +1,236 @@
+"""
+Async access to databases with blocking drivers like sqlite3 and psycopg2:
+their calls run on a dedicated thread pool instead of the event loop.
+"""
+import asyncio
+import sqlite3
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Generic, List, NamedTuple, Optional, Sequence, TypeVar, Union
+
+from loguru import logger
+
+T = TypeVar('T')
+# Connection type of the database driver
+C = TypeVar('C')
+
+
+class PoolTimeoutError(Exception):
+    """ No connection became available within the acquire timeout """
+
+
+class WriteResult(NamedTuple):
+    last_row_id: int
+    row_count: int
+
+
+@dataclass(frozen=True)
+class SQLiteProfile:
+    """ Pragmas applied to every connection, the defaults are the sqlite defaults """
+    # 'wal' lets readers run concurrently with the writer and replaces the fsync of the rollback journal
+    journal_mode: str = 'delete'
+    # 'normal' in WAL mode only syncs on checkpoints, a power loss may lose the last commits but not corrupt the db
+    synchronous: str = 'full'
+    # Bytes of the database file read through memory mapped I/O, 0 disables it
+    mmap_size: int = 0
+    # Page cache per connection, negative values are KiB
+    cache_size: int = -2000
+    # Compiled statements cached per connection, queries with parameters are reused instead of parsed again
+    cached_statements: int = 128
+
+
+SQLITE_PROFILES: Dict[str, SQLiteProfile] = {
+    'safe': SQLiteProfile(),
+    'fast': SQLiteProfile(
+        journal_mode='wal',
+        synchronous='normal',
+        mmap_size=256 * 2**20,
+        cache_size=-64 * 2**10,
+        cached_statements=256,
+    ),
+}
+
+
+class ThreadedConnectionPool(Generic[C]):
+    """
+    A fixed number of connections of a blocking database driver, used on a dedicated thread pool.
+    Each call borrows one connection, a lease keeps the same connection for several calls.
+    Connections that 'is_broken' reports as unusable, e.g. after the database server restarted, are replaced by a new
+    connection before they are handed out again.
+    """
+    def __init__(
+        self,
+        connect: Callable[[], C],
+        pool_size: int = 4,
+        acquire_timeout: float = 5,
+        thread_name_prefix: str = 'db',
+        is_broken: Optional[Callable[[C], bool]] = None,
+    ):
+        assert pool_size > 0, pool_size
+        self.connect = connect
+        self.is_broken = is_broken
+        self.pool_size = pool_size
+        # How long a query waits for a free connection
+        self.acquire_timeout = acquire_timeout
+        # One thread per connection, so a connection is never waiting for a thread
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix=thread_name_prefix)
+        self._connections: List[C] = []
+        self._idle: Optional['asyncio.Queue[C]'] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def open(self):
+        self._loop = asyncio.get_event_loop()
+        self._idle = asyncio.Queue()
+        for _ in range(self.pool_size):
+            connection = await self._loop.run_in_executor(self._executor, self.connect)
+            self._connections.append(connection)
+            self._idle.put_nowait(connection)
+
+    async def close(self):
+        assert self._loop is not None
+        connections, self._connections = self._connections, []
+        for connection in connections:
+            await self._loop.run_in_executor(self._executor, connection.close)  # type: ignore
+        self._executor.shutdown(wait=False)
+
+    async def _acquire(self) -> C:
+        assert self._idle is not None and self._loop is not None, 'open() was not called'
+        try:
+            connection = await asyncio.wait_for(self._idle.get(), self.acquire_timeout)
+        except asyncio.TimeoutError as e:
+            raise PoolTimeoutError(f'No database connection available after {self.acquire_timeout} seconds') from e
+        if self.is_broken is None or not self.is_broken(connection):
+            return connection
+        try:
+            new_connection = await self._loop.run_in_executor(self._executor, self._reconnect, connection)
+        except BaseException:
+            # E.g. the database is still down, the next caller tries again
+            self._idle.put_nowait(connection)
+            raise
+        self._connections[self._connections.index(connection)] = new_connection
+        return new_connection
+
+    def _reconnect(self, connection: C) -> C:
+        logger.warning('Replacing a broken database connection')
+        try:
+            connection.close()  # type: ignore
+        except Exception:  # pylint: disable=W0703
+            pass
+        return self.connect()
+
+    def _release(self, connection: C):
+        assert self._loop is not None and self._idle is not None
+        self._loop.call_soon_threadsafe(self._idle.put_nowait, connection)
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator['Lease[C]']:
+        lease = Lease(self._executor, await self._acquire())
+        try:
+            yield lease
+        finally:
+            if lease.running is None:
+                self._release(lease.connection)
+            else:
+                # The awaiting task was cancelled, the connection is returned once the thread is done with it
+                lease.running.add_done_callback(lambda _: self._release(lease.connection))
+
+    async def run(self, function: Callable[..., T], *args: Any) -> T:
+        """ Calls function(connection, *args) on the database thread pool """
+        async with self.lease() as lease:
+            return await lease.run(function, *args)
+
+
+class Lease(Generic[C]):
+    """ One connection borrowed from a ThreadedConnectionPool, e.g. to read from a server side cursor """
+    def __init__(self, executor: ThreadPoolExecutor, connection: C):
+        self.executor = executor
+        self.connection = connection
+        self.running: Optional['Future[Any]'] = None
+
+    async def run(self, function: Callable[..., T], *args: Any) -> T:
+        self.running = self.executor.submit(function, self.connection, *args)
+        result = await asyncio.wrap_future(self.running)
+        self.running = None
+        return result
+
+
+class SQLitePool:
+    """
+    Reads borrow one of several read only connections, writes go through the single writer connection:
+    sqlite only allows one writer at a time, and in WAL mode readers do not wait for it.
+    """
+    def __init__(
+        self,
+        path: Union[str, Path],
+        pool_size: int = 4,
+        acquire_timeout: float = 5,
+        busy_timeout: float = 5,
+        profile: SQLiteProfile = SQLiteProfile(),
+    ):
+        self.path = path
+        # How long sqlite waits for a lock held by another connection
+        self.busy_timeout = busy_timeout
+        self.profile = profile
+        self._writer = ThreadedConnectionPool(
+            partial(self._connect, False),
+            pool_size=1,
+            acquire_timeout=acquire_timeout,
+            thread_name_prefix='sqlite_writer',
+        )
+        self._readers = ThreadedConnectionPool(
+            partial(self._connect, True),
+            pool_size=pool_size,
+            acquire_timeout=acquire_timeout,
+            thread_name_prefix='sqlite_reader',
+        )
+
+    async def open(self):
+        # The writer is opened first because it switches the journal mode
+        await self._writer.open()
+        await self._readers.open()
+
+    async def close(self):
+        await self._readers.close()
+        await self._writer.close()
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        # The pool makes sure a connection is only used by one thread at a time
+        connection = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            check_same_thread=False,
+            cached_statements=self.profile.cached_statements,
+        )
+        if not read_only:
+            connection.execute(f'PRAGMA journal_mode = {self.profile.journal_mode}')
+        connection.execute(f'PRAGMA synchronous = {self.profile.synchronous}')
+        connection.execute(f'PRAGMA mmap_size = {self.profile.mmap_size:d}')
+        connection.execute(f'PRAGMA cache_size = {self.profile.cache_size:d}')
+        if read_only:
+            connection.execute('PRAGMA query_only = ON')
+        return connection
+
+    async def run(self, function: Callable[..., T], *args: Any) -> T:
+        """ Calls function(connection, *args) with a read only connection on the database thread pool """
+        return await self._readers.run(function, *args)
+
+    async def run_write(self, function: Callable[..., T], *args: Any) -> T:
+        """ Calls function(connection, *args) with the writer connection on the database thread pool """
+        return await self._writer.run(function, *args)
+
+    async def execute(self, sql: str, parameters: Sequence[Any] = ()) -> WriteResult:
+        """ Runs a single statement in its own transaction """
+        return await self.run_write(_execute, sql, parameters)
+
+
+def execute_write(connection: sqlite3.Connection, sql: str, parameters: Sequence[Any]) -> WriteResult:
+    cursor = connection.execute(sql, parameters)
+    return WriteResult(cursor.lastrowid, cursor.rowcount)
+
+
+def _execute(connection: sqlite3.Connection, sql: str, parameters: Sequence[Any]) -> WriteResult:
+    with connection:
+        return execute_write(connection, sql, parameters)
@@ -0,0 +1,84 @@
+"""
+Change feed of the todo list for /todows subscribers.
+
+Every insert and delete gets the next sequence number. A client remembers the epoch and the last sequence number it
+has seen and reconnects with /todows?epoch=<epoch>&since=<seq> to receive only the changes it missed.
+The feed lives in the worker process and only carries the writes handled by that worker: run the backend with a
+single worker when clients rely on it, with several workers a client misses the writes of the other workers.
+Server -> client frames:
+    {"hello": {"epoch": <str>, "seq": <last seq>, "resumed": <bool>}}
+        'resumed' is false if the missed changes are no longer available, the client then reloads GET /api
+    {"changes": [{"seq": <int>, "op": "insert", "todo": {"id": <int>, "content": <str>}},
+                 {"seq": <int>, "op": "delete", "id": <int>}, ...]}
+"""
+import json
+import uuid
+from collections import deque
+from itertools import islice
+from typing import Any, Deque, Dict, List, Optional
+
+from fastapi import WebSocket
+
+from backend.chat.broadcast import BroadcastEngine, SlowConsumerPolicy
+from backend.todo.repository import Todo
+
+Change = Dict[str, Any]
+
+
+def _encode(frame: Dict[str, Any]) -> str:
+    return json.dumps(frame, separators=(',', ':'))
+
+
+class TodoChangeFeed:
+    def __init__(self, history_size: int = 10_000, send_queue_size: int = 256):
+        # Sequence numbers restart with the process, the epoch tells clients that happened
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        # The most recent changes, for clients that resume
+        self.changes: Deque[Change] = deque(maxlen=history_size)
+        # A subscriber that falls behind is disconnected instead of silently missing changes, it resumes on reconnect
+        self.broadcast_engine = BroadcastEngine(max_queue_size=send_queue_size, policy=SlowConsumerPolicy.DISCONNECT)
+
+    def __len__(self) -> int:
+        return len(self.broadcast_engine)
+
+    def _publish(self, changes: List[Change]):
+        if not changes:
+            return
+        self.changes.extend(changes)
+        self.broadcast_engine.broadcast(_encode({'changes': changes}))
+
+    def _next_seq(self) -> int:
+        self.seq += 1
+        return self.seq
+
+    def publish_inserts(self, todos: List[Todo]):
+        self._publish([{'seq': self._next_seq(), 'op': 'insert', 'todo': todo} for todo in todos])
+
+    def publish_deletes(self, todo_ids: List[int]):
+        self._publish([{'seq': self._next_seq(), 'op': 'delete', 'id': todo_id} for todo_id in todo_ids])
+
+    def changes_since(self, epoch: Optional[str], since: int) -> Optional[List[Change]]:
+        """ The changes after sequence number 'since', None if they are not available anymore """
+        if epoch != self.epoch or since > self.seq:
+            return None
+        oldest = self.changes[0]['seq'] if self.changes else self.seq + 1
+        if since < oldest - 1:
+            return None
+        # Sequence numbers are consecutive, so the position in the deque follows from the number
+        return list(islice(self.changes, since - oldest + 1, None))
+
+    def subscribe(self, websocket: WebSocket, epoch: Optional[str] = None, since: Optional[int] = None):
+        """ Sends the hello frame and the missed changes, then all new changes to the websocket """
+        missed = None if since is None else self.changes_since(epoch, since)
+        self.broadcast_engine.add(websocket)
+        hello = {'epoch': self.epoch, 'seq': self.seq, 'resumed': missed is not None}
+        self.broadcast_engine.send(_encode({'hello': hello}), websocket)
+        if missed:
+            self.broadcast_engine.send(_encode({'changes': missed}), websocket)
+
+    def unsubscribe(self, websocket: WebSocket):
+        self.broadcast_engine.remove(websocket)
+
+    def close(self):
+        self.broadcast_engine.close()
@@ -0,0 +1,46 @@
+"""
+Schema migrations of the todo database, the applied version is stored in 'PRAGMA user_version'.
+Migrations are only ever appended, each one runs in its own transaction together with the version bump.
+"""
+import sqlite3
+from typing import List
+
+from loguru import logger
+
+MIGRATIONS: List[str] = [
+    # 1: Initial schema, databases created before versioning already have this table
+    'CREATE TABLE IF NOT EXISTS todos (id INTEGER PRIMARY KEY AUTOINCREMENT, task TEXT);',
+    # 2: Full text search index over the tasks, kept in sync by triggers and filled with the existing todos
+    '''
+    CREATE VIRTUAL TABLE todos_fts USING fts5(
+        task, content='todos', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER todos_fts_insert AFTER INSERT ON todos BEGIN
+        INSERT INTO todos_fts (rowid, task) VALUES (new.id, new.task);
+    END;
+    CREATE TRIGGER todos_fts_delete AFTER DELETE ON todos BEGIN
+        INSERT INTO todos_fts (todos_fts, rowid, task) VALUES ('delete', old.id, old.task);
+    END;
+    CREATE TRIGGER todos_fts_update AFTER UPDATE ON todos BEGIN
+        INSERT INTO todos_fts (todos_fts, rowid, task) VALUES ('delete', old.id, old.task);
+        INSERT INTO todos_fts (rowid, task) VALUES (new.id, new.task);
+    END;
+    INSERT INTO todos_fts (todos_fts) VALUES ('rebuild');
+    ''',
+]
+
+
+def schema_version(connection: sqlite3.Connection) -> int:
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(connection: sqlite3.Connection, migrations: List[str] = MIGRATIONS) -> int:
+    """ Applies all migrations that are newer than the database, returns the new schema version """
+    version = schema_version(connection)
+    if version > len(migrations):
+        raise RuntimeError(f'Database schema version {version} is newer than this application ({len(migrations)})')
+    for new_version, script in enumerate(migrations[version:], start=version + 1):
+        # executescript commits any open transaction first, so the transaction is managed by the script itself
+        connection.executescript(f'BEGIN;\n{script}\nPRAGMA user_version = {new_version:d};\nCOMMIT;')
+        logger.info(f'Migrated todo database to schema version {new_version}')
+    return len(migrations)
@@ -0,0 +1,126 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, AsyncIterator, Callable, List, Optional, TypeVar
+
+import pymongo
+from pymongo import MongoClient, ReturnDocument
+from pymongo.collection import Collection
+from pymongo.errors import ConnectionFailure
+
+from backend.todo.database import PoolTimeoutError
+from backend.todo.repository import Todo, TodoRepository
+
+T = TypeVar('T')
+
+
+def _documents_to_todos(documents) -> List[Todo]:
+    return [{
+        'id': document['_id'],
+        'content': document['task'],
+    } for document in documents]
+
+
+def _is_wait_queue_timeout(error: ConnectionFailure) -> bool:
+    # pymongo 4 raises WaitQueueTimeoutError, pymongo 3 a plain ConnectionFailure
+    wait_queue_timeout_error = getattr(pymongo.errors, 'WaitQueueTimeoutError', None)
+    if wait_queue_timeout_error is not None and isinstance(error, wait_queue_timeout_error):
+        return True
+    return 'checking out a connection from connection pool' in str(error)
+
+
+class MongoTodoRepository(TodoRepository):
+    """
+    Todos are stored as {"_id": <int>, "task": <str>}, integer ids are handed out by a counter document
+    so the routes work the same as with the sql backends.
+    """
+    name = 'mongo'
+
+    def __init__(self, url: str, database: str = 'todos', pool_size: int = 4, acquire_timeout: float = 5):
+        self.url = url
+        self.database = database
+        self.pool_size = pool_size
+        self.acquire_timeout = acquire_timeout
+        # pymongo blocks, its calls run on this thread pool, MongoClient itself pools the connections
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='mongo')
+        self._client: Optional[MongoClient] = None
+
+    @property
+    def todos(self) -> Collection:
+        assert self._client is not None, 'open() was not called'
+        return self._client[self.database]['todos']
+
+    @property
+    def counters(self) -> Collection:
+        assert self._client is not None, 'open() was not called'
+        return self._client[self.database]['counters']
+
+    async def _run(self, function: Callable[..., T], *args: Any) -> T:
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+        except ConnectionFailure as e:
+            # Same as the sql backends, so the routes answer with 503 instead of 500
+            if _is_wait_queue_timeout(e):
+                raise PoolTimeoutError(f'No mongodb connection available after {self.acquire_timeout} seconds') from e
+            raise
+
+    async def open(self):
+        self._client = MongoClient(
+            self.url,
+            maxPoolSize=self.pool_size,
+            waitQueueTimeoutMS=int(self.acquire_timeout * 1000),
+        )
+
+    async def close(self):
+        if self._client is not None:
+            await self._run(self._client.close)
+            self._client = None
+        self._executor.shutdown(wait=False)
+
+    def _find(self, after_id: int, limit: int = 0) -> List[Todo]:
+        cursor = self.todos.find({'_id': {'$gt': after_id}}).sort('_id', pymongo.ASCENDING).limit(limit)
+        return _documents_to_todos(cursor)
+
+    async def list_todos(self) -> List[Todo]:
+        return await self._run(self._find, 0)
+
+    async def list_page(self, after_id: int, limit: int) -> List[Todo]:
+        return await self._run(self._find, after_id, limit)
+
+    async def iterate(self, after_id: int, batch_size: int) -> AsyncIterator[List[Todo]]:
+        # The cursor stays open on the server, each batch is one getMore round trip
+        cursor = self.todos.find({'_id': {'$gt': after_id}}).sort('_id', pymongo.ASCENDING).batch_size(batch_size)
+        try:
+            while 1:
+                batch = await self._run(lambda: _documents_to_todos(islice(cursor, batch_size)))
+                if batch:
+                    yield batch
+                if len(batch) < batch_size:
+                    return
+        finally:
+            await self._run(cursor.close)
+
+    def _reserve_ids(self, count: int) -> List[int]:
+        counter = self.counters.find_one_and_update(
+            {'_id': 'todos'},
+            {'$inc': {'seq': count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        last_id = counter['seq']
+        return list(range(last_id - count + 1, last_id + 1))
+
+    def _insert_many(self, tasks: List[str]) -> List[int]:
+        ids = self._reserve_ids(len(tasks))
+        self.todos.insert_many([{'_id': todo_id, 'task': task} for todo_id, task in zip(ids, tasks)])
+        return ids
+
+    async def insert(self, task: str) -> int:
+        return (await self.insert_many([task]))[0]
+
+    async def insert_many(self, tasks: List[str]) -> List[int]:
+        return await self._run(self._insert_many, tasks)
+
+    async def delete_many(self, todo_ids: List[int]) -> int:
+        result = await self._run(self.todos.delete_many, {'_id': {'$in': todo_ids}})
+        return result.deleted_count
@@ -0,0 +1,126 @@
+from functools import partial
+from typing import AsyncIterator, List
+
+import psycopg2
+from psycopg2.extensions import connection as Connection
+from psycopg2.extras import execute_values
+
+from backend.todo.database import ThreadedConnectionPool
+from backend.todo.repository import Todo, TodoRepository
+
+CREATE_TABLE = 'CREATE TABLE IF NOT EXISTS todos (id BIGSERIAL PRIMARY KEY, task TEXT)'
+
+
+def _rows_to_todos(rows: List[tuple]) -> List[Todo]:
+    return [{
+        'id': row[0],
+        'content': row[1],
+    } for row in rows]
+
+
+def _is_broken(connection: Connection) -> bool:
+    # psycopg2 marks the connection as closed once a query failed because the server went away
+    return connection.closed != 0
+
+
+def _create_table(connection: Connection):
+    with connection, connection.cursor() as cursor:
+        cursor.execute(CREATE_TABLE)
+
+
+def _select_todos(connection: Connection) -> List[Todo]:
+    with connection, connection.cursor() as cursor:
+        cursor.execute('SELECT id, task FROM todos ORDER BY id')
+        return _rows_to_todos(cursor.fetchall())
+
+
+def _select_todos_page(connection: Connection, after_id: int, limit: int) -> List[Todo]:
+    with connection, connection.cursor() as cursor:
+        cursor.execute('SELECT id, task FROM todos WHERE id > %s ORDER BY id LIMIT %s', [after_id, limit])
+        return _rows_to_todos(cursor.fetchall())
+
+
+def _insert_todos(connection: Connection, tasks: List[str]) -> List[int]:
+    with connection, connection.cursor() as cursor:
+        # One multi row INSERT per page of 1000 tasks instead of one statement per task
+        rows = execute_values(
+            cursor,
+            'INSERT INTO todos (task) VALUES %s RETURNING id',
+            [(task, ) for task in tasks],
+            page_size=1000,
+            fetch=True,
+        )
+        return [row[0] for row in rows]
+
+
+def _delete_todos(connection: Connection, todo_ids: List[int]) -> int:
+    with connection, connection.cursor() as cursor:
+        cursor.execute('DELETE FROM todos WHERE id = ANY(%s)', [todo_ids])
+        return cursor.rowcount
+
+
+def _open_server_cursor(connection: Connection, after_id: int, batch_size: int):
+    # A named cursor keeps the result set on the server, rows are transferred 'itersize' at a time
+    cursor = connection.cursor(name='todos_stream')
+    cursor.itersize = batch_size
+    cursor.execute('SELECT id, task FROM todos WHERE id > %s ORDER BY id', [after_id])
+    return cursor
+
+
+def _fetch_batch(_connection: Connection, cursor, batch_size: int) -> List[Todo]:
+    return _rows_to_todos(cursor.fetchmany(batch_size))
+
+
+def _close_server_cursor(connection: Connection, cursor):
+    cursor.close()
+    # Ends the read transaction the named cursor lived in
+    connection.rollback()
+
+
+class PostgresTodoRepository(TodoRepository):
+    name = 'postgres'
+
+    def __init__(self, dsn: str, pool_size: int = 4, acquire_timeout: float = 5):
+        self.pool: ThreadedConnectionPool[Connection] = ThreadedConnectionPool(
+            partial(psycopg2.connect, dsn),
+            pool_size=pool_size,
+            acquire_timeout=acquire_timeout,
+            thread_name_prefix='postgres',
+            is_broken=_is_broken,
+        )
+
+    async def open(self):
+        await self.pool.open()
+        await self.pool.run(_create_table)
+
+    async def close(self):
+        await self.pool.close()
+
+    async def list_todos(self) -> List[Todo]:
+        return await self.pool.run(_select_todos)
+
+    async def list_page(self, after_id: int, limit: int) -> List[Todo]:
+        return await self.pool.run(_select_todos_page, after_id, limit)
+
+    async def iterate(self, after_id: int, batch_size: int) -> AsyncIterator[List[Todo]]:
+        # The connection stays leased until the stream is consumed or aborted
+        async with self.pool.lease() as lease:
+            cursor = await lease.run(_open_server_cursor, after_id, batch_size)
+            try:
+                while 1:
+                    batch = await lease.run(_fetch_batch, cursor, batch_size)
+                    if batch:
+                        yield batch
+                    if len(batch) < batch_size:
+                        return
+            finally:
+                await lease.run(_close_server_cursor, cursor)
+
+    async def insert(self, task: str) -> int:
+        return (await self.insert_many([task]))[0]
+
+    async def insert_many(self, tasks: List[str]) -> List[int]:
+        return await self.pool.run(_insert_todos, tasks)
+
+    async def delete_many(self, todo_ids: List[int]) -> int:
+        return await self.pool.run(_delete_todos, todo_ids)
@@ -0,0 +1,55 @@
+"""
+Storage interface of the todo list, implemented for sqlite, postgres and mongodb.
+All methods are coroutines and must not block the event loop.
+"""
+from typing import Any, AsyncIterator, Dict, List
+
+# {'id': <int>, 'content': <str>}, the format returned by the todo routes
+Todo = Dict[str, Any]
+
+
+class TodoRepository:
+    name = ''
+
+    async def open(self):
+        """ Connects and creates or migrates the schema """
+
+    async def close(self):
+        pass
+
+    async def list_todos(self) -> List[Todo]:
+        raise NotImplementedError()
+
+    async def list_page(self, after_id: int, limit: int) -> List[Todo]:
+        """ Keyset pagination: the first 'limit' todos with an id greater than 'after_id', ordered by id """
+        raise NotImplementedError()
+
+    async def iterate(self, after_id: int, batch_size: int) -> AsyncIterator[List[Todo]]:
+        """ Yields all todos after 'after_id' in batches, only one batch is held in memory at a time """
+        while 1:
+            batch = await self.list_page(after_id, batch_size)
+            if batch:
+                yield batch
+            if len(batch) < batch_size:
+                return
+            after_id = batch[-1]['id']
+
+    async def insert(self, task: str) -> int:
+        """ Returns the id of the new todo """
+        raise NotImplementedError()
+
+    async def insert_many(self, tasks: List[str]) -> List[int]:
+        """ Inserts all tasks in one transaction, returns the new ids in order """
+        raise NotImplementedError()
+
+    async def delete(self, todo_id: int) -> int:
+        """ Returns the number of deleted todos """
+        return await self.delete_many([todo_id])
+
+    async def delete_many(self, todo_ids: List[int]) -> int:
+        """ Deletes all ids in one transaction, returns the number of deleted todos """
+        raise NotImplementedError()
+
+    async def search(self, query: str, limit: int) -> List[Todo]:
+        """ Todos containing all words of the query as word prefix, best matches first """
+        raise NotImplementedError()
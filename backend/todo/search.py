@@ -0,0 +1,56 @@
+"""
+Full text search over the todos of the sqlite backend with the FTS5 index 'todos_fts'.
+Rebuild the index of an existing database, e.g. after editing the todos table with triggers disabled, with:
+poetry run python -m backend.todo.search <path to todos.db>
+"""
+import re
+import sqlite3
+import sys
+from typing import List
+
+from loguru import logger
+
+from backend.todo.migrations import migrate
+from backend.todo.repository import Todo
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def build_match_query(query: str) -> str:
+    """
+    Turns user input into an FTS5 query: every word is quoted, so FTS5 operators in the input have no effect,
+    and matched as prefix. All words have to match.
+    """
+    return ' '.join(f'"{word}"*' for word in _WORD.findall(query))
+
+
+def search_todos(connection: sqlite3.Connection, query: str, limit: int) -> List[Todo]:
+    match_query = build_match_query(query)
+    if not match_query:
+        return []
+    # 'rank' is the bm25 score, lower is better
+    rows = connection.execute(
+        'SELECT todos.id, todos.task FROM todos_fts JOIN todos ON todos.id = todos_fts.rowid '
+        'WHERE todos_fts MATCH ? ORDER BY rank LIMIT ?',
+        [match_query, limit],
+    )
+    return [{
+        'id': row[0],
+        'content': row[1],
+    } for row in rows]
+
+
+def rebuild_search_index(connection: sqlite3.Connection):
+    """ Recreates the index from the todos table """
+    with connection:
+        connection.execute("INSERT INTO todos_fts (todos_fts) VALUES ('rebuild')")
+        connection.execute("INSERT INTO todos_fts (todos_fts) VALUES ('optimize')")
+
+
+if __name__ == '__main__':
+    database_path = sys.argv[1]
+    with sqlite3.connect(database_path) as database:
+        # Older databases get the index from their migration
+        migrate(database)
+        rebuild_search_index(database)
+    logger.info(f'Rebuilt search index of {database_path}')
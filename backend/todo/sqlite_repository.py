@@ -0,0 +1,114 @@
+import os
+import sqlite3
+from pathlib import Path
+from typing import List, Optional, Union
+
+from loguru import logger
+
+from backend.todo.coalescer import WriteCoalescer
+from backend.todo.database import SQLiteProfile, SQLitePool, WriteResult
+from backend.todo.migrations import migrate
+from backend.todo.repository import Todo, TodoRepository
+from backend.todo.search import search_todos
+
+INSERT_TODO = 'INSERT INTO todos (task) VALUES (?)'
+DELETE_TODO = 'DELETE FROM todos WHERE id==(?)'
+
+
+def _select_todos(connection: sqlite3.Connection) -> List[Todo]:
+    return [{
+        'id': row[0],
+        'content': row[1],
+    } for row in connection.execute('SELECT id, task FROM todos')]
+
+
+def _select_todos_page(connection: sqlite3.Connection, after_id: int, limit: int) -> List[Todo]:
+    # Keyset pagination: seeks on the primary key instead of skipping rows with OFFSET
+    return [{
+        'id': row[0],
+        'content': row[1],
+    } for row in connection.execute('SELECT id, task FROM todos WHERE id > ? ORDER BY id LIMIT ?', [after_id, limit])]
+
+
+def _insert_todos(connection: sqlite3.Connection, tasks: List[str]) -> List[int]:
+    with connection:
+        connection.executemany(INSERT_TODO, [(task, ) for task in tasks])
+        # The transaction holds the write lock, so the ids of the inserted rows are consecutive
+        last_id = connection.execute('SELECT last_insert_rowid()').fetchone()[0]
+    return list(range(last_id - len(tasks) + 1, last_id + 1))
+
+
+def _delete_todos(connection: sqlite3.Connection, todo_ids: List[int]) -> int:
+    with connection:
+        return connection.executemany(DELETE_TODO, [(todo_id, ) for todo_id in todo_ids]).rowcount
+
+
+class SQLiteTodoRepository(TodoRepository):
+    name = 'sqlite'
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        pool_size: int = 4,
+        acquire_timeout: float = 5,
+        busy_timeout: float = 5,
+        profile: SQLiteProfile = SQLiteProfile(),
+        write_coalesce_window: float = 0,
+        write_coalesce_max_batch: int = 500,
+    ):
+        self.path = Path(path)
+        self.pool = SQLitePool(
+            path,
+            pool_size=pool_size,
+            acquire_timeout=acquire_timeout,
+            busy_timeout=busy_timeout,
+            profile=profile,
+        )
+        # Single item writes are committed together with other writes arriving within the window
+        self.write_coalescer: Optional[WriteCoalescer] = None
+        if write_coalesce_window > 0:
+            self.write_coalescer = WriteCoalescer(
+                self.pool,
+                window=write_coalesce_window,
+                max_batch_size=write_coalesce_max_batch,
+            )
+
+    async def open(self):
+        is_new = not self.path.is_file()
+        if is_new:
+            os.makedirs(self.path.parent, exist_ok=True)
+        await self.pool.open()
+        await self.pool.run_write(migrate)
+        if is_new:
+            logger.info(f'Created new database: {self.path.name}')
+
+    async def close(self):
+        if self.write_coalescer is not None:
+            await self.write_coalescer.close()
+        await self.pool.close()
+
+    async def _execute_write(self, sql: str, parameter: Union[str, int]) -> WriteResult:
+        if self.write_coalescer is None:
+            return await self.pool.execute(sql, [parameter])
+        return await self.write_coalescer.execute(sql, [parameter])
+
+    async def list_todos(self) -> List[Todo]:
+        return await self.pool.run(_select_todos)
+
+    async def list_page(self, after_id: int, limit: int) -> List[Todo]:
+        return await self.pool.run(_select_todos_page, after_id, limit)
+
+    async def insert(self, task: str) -> int:
+        return (await self._execute_write(INSERT_TODO, task)).last_row_id
+
+    async def insert_many(self, tasks: List[str]) -> List[int]:
+        return await self.pool.run_write(_insert_todos, tasks)
+
+    async def delete(self, todo_id: int) -> int:
+        return (await self._execute_write(DELETE_TODO, todo_id)).row_count
+
+    async def delete_many(self, todo_ids: List[int]) -> int:
+        return await self.pool.run_write(_delete_todos, todo_ids)
+
+    async def search(self, query: str, limit: int) -> List[Todo]:
+        return await self.pool.run(search_todos, query, limit)
@@ -49,10 +49,16 @@ export default function NormalChat(): JSX.Element {
                     // Why doesn't this work
                     // setMessages([...messages, content.newMessage])
                     setMessages((messages) => [...messages, content.newMessage])
+                } else if ("newMessages" in content) {
+                    // Several new messages at once, sent by busy rooms
+                    setMessages((messages) => [...messages, ...content.newMessages])
                 } else if ("newMessageHistory" in content) {
                     // Received new message
                     // console.log(`Received new message history: ${JSON.stringify(content.newMessageHistory)}`)
                     setMessages([...content.newMessageHistory])
+                } else if ("ping" in content) {
+                    // Server checks if the connection is still alive
+                    ws.send(JSON.stringify({ pong: content.ping }))
                 } else if ("connectUser" in content) {
                     // User connected, server accepted the username
                     console.log(`Successfully connected to server with username ${content.connectUser}`)
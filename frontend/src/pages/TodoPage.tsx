@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from "react"
+import React, { useEffect, useRef, useState } from "react"
 import TodoItem from "../components/TodoItem"
 import { delete_, get, post } from "../functions/fetch_helper"
 
@@ -7,15 +7,88 @@ type ITodoItem = {
     content: string
 }
 
+type ITodoChange = {
+    seq: number
+    op: "insert" | "delete"
+    todo?: ITodoItem
+    id?: number
+}
+
 export default function TodoPage(): JSX.Element {
     const [newTodoText, setNewTodoText] = useState("")
     const [todos, setTodos] = useState<ITodoItem[]>([])
     const [APIserverIsResponding, setAPIserverIsResponding] = useState(true)
 
+    // Last change received from /todows, used to resume after a reconnect
+    const feedPosition = useRef<{ epoch: string; seq: number } | null>(null)
+    const [feedIsLive, setFeedIsLive] = useState(false)
+
     useEffect(() => {
-        getTodos()
+        // The feed only carries the changes of a single backend worker, see backend/todo/feed.py
+        connectFeed()
     }, [])
 
+    const connectFeed = () => {
+        const address = process.env.REACT_APP_WEBSOCKET
+        if (!address) {
+            console.error("process.env.REACT_APP_WEBSOCKET is not set! Check your Env variables")
+        }
+        const position = feedPosition.current
+        const resume = position ? `?epoch=${position.epoch}&since=${position.seq}` : ""
+        const ws = new WebSocket(`${address}/todows${resume}`)
+        ws.onmessage = (event) => {
+            const content = JSON.parse(event.data)
+            if ("hello" in content) {
+                feedPosition.current = { epoch: content.hello.epoch, seq: content.hello.seq }
+                setFeedIsLive(true)
+                if (!content.hello.resumed) {
+                    // Missed changes are not available, load the whole list once
+                    getTodos()
+                }
+            } else if ("changes" in content) {
+                applyChanges(content.changes)
+            }
+        }
+        ws.onclose = () => {
+            setFeedIsLive(false)
+            // Resume from the last received change, the list is only reloaded if the hello says that failed
+            const sleep_in_seconds = 5
+            setTimeout(() => {
+                connectFeed()
+            }, sleep_in_seconds * 1000)
+        }
+        ws.onerror = () => {
+            ws.close()
+        }
+    }
+
+    const applyChanges = (changes: ITodoChange[]) => {
+        setTodos((todos) => {
+            let newTodos = todos
+            changes.forEach((change) => {
+                if (change.op === "insert" && change.todo) {
+                    const todo = change.todo
+                    if (!newTodos.some((obj) => obj.id === todo.id)) {
+                        newTodos = [...newTodos, todo]
+                    }
+                } else if (change.op === "delete") {
+                    newTodos = newTodos.filter((obj) => obj.id !== change.id)
+                }
+            })
+            return newTodos
+        })
+        if (feedPosition.current && changes.length > 0) {
+            feedPosition.current.seq = changes[changes.length - 1].seq
+        }
+    }
+
+    const refreshTodos = async () => {
+        // While the change feed is live it delivers our own changes, too
+        if (!feedIsLive) {
+            await getTodos()
+        }
+    }
+
     const getTodos = async () => {
         try {
             const response = await get("/api")
@@ -44,7 +117,7 @@ export default function TodoPage(): JSX.Element {
             localSubmit()
         }
         setNewTodoText("")
-        await getTodos()
+        await refreshTodos()
     }
 
     const submitPressedBody = async () => {
@@ -56,7 +129,7 @@ export default function TodoPage(): JSX.Element {
             localSubmit()
         }
         setNewTodoText("")
-        await getTodos()
+        await refreshTodos()
     }
 
     const submitPressedModel = async () => {
@@ -73,7 +146,7 @@ export default function TodoPage(): JSX.Element {
             localSubmit()
         }
         setNewTodoText("")
-        await getTodos()
+        await refreshTodos()
     }
 
     const removeTodo = async (id: number) => {
@@ -82,7 +155,7 @@ export default function TodoPage(): JSX.Element {
         } else {
             localRemove(id)
         }
-        await getTodos()
+        await refreshTodos()
     }
 
     const localSubmit = () => {
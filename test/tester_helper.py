@@ -52,6 +52,11 @@ def get_pid(name: str) -> Set[int]:
     return process_pids
 
 
+def sqlite_files(database: Path) -> Set[Path]:
+    """ The database and its write-ahead log files, a leftover log would be applied to the next fresh database """
+    return {database, database.with_name(f'{database.name}-wal'), database.with_name(f'{database.name}-shm')}
+
+
 def remove_leftover_files(files: Set[Path]):
     for file in files:
         if file.is_file():
@@ -161,8 +166,8 @@ def start_backend_dev_server(
 
     sqlite_test_file_name = 'todos_TEST.db'
     sqlite_test_file_path = backend_folder / 'data' / sqlite_test_file_name
-    CREATED_FILES.add(sqlite_test_file_path)
-    remove_leftover_files({sqlite_test_file_path})
+    CREATED_FILES.update(sqlite_files(sqlite_test_file_path))
+    remove_leftover_files(sqlite_files(sqlite_test_file_path))
     env['SQLITE_FILENAME'] = sqlite_test_file_name
 
     logger.info(f'Starting backend on port {port}')